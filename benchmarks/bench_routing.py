@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Routing benchmarks for tipfy.
+
+Builds synthetic URL maps of increasing size, mixing static rules, rules with
+``int``, ``path`` and ``regex`` converters and subdomain rules, and measures:
+
+    - the time to expand the rules wrapped by HandlerPrefix;
+    - the time to build the router (map construction);
+    - matches per second for paths that match a rule;
+    - matches per second for paths that don't match any rule;
+    - URL builds per second.
+
+Run it from the repository root::
+
+    python benchmarks/bench_routing.py
+
+To compare two revisions, save the results of one as JSON and pass them to
+the other::
+
+    python benchmarks/bench_routing.py --json=before.json
+    (checkout another revision)
+    python benchmarks/bench_routing.py --compare=before.json
+
+Router options can be set with ``--config``, e.g.,
+``--config=url_trie=True --config=match_cache_size=1000``.
+"""
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+base = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(base, '..'))
+
+import tipfy
+from tipfy import (HandlerPrefix, Request, RequestHandler, Rule, Subdomain,
+    Tipfy)
+
+#: Default map sizes.
+SIZES = '10,100,1000,10000'
+#: Server name used to match subdomains.
+SERVER_NAME = 'example.com'
+#: Metrics, in the order they are reported, and if higher is better.
+METRICS = [
+    ('prefix_secs', False),
+    ('construct_secs', False),
+    ('match_per_sec', True),
+    ('miss_per_sec', True),
+    ('build_per_sec', True),
+]
+
+
+class BenchmarkHandler(RequestHandler):
+    def get(self, **kwargs):
+        return ''
+
+
+def get_rules(size):
+    """Returns a list of synthetic rules and a list of samples to match and
+    build them.
+
+    :param size:
+        Number of rules.
+    :returns:
+        A tuple ``(rules, samples)``. Each sample is a tuple
+        ``(base_url, path, name, values)``.
+    """
+    rules = []
+    subdomain_rules = []
+    samples = []
+    base_url = 'http://%s/' % SERVER_NAME
+    user_url = 'http://calvin.%s/' % SERVER_NAME
+
+    for i in range(size):
+        kind = i % 5
+        name = 'rule-%d' % i
+        if kind == 0:
+            rules.append(Rule('/static%d/page' % i, name=name,
+                handler='BenchmarkHandler'))
+            samples.append((base_url, '/static%d/page' % i, name, {}))
+        elif kind == 1:
+            rules.append(Rule('/items%d/<int:id>' % i, name=name,
+                handler='BenchmarkHandler'))
+            samples.append((base_url, '/items%d/42' % i, name, {'id': 42}))
+        elif kind == 2:
+            rules.append(Rule('/files%d/<path:filename>' % i, name=name,
+                handler='BenchmarkHandler'))
+            samples.append((base_url, '/files%d/a/b.txt' % i, name,
+                {'filename': 'a/b.txt'}))
+        elif kind == 3:
+            rules.append(Rule('/tags%d/<regex("[a-z]+"):tag>' % i, name=name,
+                handler='BenchmarkHandler'))
+            samples.append((base_url, '/tags%d/python' % i, name,
+                {'tag': 'python'}))
+        else:
+            subdomain_rules.append(Rule('/users%d/<int:id>' % i, name=name,
+                handler='BenchmarkHandler'))
+            samples.append((user_url, '/users%d/42' % i, name,
+                {'id': 42, 'user': 'calvin'}))
+
+    rules = [
+        HandlerPrefix('%s.' % __name__, rules + [
+            Subdomain(r'<regex("(?!www\b)\w+"):user>', subdomain_rules),
+        ]),
+    ]
+    return rules, samples
+
+
+def get_sample(samples, count=500):
+    """Returns up to ``count`` samples evenly spread over all samples."""
+    if len(samples) <= count:
+        return samples
+
+    # Offset the indexes so that all kinds of rules are sampled.
+    step = len(samples) // count
+    return [samples[i * step + i % step] for i in range(count)]
+
+
+def measure(func, items, min_time):
+    """Calls a function for each item repeatedly, until ``min_time`` has
+    passed, and returns the number of calls per second.
+    """
+    calls = 0
+    start = time.time()
+    while True:
+        for item in items:
+            func(item)
+
+        calls += len(items)
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            return calls / elapsed
+
+
+def best_time(func, repeat):
+    """Returns the best time of ``repeat`` calls to a function."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+
+    return min(times)
+
+
+def bench_size(size, config, repeat, min_time):
+    """Runs all benchmarks for a map size.
+
+    :returns:
+        A dictionary of metrics.
+    """
+    def get_app():
+        rules, samples = get_rules(size)
+        return Tipfy(rules=rules, config={'tipfy': config})
+
+    rules, samples = get_rules(size)
+    samples = get_sample(samples)
+
+    result = {}
+    result['prefix_secs'] = best_time(lambda: list(rules[0].get_rules(None)),
+        repeat)
+    result['construct_secs'] = best_time(get_app, repeat)
+
+    app = get_app()
+    router = app.router
+
+    requests = []
+    missing = []
+    for base_url, path, name, values in samples:
+        request = Request.from_values(path, base_url=base_url)
+        requests.append((request, name, values))
+        missing.append(Request.from_values('/missing' + path,
+            base_url=base_url))
+
+    def match(request):
+        try:
+            router.match(request)
+        except Exception:
+            pass
+
+    def build(args):
+        request, name, values = args
+        router.build(request, name, dict(values))
+
+    # Bind the requests and check that the samples match.
+    for request, name, values in requests:
+        rule, rule_args = router.match(request)
+        assert rule.name == name, (rule.name, name)
+
+    rates = []
+    for i in range(repeat):
+        rates.append((
+            measure(match, [r[0] for r in requests], min_time),
+            measure(match, missing, min_time),
+            measure(build, requests, min_time),
+        ))
+
+    result['match_per_sec'] = max(r[0] for r in rates)
+    result['miss_per_sec'] = max(r[1] for r in rates)
+    result['build_per_sec'] = max(r[2] for r in rates)
+    return result
+
+
+def get_revision():
+    """Returns the current git revision, or None if it is unknown."""
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=base)
+        revision = process.communicate()[0].strip()
+        return revision or None
+    except OSError:
+        return None
+
+
+def parse_config(values):
+    """Parses ``key=value`` options as config values for the ``tipfy``
+    module. Values are evaluated as Python literals when possible.
+    """
+    config = {'server_name': SERVER_NAME}
+    for value in values:
+        key, value = value.split('=', 1)
+        try:
+            value = eval(value, {}, {})
+        except Exception:
+            pass
+
+        config[key] = value
+
+    return config
+
+
+def format_value(metric, value):
+    if metric.endswith('_secs'):
+        return '%14.2fms' % (value * 1000)
+
+    return '%14.0f/s' % value
+
+
+def print_results(results, previous=None):
+    header = '%6s' % 'rules'
+    for metric, higher in METRICS:
+        header += ' %16s' % metric
+
+    print header
+    for size in sorted(results['sizes'], key=int):
+        line = '%6s' % size
+        for metric, higher in METRICS:
+            value = results['sizes'][size][metric]
+            line += ' %s' % format_value(metric, value)
+
+        print line
+
+        if previous and size in previous['sizes']:
+            line = '%6s' % ''
+            for metric, higher in METRICS:
+                old = previous['sizes'][size][metric]
+                value = results['sizes'][size][metric]
+                if higher:
+                    ratio = value / old
+                else:
+                    ratio = old / value
+
+                line += ' %16s' % ('%.2fx' % ratio)
+
+            print line
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default=SIZES,
+        help='comma separated map sizes [default: %default]')
+    parser.add_option('--repeat', type='int', default=3,
+        help='times each benchmark is repeated; the best result is kept '
+        '[default: %default]')
+    parser.add_option('--min-time', type='float', default=0.2,
+        help='minimum time in seconds to measure rates [default: %default]')
+    parser.add_option('--config', action='append', default=[],
+        help="a 'tipfy' config value as key=value; can be repeated")
+    parser.add_option('--json', metavar='FILE',
+        help="save results as JSON to FILE; use '-' for stdout")
+    parser.add_option('--compare', metavar='FILE',
+        help='compare results with a JSON file saved using --json; ratios '
+        'above 1 are improvements')
+    options, args = parser.parse_args()
+
+    config = parse_config(options.config)
+    results = {
+        'tipfy_version': tipfy.__version__,
+        'revision': get_revision(),
+        'python_version': sys.version.split()[0],
+        'config': config,
+        'sizes': {},
+    }
+
+    for size in options.sizes.split(','):
+        size = str(int(size))
+        results['sizes'][size] = bench_size(int(size), config,
+            options.repeat, options.min_time)
+        if options.json != '-':
+            sys.stderr.write('.')
+
+    if options.json != '-':
+        sys.stderr.write('\n')
+
+    if options.json:
+        if options.json == '-':
+            print json.dumps(results, indent=2, sort_keys=True)
+            return
+
+        f = open(options.json, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    previous = None
+    if options.compare:
+        f = open(options.compare)
+        try:
+            previous = json.load(f)
+        finally:
+            f.close()
+
+        print 'Compared with revision %s (ratios above 1 are improvements)' % \
+            previous.get('revision')
+
+    print_results(results, previous)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,9 +14,21 @@ def get_rules(app):
     """
     #  Here we show an example of joining all rules from the
     # ``apps_installed`` definition set in config.py.
-    rules = []
+    # Handle App Engine warmup requests, importing all handlers.
+    rules = [
+        Rule('/_ah/warmup', name='warmup', handler='tipfy.WarmupHandler'),
+    ]
+
+    # Apps with an entry point are loaded by the router on demand when
+    # 'apps_lazy_load' is enabled, so we skip them here.
+    lazy_apps = {}
+    if app.get_config('tipfy', 'apps_lazy_load'):
+        lazy_apps = app.get_config('tipfy', 'apps_entry_points')
 
     for app_module in app.get_config('tipfy', 'apps_installed'):
+        if app_module in lazy_apps:
+            continue
+
         try:
             # Load the urls module from the app and extend our rules.
             app_rules = import_string('%s.urls' % app_module)
@@ -1,8 +1,15 @@
 import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
 
 from tipfy import (Request, RequestHandler, Response, Rule, Tipfy,
-    make_wsgi_app, run_wsgi_app, ALLOWED_METHODS)
+    WarmupHandler, get_config, make_wsgi_app, run_in_process, run_wsgi_app,
+    url_for, ALLOWED_METHODS)
 
 
 class BrokenHandler(RequestHandler):
@@ -158,6 +165,322 @@ class TestHandleException(unittest.TestCase):
         self.assertEqual(res.status_code, 500)
         self.assertEqual(res.data, '500 custom handler')
 
+class TestContextLocals(unittest.TestCase):
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def run_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+
+    def test_app_and_request(self):
+        app = Tipfy()
+        request = Request.from_values('/')
+        Tipfy.request = request
+        self.assertEqual(Tipfy.app, app)
+        self.assertEqual(Tipfy.request, request)
+        self.assertEqual(app.app, app)
+        self.assertEqual(app.request, request)
+
+        result = {}
+        def target():
+            # Outside of a request, other threads see the last app.
+            result['app'] = Tipfy.app
+            result['request'] = Tipfy.request
+            Tipfy.app = Tipfy.request = None
+
+        self.run_thread(target)
+        self.assertEqual(result, {'app': app, 'request': None})
+        # Not changed by the other thread.
+        self.assertEqual(Tipfy.app, app)
+        self.assertEqual(Tipfy.request, request)
+
+        Tipfy.app = None
+        self.assertEqual(Tipfy.app, None)
+
+    def test_concurrent_requests(self):
+        second_started = threading.Event()
+        first_done = threading.Event()
+        results = {}
+
+        class MyHandler(RequestHandler):
+            def get(self, **kwargs):
+                name = self.request.args.get('name')
+                if name == 'first':
+                    second_started.wait(5)
+                else:
+                    second_started.set()
+                    first_done.wait(5)
+
+                results[name] = (Tipfy.request.args.get('name'),
+                    url_for('home', name=name), get_config('tipfy', 'foo'))
+                return Response(name)
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=MyHandler)],
+            config={'tipfy': {'foo': 'bar'}})
+
+        def first():
+            app.get_test_client().get('/?name=first')
+            first_done.set()
+
+        def second():
+            app.get_test_client().get('/?name=second')
+
+        threads = [threading.Thread(target=first),
+            threading.Thread(target=second)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {
+            'first': ('first', '/?name=first', 'bar'),
+            'second': ('second', '/?name=second', 'bar'),
+        })
+
+    def test_release_after_request(self):
+        class MyHandler(RequestHandler):
+            def get(self, **kwargs):
+                return Response(str(Tipfy.request is self.request))
+
+        app = Tipfy(rules=[Rule('/', name='home', handler=MyHandler)])
+        result = {}
+        def target():
+            response = app.get_test_client().get('/')
+            result['data'] = response.data
+            result['request'] = Tipfy.request
+            result['app'] = Tipfy.app
+
+        self.run_thread(target)
+        self.assertEqual(result, {'data': 'True', 'request': None,
+            'app': app})
+
+
+WARMUP_HANDLERS = """
+from tipfy import RequestHandler, Response
+
+class HomeHandler(RequestHandler):
+    plugins = ['warmup_plugins.Plugin', 'warmup_plugins.MissingPlugin']
+
+    def get(self, **kwargs):
+        return Response('home')
+"""
+
+WARMUP_PLUGINS = """
+loaded = []
+
+class Plugin(object):
+    def __init__(self):
+        loaded.append(self)
+"""
+
+
+class SlowHandler(RequestHandler):
+    def get(self, **kwargs):
+        # Simulates a backend call.
+        time.sleep(0.3)
+        return Response(Tipfy.request.args.get('n'))
+
+
+class TestServe(unittest.TestCase):
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def test_concurrent_requests(self):
+        app = Tipfy(rules=[Rule('/', name='slow', handler=SlowHandler)])
+        server = app.make_server(port=0)
+        url = 'http://127.0.0.1:%d/?n=%%d' % server.server_port
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+        results = {}
+        def target(n):
+            results[n] = urllib2.urlopen(url % n).read()
+
+        threads = [threading.Thread(target=target, args=(n,)) for n in
+            range(4)]
+        start = time.time()
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        elapsed = time.time() - start
+        server.shutdown()
+        server.server_close()
+
+        # Each request sees its own request object.
+        self.assertEqual(results, {0: '0', 1: '1', 2: '2', 3: '3'})
+        # Requests waited at the same time.
+        self.assertTrue(elapsed < 1.0, elapsed)
+
+
+coalesce_calls = []
+
+
+class CoalesceHandler(RequestHandler):
+    def get(self, **kwargs):
+        coalesce_calls.append(self.request.url)
+        time.sleep(0.3)
+        if self.request.args.get('fail'):
+            raise ValueError('booo!')
+
+        response = Response('page %d' % len(coalesce_calls))
+        if self.request.args.get('cookie'):
+            response.set_cookie('foo', 'bar')
+
+        return response
+
+
+class CoalesceErrorHandler(CoalesceHandler):
+    def handle_exception(self, exception=None, debug=False):
+        return Response('error %d' % len(coalesce_calls), status=500)
+
+
+class TestCoalesce(unittest.TestCase):
+    def setUp(self):
+        del coalesce_calls[:]
+
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def get_results(self, app, path, count=4):
+        server = app.make_server(port=0)
+        url = 'http://127.0.0.1:%d%s' % (server.server_port, path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+        results = []
+        def target():
+            try:
+                results.append(urllib2.urlopen(url).read())
+            except urllib2.HTTPError, e:
+                results.append(e.code)
+
+        threads = [threading.Thread(target=target) for n in range(count)]
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        server.shutdown()
+        server.server_close()
+        return results
+
+    def get_app(self, **config):
+        config['coalesce_requests'] = True
+        return Tipfy(rules=[
+            Rule('/', name='home', handler=CoalesceHandler),
+            Rule('/error', name='error', handler=CoalesceErrorHandler),
+        ], config={'tipfy': config})
+
+    def test_coalesce(self):
+        results = self.get_results(self.get_app(), '/')
+        self.assertEqual(results, ['page 1'] * 4)
+        self.assertEqual(len(coalesce_calls), 1)
+
+    def test_disabled(self):
+        app = Tipfy(rules=[Rule('/', name='home', handler=CoalesceHandler)])
+        self.get_results(app, '/')
+        self.assertEqual(len(coalesce_calls), 4)
+
+    def test_uncoalesced_responses(self):
+        app = self.get_app()
+        results = self.get_results(app, '/?fail=1')
+        self.assertEqual(results, [500] * 4)
+        self.assertEqual(len(coalesce_calls), 4)
+
+        del coalesce_calls[:]
+        self.get_results(app, '/?cookie=1')
+        self.assertEqual(len(coalesce_calls), 4)
+        self.assertEqual(app.router.flights, {})
+
+    def test_error_responses(self):
+        # Error responses built by handle_exception() are not shared.
+        results = self.get_results(self.get_app(), '/error?fail=1')
+        self.assertEqual(results, [500] * 4)
+        self.assertEqual(len(coalesce_calls), 4)
+
+    def test_coalesce_key(self):
+        app = self.get_app(coalesce_key=lambda request: None)
+        self.get_results(app, '/')
+        self.assertEqual(len(coalesce_calls), 4)
+
+    def test_timeout(self):
+        app = self.get_app(coalesce_timeout=0.05)
+        self.get_results(app, '/')
+        self.assertEqual(len(coalesce_calls), 4)
+
+
+class TestWarmup(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name, source in (('warmup_handlers', WARMUP_HANDLERS),
+            ('warmup_plugins', WARMUP_PLUGINS)):
+            f = open(os.path.join(self.path, name + '.py'), 'w')
+            f.write(source)
+            f.close()
+
+        sys.path.insert(0, self.path)
+
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+        sys.path.remove(self.path)
+        for name in ('warmup_handlers', 'warmup_plugins'):
+            sys.modules.pop(name, None)
+
+        shutil.rmtree(self.path)
+
+    def get_app(self):
+        return Tipfy(rules=[
+            Rule('/', name='home', handler='warmup_handlers.HomeHandler'),
+            Rule('/other', name='other', handler='warmup_handlers:HomeHandler'),
+            Rule('/broken', name='broken', handler='warmup_missing.Handler'),
+            Rule('/_ah/warmup', name='warmup', handler=WarmupHandler),
+        ])
+
+    def test_warmup(self):
+        app = self.get_app()
+        timings = app.warmup()
+
+        self.assertEqual(sorted(module for module, seconds in timings),
+            ['warmup_handlers', 'warmup_plugins'])
+        self.assertEqual(timings, sorted(timings, key=lambda t: t[1],
+            reverse=True))
+
+        import warmup_handlers, warmup_plugins
+        rules = dict((rule.endpoint, rule) for rule in app.router.map._rules)
+        self.assertEqual(app.router.rule_handlers, {
+            rules['home']: warmup_handlers.HomeHandler,
+            rules['other']: warmup_handlers.HomeHandler,
+            rules['warmup']: WarmupHandler,
+        })
+        self.assertEqual(len(warmup_plugins.loaded), 1)
+        assert app.router.static_rules is not None
+
+        # Nothing else to import.
+        self.assertEqual(app.warmup(), [])
+        self.assertEqual(len(warmup_plugins.loaded), 1)
+
+        client = app.get_test_client()
+        self.assertEqual(client.get('/').data, 'home')
+        self.assertEqual(len(warmup_plugins.loaded), 1)
+
+    def test_warmup_handler(self):
+        app = self.get_app()
+        response = app.get_test_client().get('/_ah/warmup')
+        self.assertEqual(response.status_code, 200)
+        # Module names are not exposed.
+        self.assertEqual(response.data, '')
+        assert 'warmup_handlers' in sys.modules
+
+
 class SillyTests(unittest.TestCase):
     def tearDown(self):
         Tipfy.app = Tipfy.request = None
@@ -259,3 +582,79 @@ class SillyTests(unittest.TestCase):
         fix_sys_path()
 
         sys.path = path
+
+
+class CpuHandler(RequestHandler):
+    @run_in_process
+    def get(self, **kwargs):
+        if kwargs['n'] == 0:
+            self.abort(404)
+        elif kwargs['n'] == 1:
+            time.sleep(2)
+
+        return Response('%d %s %s' % (os.getpid(), self.request.args['q'],
+            Tipfy.app.config.get('test', 'value')), status=201,
+            headers=[('X-Custom', 'custom')])
+
+    @run_in_process
+    def post(self, **kwargs):
+        return Response(self.request.data.upper())
+
+
+class TestProcessPool(unittest.TestCase):
+    def setUp(self):
+        self.app = Tipfy(rules=[
+            Rule('/cpu/<int:n>', name='cpu', handler=CpuHandler),
+        ], config={
+            'tipfy': {'process_pool_size': 1, 'process_pool_timeout': 0.5},
+            'test': {'value': 'from-config'},
+        })
+
+    def tearDown(self):
+        pool = self.app.registry.get('process_pool')
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+        Tipfy.app = Tipfy.request = None
+
+    def test_run_in_process(self):
+        client = self.app.get_test_client()
+        response = client.get('/cpu/2?q=foo')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.headers['X-Custom'], 'custom')
+
+        pid, q, value = response.data.split()
+        self.assertNotEqual(int(pid), os.getpid())
+        self.assertEqual(q, 'foo')
+        self.assertEqual(value, 'from-config')
+
+        # The pool is forked only once.
+        response = client.get('/cpu/2?q=bar')
+        self.assertEqual(response.data.split()[0], pid)
+
+    def test_run_in_process_body(self):
+        client = self.app.get_test_client()
+        response = client.post('/cpu/2', data='hello')
+        self.assertEqual(response.data, 'HELLO')
+
+    def test_run_in_process_abort(self):
+        client = self.app.get_test_client()
+        response = client.get('/cpu/0?q=foo')
+        self.assertEqual(response.status_code, 404)
+
+    def test_close_process_pool(self):
+        pool = self.app.get_process_pool()
+        self.app.close_process_pool()
+        assert 'process_pool' not in self.app.registry
+        # A closed pool doesn't accept new tasks.
+        self.assertRaises((AssertionError, ValueError), pool.apply_async,
+            os.getpid)
+
+        # Closing again does nothing.
+        self.app.close_process_pool()
+
+    def test_run_in_process_timeout(self):
+        client = self.app.get_test_client()
+        response = client.get('/cpu/1?q=foo')
+        self.assertEqual(response.status_code, 503)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.ext.compress
+"""
+import gzip
+import unittest
+import zlib
+from cStringIO import StringIO
+
+from tipfy import RequestHandler, Response, Rule, Tipfy
+from tipfy.ext.compress import compress, compress_iter, get_encoding
+
+
+text = 'Hello, World! ' * 100
+closed = []
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+class TextHandler(RequestHandler):
+    def get(self, **kwargs):
+        response = Response(text)
+        if self.request.args.get('etag'):
+            response.headers['ETag'] = '"%s"' % self.request.args['etag']
+
+        return response
+
+
+class OtherTextHandler(RequestHandler):
+    def get(self, **kwargs):
+        response = Response('Bye, World! ' * 100)
+        response.headers['ETag'] = '"%s"' % self.request.args['etag']
+        return response
+
+
+class SmallHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response('Hello, World!')
+
+
+class ImageHandler(RequestHandler):
+    def get(self, **kwargs):
+        return Response(text, mimetype='image/png')
+
+
+class StreamHandler(RequestHandler):
+    def get(self, **kwargs):
+        def generate():
+            try:
+                for i in range(100):
+                    yield u'Hello, World! '
+            finally:
+                closed.append(True)
+
+        return Response(generate(), mimetype='text/plain')
+
+
+class TestCompress(unittest.TestCase):
+    def setUp(self):
+        del closed[:]
+
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def get_app(self, **config):
+        return Tipfy(rules=[
+            Rule('/', name='text', handler=TextHandler),
+            Rule('/other', name='other', handler=OtherTextHandler),
+            Rule('/small', name='small', handler=SmallHandler),
+            Rule('/image', name='image', handler=ImageHandler),
+            Rule('/stream', name='stream', handler=StreamHandler),
+        ], config={
+            'tipfy': {
+                'middleware': ['tipfy.ext.compress.CompressMiddleware'],
+            },
+            'tipfy.ext.compress': config,
+        })
+
+    def test_gzip(self):
+        client = self.get_app().get_test_client()
+        response = client.get('/', headers=[('Accept-Encoding',
+            'gzip, deflate')])
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(int(response.headers['Content-Length']),
+            len(response.data))
+        self.assertTrue(len(response.data) < len(text))
+        self.assertEqual(gunzip(response.data), text)
+
+    def test_deflate(self):
+        client = self.get_app().get_test_client()
+        response = client.get('/', headers=[('Accept-Encoding',
+            'gzip;q=0.5, deflate')])
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.data), text)
+
+    def test_not_accepted(self):
+        client = self.get_app().get_test_client()
+        response = client.get('/')
+        self.assertFalse('Content-Encoding' in response.headers)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.data, text)
+
+    def test_min_size_and_mimetypes(self):
+        client = self.get_app().get_test_client()
+        headers = [('Accept-Encoding', 'gzip')]
+        response = client.get('/small', headers=headers)
+        self.assertFalse('Content-Encoding' in response.headers)
+        self.assertEqual(response.data, 'Hello, World!')
+
+        response = client.get('/image', headers=headers)
+        self.assertFalse('Content-Encoding' in response.headers)
+        self.assertFalse('Vary' in response.headers)
+
+    def test_streamed(self):
+        client = self.get_app().get_test_client()
+        response = client.get('/stream', headers=[('Accept-Encoding',
+            'gzip')])
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertFalse('Content-Length' in response.headers)
+        self.assertEqual(gunzip(response.data), text)
+        self.assertEqual(closed, [True])
+
+    def test_cache(self):
+        app = self.get_app()
+        client = app.get_test_client()
+        middleware = app.middleware_factory.instances[
+            'tipfy.ext.compress.CompressMiddleware']
+        headers = [('Accept-Encoding', 'gzip')]
+
+        response = client.get('/?etag=foo', headers=headers)
+        self.assertEqual(response.headers['ETag'].lower(), 'w/"foo"')
+        self.assertEqual(len(middleware.cache), 1)
+        self.assertEqual(middleware.cache.get(('localhost', '', '/',
+            'etag=foo', 'foo', 'gzip')), response.data)
+
+        response = client.get('/?etag=foo', headers=headers)
+        self.assertEqual(gunzip(response.data), text)
+        self.assertEqual(len(middleware.cache), 1)
+
+        # Responses without a strong ETag are not cached.
+        client.get('/', headers=headers)
+        self.assertEqual(len(middleware.cache), 1)
+
+        # ETags are only unique for a URL.
+        response = client.get('/other?etag=foo', headers=headers)
+        self.assertEqual(gunzip(response.data), 'Bye, World! ' * 100)
+        self.assertEqual(len(middleware.cache), 2)
+
+    def test_get_encoding(self):
+        from tipfy import Request
+        def get(value):
+            return get_encoding(Request.from_values('/',
+                headers=[('Accept-Encoding', value)]))
+
+        self.assertEqual(get('gzip, deflate'), 'gzip')
+        self.assertEqual(get('deflate'), 'deflate')
+        self.assertEqual(get('gzip;q=0, deflate'), 'deflate')
+        self.assertEqual(get('*'), 'gzip')
+        self.assertEqual(get('identity'), None)
+
+    def test_compress_iter(self):
+        chunks = ['a' * 10, 'b' * 10, 'c' * 10]
+        self.assertEqual(gunzip(''.join(compress_iter(iter(chunks),
+            'gzip'))), gunzip(compress(chunks, 'gzip')))
+
+        # Each chunk can be decompressed as soon as it is received.
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        result = compress_iter(iter(chunks), 'gzip')
+        for chunk in chunks:
+            self.assertEqual(decompressor.decompress(result.next()), chunk)
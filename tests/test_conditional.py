@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.ext.conditional
+"""
+import datetime
+import hashlib
+import unittest
+
+from werkzeug import http_date
+
+from tipfy import RequestHandler, Response, Rule, Tipfy
+from tipfy.ext.conditional import make_not_modified
+
+
+calls = []
+closed = []
+updated = datetime.datetime(2010, 9, 1, 12, 30, 15, 123)
+
+
+class PageHandler(RequestHandler):
+    def get(self, **kwargs):
+        calls.append('get')
+        return Response('Hello, World!')
+
+    def post(self, **kwargs):
+        return Response('Posted!')
+
+
+class StreamHandler(RequestHandler):
+    def get(self, **kwargs):
+        def generate():
+            try:
+                yield 'Hello, '
+                yield u'World!'
+            finally:
+                closed.append(True)
+
+        return Response(generate())
+
+
+class ValidatorsHandler(RequestHandler):
+    plugins = ['tipfy.ext.conditional.ConditionalMiddleware']
+
+    def get_validators(self, **kwargs):
+        calls.append('validators')
+        return 'v%s' % kwargs['version'], updated
+
+    def get(self, **kwargs):
+        calls.append('get')
+        return Response('Version %s' % kwargs['version'])
+
+
+class TestConditional(unittest.TestCase):
+    def setUp(self):
+        del calls[:]
+        del closed[:]
+
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def get_client(self, **config):
+        return Tipfy(rules=[
+            Rule('/', name='home', handler=PageHandler),
+            Rule('/stream', name='stream', handler=StreamHandler),
+            Rule('/versions/<version>', name='versions',
+                handler=ValidatorsHandler),
+        ], config={
+            'tipfy': {
+                'middleware': ['tipfy.ext.conditional.ConditionalMiddleware'],
+            },
+            'tipfy.ext.conditional': config,
+        }).get_test_client()
+
+    def test_etag(self):
+        client = self.get_client()
+        response = client.get('/')
+        etag = '"%s"' % hashlib.md5('Hello, World!').hexdigest()
+        self.assertEqual(response.headers['ETag'], etag)
+
+        response = client.get('/', headers=[('If-None-Match', etag)])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.headers['ETag'], etag)
+
+        response = client.get('/', headers=[('If-None-Match', '"other"')])
+        self.assertEqual(response.status_code, 200)
+        response = client.get('/', headers=[('If-None-Match', '*')])
+        self.assertEqual(response.status_code, 304)
+
+    def test_weak_etag(self):
+        client = self.get_client(weak=True)
+        response = client.get('/')
+        etag = response.headers['ETag']
+        self.assertTrue(etag.lower().startswith('w/'))
+
+        response = client.get('/', headers=[('If-None-Match', etag)])
+        self.assertEqual(response.status_code, 304)
+
+    def test_post(self):
+        client = self.get_client()
+        response = client.post('/')
+        self.assertFalse('ETag' in response.headers)
+
+    def test_streamed(self):
+        client = self.get_client()
+        response = client.get('/stream')
+        self.assertEqual(response.data, 'Hello, World!')
+        self.assertEqual(response.headers['ETag'],
+            '"%s"' % hashlib.md5('Hello, World!').hexdigest())
+        self.assertEqual(closed, [True])
+
+        response = client.get('/stream', headers=[('If-None-Match',
+            response.headers['ETag'])])
+        self.assertEqual(response.status_code, 304)
+
+    def test_streamed_disabled(self):
+        client = self.get_client(streamed=False)
+        response = client.get('/stream')
+        self.assertEqual(response.data, 'Hello, World!')
+        self.assertFalse('ETag' in response.headers)
+
+    def test_validators(self):
+        client = self.get_client()
+        response = client.get('/versions/1')
+        self.assertEqual(response.data, 'Version 1')
+        self.assertEqual(response.headers['ETag'], '"v1"')
+        self.assertEqual(response.headers['Last-Modified'],
+            'Wed, 01 Sep 2010 12:30:15 GMT')
+        self.assertEqual(calls, ['validators', 'get'])
+
+        del calls[:]
+        response = client.get('/versions/1', headers=[('If-None-Match',
+            '"v1"')])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], '"v1"')
+        self.assertEqual(calls, ['validators'])
+
+        del calls[:]
+        response = client.get('/versions/2', headers=[('If-None-Match',
+            '"v1"')])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(calls, ['validators', 'get'])
+
+    def test_if_modified_since(self):
+        client = self.get_client()
+        response = client.get('/versions/1', headers=[('If-Modified-Since',
+            http_date(updated))])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(calls, ['validators'])
+
+        del calls[:]
+        earlier = updated - datetime.timedelta(seconds=1)
+        response = client.get('/versions/1', headers=[('If-Modified-Since',
+            http_date(earlier))])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(calls, ['validators', 'get'])
+
+    def test_make_not_modified(self):
+        response = Response('Hello, World!')
+        response.headers['ETag'] = '"foo"'
+        make_not_modified(response)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.response, [])
+        self.assertEqual(response.headers['ETag'], '"foo"')
+        self.assertFalse('Content-Type' in response.headers)
@@ -1,7 +1,7 @@
 import unittest
 
 from tipfy import (Request, RequestHandler, Response, Rule, Tipfy,
-    ALLOWED_METHODS)
+    ALLOWED_METHODS, get_valid_methods)
 
 
 class TestHandler(unittest.TestCase):
@@ -36,6 +36,78 @@ class TestHandler(unittest.TestCase):
             response = client.open('/', method=method)
             self.assertEqual(response.status_code, 405)
 
+    def test_405_allow_header(self):
+        class HomeHandler(RequestHandler):
+            def get(self, **kwargs):
+                return Response('Home sweet home!')
+
+            def post(self, **kwargs):
+                return Response('Posted!')
+
+        app = Tipfy(rules=[
+            Rule('/', endpoint='home', handler=HomeHandler),
+        ])
+
+        client = app.get_test_client()
+        response = client.put('/')
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response.headers['Allow'], 'GET, OPTIONS, POST')
+
+    def test_automatic_options(self):
+        class HomeHandler(RequestHandler):
+            def get(self, **kwargs):
+                return Response('Home sweet home!')
+
+            def delete(self, **kwargs):
+                return Response('Deleted!')
+
+        class OptionsHandler(RequestHandler):
+            def get(self, **kwargs):
+                return Response('Home sweet home!')
+
+            def options(self, **kwargs):
+                return Response('Custom options!')
+
+        app = Tipfy(rules=[
+            Rule('/', endpoint='home', handler=HomeHandler),
+            Rule('/options', endpoint='options', handler=OptionsHandler),
+        ])
+
+        client = app.get_test_client()
+        response = client.open('/', method='OPTIONS')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.headers['Allow'], 'DELETE, GET, OPTIONS')
+
+        response = client.open('/options', method='OPTIONS')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, 'Custom options!')
+
+    def test_method_table(self):
+        class BaseHandler(RequestHandler):
+            def get(self, **kwargs):
+                return Response('Base')
+
+        class ChildHandler(BaseHandler):
+            def post(self, **kwargs):
+                return Response('Child')
+
+        methods, valid_methods, allow = BaseHandler.get_method_table()
+        self.assertEqual(sorted(methods.keys()), ['get', 'options'])
+        self.assertEqual(valid_methods, ['GET', 'OPTIONS'])
+        self.assertEqual(allow, 'GET, OPTIONS')
+
+        # The table is computed once per class, not inherited.
+        self.assertTrue(BaseHandler.get_method_table() is
+            BaseHandler.get_method_table())
+        methods, valid_methods, allow = ChildHandler.get_method_table()
+        self.assertEqual(valid_methods, ['GET', 'OPTIONS', 'POST'])
+
+        request = Request.from_values('/')
+        handler = ChildHandler(Tipfy(), request)
+        self.assertEqual(get_valid_methods(handler), ['GET', 'OPTIONS',
+            'POST'])
+
     def test_abort(self):
         class HandlerWith400(RequestHandler):
             def get(self, **kwargs):
@@ -1,6 +1,7 @@
 import unittest
 
-from tipfy import MiddlewareFactory, Tipfy
+from tipfy import (MiddlewareFactory, RequestHandler, Response, Rule, Router,
+    Tipfy)
 
 
 class SomeObject(object):
@@ -236,3 +237,195 @@ class TestMiddlewareFactory(unittest.TestCase):
         assert middleware['post_dispatch'][0] == factory.instances[__name__ + '.Middleware_5'].post_dispatch
         assert middleware['post_dispatch'][1] == factory.instances[__name__ + '.Middleware_4'].post_dispatch
         assert middleware['post_dispatch'][2] == factory.instances[__name__ + '.Middleware_3'].post_dispatch
+
+
+class Plugin_1(object):
+    def pre_dispatch(self, handler):
+        handler.calls.append('pre_1')
+        if handler.request.args.get('stop'):
+            return Response('Stopped!')
+
+    def post_dispatch(self, handler, response):
+        handler.calls.append('post_1')
+        return response
+
+
+class Plugin_2(object):
+    def pre_dispatch(self, handler):
+        handler.calls.append('pre_2')
+
+    def post_dispatch(self, handler, response):
+        handler.calls.append('post_2')
+        response.data += ' Wrapped.'
+        return response
+
+
+class Plugin_3(object):
+    def post_dispatch(self, handler, response):
+        handler.calls.append('post_3')
+        return response
+
+
+calls = []
+
+
+class PluginsHandler(RequestHandler):
+    plugins = [Plugin_1, Plugin_2]
+
+    def __init__(self, app, request):
+        super(PluginsHandler, self).__init__(app, request)
+        self.calls = calls
+
+    def get(self, **kwargs):
+        self.calls.append('get')
+        return Response('Hello!')
+
+
+class PostOnlyHandler(PluginsHandler):
+    plugins = [Plugin_3]
+
+
+class TestHandlerChain(unittest.TestCase):
+    def setUp(self):
+        del calls[:]
+
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def get_app(self):
+        return Tipfy(rules=[
+            Rule('/', endpoint='home', handler=PluginsHandler),
+            Rule('/post-only', endpoint='post-only', handler=PostOnlyHandler),
+        ])
+
+    def test_chain(self):
+        app = self.get_app()
+        client = app.get_test_client()
+
+        response = client.get('/')
+        self.assertEqual(response.data, 'Hello! Wrapped.')
+        self.assertEqual(calls, ['pre_1', 'pre_2', 'get', 'post_2',
+            'post_1'])
+
+    def test_chain_stopped_by_pre_dispatch(self):
+        app = self.get_app()
+        client = app.get_test_client()
+
+        response = client.get('/?stop=1')
+        self.assertEqual(response.data, 'Stopped! Wrapped.')
+        self.assertEqual(calls, ['pre_1', 'post_2', 'post_1'])
+
+    def test_chain_post_dispatch_only(self):
+        app = self.get_app()
+        client = app.get_test_client()
+
+        response = client.get('/post-only')
+        self.assertEqual(response.data, 'Hello!')
+        self.assertEqual(calls, ['get', 'post_3'])
+
+    def test_chain_compiled_once(self):
+        app = self.get_app()
+        client = app.get_test_client()
+        factory = app.middleware_factory
+
+        client.get('/')
+        chain = factory.handler_chains[PluginsHandler]
+        client.get('/')
+        client.get('/post-only')
+
+        self.assertEqual(len(factory.handler_chains), 2)
+        self.assertTrue(factory.handler_chains[PluginsHandler] is chain)
+
+
+class AppMiddleware_1(object):
+    def pre_dispatch_handler(self):
+        calls.append('pre_1')
+        if Tipfy.request.args.get('stop'):
+            return Response('Stopped!')
+
+    def post_dispatch_handler(self, response):
+        calls.append('post_1')
+        return response
+
+
+class AppMiddleware_2(object):
+    def post_dispatch_handler(self, response):
+        calls.append('post_2')
+        response.data += ' Wrapped.'
+        return response
+
+
+class HomeHandler(RequestHandler):
+    def get(self, **kwargs):
+        calls.append('get')
+        return Response('Hello!')
+
+
+class TestAppPipeline(unittest.TestCase):
+    def setUp(self):
+        del calls[:]
+
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def get_app(self, middleware):
+        return Tipfy(rules=[
+            Rule('/', endpoint='home', handler=HomeHandler),
+        ], config={'tipfy': {'middleware': middleware}})
+
+    def test_pipeline(self):
+        app = self.get_app([AppMiddleware_1, AppMiddleware_2])
+        client = app.get_test_client()
+
+        response = client.get('/')
+        self.assertEqual(response.data, 'Hello! Wrapped.')
+        self.assertEqual(calls, ['pre_1', 'get', 'post_2', 'post_1'])
+
+    def test_pipeline_stopped_by_pre_dispatch_handler(self):
+        app = self.get_app([AppMiddleware_1, AppMiddleware_2])
+        client = app.get_test_client()
+
+        response = client.get('/?stop=1')
+        self.assertEqual(response.data, 'Stopped! Wrapped.')
+        self.assertEqual(calls, ['pre_1', 'post_2', 'post_1'])
+
+    def test_pipeline_without_middleware(self):
+        app = self.get_app([])
+        client = app.get_test_client()
+
+        response = client.get('/')
+        self.assertEqual(response.data, 'Hello!')
+        self.assertEqual(calls, ['get'])
+
+    def test_router_dispatch_with_hooks(self):
+        class CustomRouter(Router):
+            def dispatch_with_hooks(self, app, request, match):
+                calls.append('dispatch_with_hooks')
+                return super(CustomRouter, self).dispatch_with_hooks(app,
+                    request, match)
+
+        class CustomApp(Tipfy):
+            router_class = CustomRouter
+
+        app = CustomApp(rules=[
+            Rule('/', endpoint='home', handler=HomeHandler),
+        ], config={'tipfy': {'middleware': [AppMiddleware_2]}})
+        response = app.get_test_client().get('/')
+        self.assertEqual(response.data, 'Hello! Wrapped.')
+        self.assertEqual(calls, ['dispatch_with_hooks', 'get', 'post_2'])
+
+    def test_compile_app_pipeline(self):
+        factory = MiddlewareFactory()
+        middleware = factory.load_middleware([AppMiddleware_2])
+        pipeline = factory.compile_app_pipeline(middleware)
+
+        class Router(object):
+            def dispatch(self, app, request, match):
+                return Response('Dispatched %s' % match)
+
+        class App(object):
+            router = Router()
+
+        response = pipeline(App(), None, 'foo')
+        self.assertEqual(response.data, 'Dispatched foo Wrapped.')
+        self.assertEqual(calls, ['post_2'])
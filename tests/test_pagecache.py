@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.ext.pagecache
+"""
+import time
+import unittest
+
+from tipfy import RequestHandler, Response, Rule, Tipfy
+from tipfy.ext.pagecache import (MemcacheBackend, MemoryBackend,
+    PageCacheMiddleware)
+
+
+calls = []
+
+
+class PageHandler(RequestHandler):
+    def get(self, **kwargs):
+        calls.append(self.request.url)
+        response = Response('page %d %s' % (len(calls),
+            self.request.headers.get('Accept-Language', '')))
+        if self.request.args.get('cookie'):
+            response.set_cookie('foo', 'bar')
+        if self.request.args.get('private'):
+            response.headers['Cache-Control'] = 'private'
+        if self.request.args.get('missing'):
+            response.status_code = 404
+        if self.request.args.get('vary'):
+            response.headers['Vary'] = self.request.args['vary']
+        if self.request.args.get('big'):
+            response.data = response.data * 100
+
+        return response
+
+    head = get
+
+    def post(self, **kwargs):
+        calls.append(self.request.url)
+        return Response('post %d' % len(calls))
+
+
+class FakeMemcache(object):
+    """A stand-in for a memcache client."""
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, time=0):
+        self.data[key] = value
+        return True
+
+
+class TestPageCache(unittest.TestCase):
+    def setUp(self):
+        del calls[:]
+
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def get_app(self, middleware=None, **config):
+        return Tipfy(rules=[
+            Rule('/', name='home', handler=PageHandler),
+            Rule('/nocache', name='nocache', handler=PageHandler),
+            Rule('/short', name='short', handler=PageHandler),
+        ], config={
+            'tipfy': {
+                'middleware': middleware or [
+                    'tipfy.ext.pagecache.PageCacheMiddleware'],
+            },
+            'tipfy.ext.pagecache': config,
+        })
+
+    def test_cache_hit(self):
+        client = self.get_app().get_test_client()
+
+        response = client.get('/')
+        self.assertEqual(response.data, 'page 1 ')
+        response = client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, 'page 1 ')
+        self.assertEqual(response.headers['Content-Type'],
+            'text/html; charset=utf-8')
+        self.assertEqual(len(calls), 1)
+
+        response = client.head('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 1)
+
+        response = client.get('/?page=2')
+        self.assertEqual(response.data, 'page 2 ')
+
+    def test_head_is_not_cached(self):
+        client = self.get_app().get_test_client()
+        client.head('/')
+        client.get('/')
+        self.assertEqual(len(calls), 2)
+
+    def test_post_is_not_cached(self):
+        client = self.get_app().get_test_client()
+        client.post('/')
+        response = client.post('/')
+        self.assertEqual(response.data, 'post 2')
+
+    def test_vary(self):
+        client = self.get_app(vary=['Accept-Language']).get_test_client()
+
+        response = client.get('/', headers=[('Accept-Language', 'en')])
+        self.assertEqual(response.data, 'page 1 en')
+        response = client.get('/', headers=[('Accept-Language', 'pt')])
+        self.assertEqual(response.data, 'page 2 pt')
+        response = client.get('/', headers=[('Accept-Language', 'en')])
+        self.assertEqual(response.data, 'page 1 en')
+
+    def test_response_vary(self):
+        client = self.get_app().get_test_client()
+
+        response = client.get('/?vary=Accept-Language',
+            headers=[('Accept-Language', 'en')])
+        self.assertEqual(response.data, 'page 1 en')
+        response = client.get('/?vary=Accept-Language',
+            headers=[('Accept-Language', 'pt')])
+        self.assertEqual(response.data, 'page 2 pt')
+        response = client.get('/?vary=Accept-Language',
+            headers=[('Accept-Language', 'en')])
+        self.assertEqual(response.data, 'page 1 en')
+
+        client.get('/?vary=*')
+        client.get('/?vary=*')
+        self.assertEqual(len(calls), 4)
+
+    def test_with_compress(self):
+        client = self.get_app(middleware=[
+            'tipfy.ext.pagecache.PageCacheMiddleware',
+            'tipfy.ext.compress.CompressMiddleware',
+        ]).get_test_client()
+
+        response = client.get('/?big=1', headers=[('Accept-Encoding', 'gzip')])
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+        response = client.get('/?big=1')
+        self.assertEqual(response.data, 'page 2 ' * 100)
+        assert 'Content-Encoding' not in response.headers
+
+        response = client.get('/?big=1', headers=[('Accept-Encoding', 'gzip')])
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        response = client.get('/?big=1')
+        self.assertEqual(response.data, 'page 2 ' * 100)
+        self.assertEqual(len(calls), 2)
+
+    def test_url_scheme(self):
+        client = self.get_app().get_test_client()
+        client.get('/')
+        response = client.get('/', base_url='https://localhost/')
+        self.assertEqual(response.data, 'page 2 ')
+
+    def test_rule_ttls(self):
+        client = self.get_app(rule_ttls={'nocache': 0,
+            'short': 0.05}).get_test_client()
+
+        client.get('/nocache')
+        client.get('/nocache')
+        self.assertEqual(len(calls), 2)
+
+        client.get('/short')
+        client.get('/short')
+        self.assertEqual(len(calls), 3)
+        time.sleep(0.06)
+        response = client.get('/short')
+        self.assertEqual(response.data, 'page 4 ')
+
+    def test_uncacheable_responses(self):
+        client = self.get_app().get_test_client()
+        for query in ('cookie=1', 'private=1', 'missing=1'):
+            client.get('/?' + query)
+            client.get('/?' + query)
+
+        self.assertEqual(len(calls), 6)
+
+    def test_personalized_requests(self):
+        client = self.get_app(ignore_cookies=['_ga']).get_test_client()
+
+        # Requests with cookies or credentials don't populate the cache.
+        response = client.get('/', headers=[('Cookie', 'session=foo')])
+        self.assertEqual(response.data, 'page 1 ')
+        response = client.get('/', headers=[('Authorization', 'Basic Zm9v')])
+        self.assertEqual(response.data, 'page 2 ')
+        response = client.get('/')
+        self.assertEqual(response.data, 'page 3 ')
+
+        # Nor are served from it.
+        response = client.get('/', headers=[('Cookie', 'session=foo')])
+        self.assertEqual(response.data, 'page 4 ')
+
+        # Ignored cookies don't change the response.
+        response = client.get('/', headers=[('Cookie', '_ga=bar')])
+        self.assertEqual(response.data, 'page 3 ')
+        response = client.get('/', headers=[('Cookie', '_ga=bar; session=1')])
+        self.assertEqual(response.data, 'page 5 ')
+
+    def test_memory_backend_lru(self):
+        backend = MemoryBackend(2)
+        backend.set('a', 1, 60)
+        backend.set('b', 2, 60)
+        backend.get('a')
+        backend.set('c', 3, 60)
+        self.assertEqual(backend.get('a'), 1)
+        self.assertEqual(backend.get('b'), None)
+        self.assertEqual(backend.get('c'), 3)
+
+    def test_memcache_backend(self):
+        app = self.get_app()
+        memcache = FakeMemcache()
+        middleware = app.middleware_factory.instances[
+            'tipfy.ext.pagecache.PageCacheMiddleware']
+        self.assertTrue(isinstance(middleware, PageCacheMiddleware))
+        middleware.backend = MemcacheBackend(memcache)
+
+        client = app.get_test_client()
+        client.get('/')
+        response = client.get('/')
+        self.assertEqual(response.data, 'page 1 ')
+        # The response and the headers it varies on.
+        self.assertEqual(len(memcache.data), 2)
+        for key in memcache.data:
+            self.assertTrue(key.startswith('tipfy.ext.pagecache:'))
+            self.assertTrue(len(key) < 250)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.ext.ratelimit
+"""
+import time
+import unittest
+
+from tipfy import RequestHandler, Response, Rule, Tipfy
+from tipfy.ext.ratelimit import TokenBucket
+
+
+class PageHandler(RequestHandler):
+    def get(self, **kwargs):
+        delay = self.request.args.get('delay')
+        if delay:
+            time.sleep(float(delay))
+
+        return Response('ok')
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_consume(self):
+        bucket = TokenBucket(2, 3, now=100)
+        self.assertEqual([bucket.consume(100) for i in range(3)], [0, 0, 0])
+        self.assertEqual(bucket.consume(100), 0.5)
+
+        # One token every half second.
+        self.assertEqual(bucket.consume(100.5), 0)
+        self.assertEqual(bucket.consume(100.5), 0.5)
+
+        # Up to the burst.
+        bucket.consume(1000)
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_no_refill(self):
+        bucket = TokenBucket(0, 1, now=100)
+        self.assertEqual(bucket.consume(100), 0)
+        self.assertEqual(bucket.consume(1000), float('inf'))
+        self.assertEqual(TokenBucket(0, 0).consume(), float('inf'))
+        self.assertRaises(ValueError, TokenBucket, -1, 1)
+
+
+class TestRateLimit(unittest.TestCase):
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def get_app(self, **config):
+        return Tipfy(rules=[
+            Rule('/', name='home', handler=PageHandler),
+            Rule('/other', name='other', handler=PageHandler),
+            Rule('/free', name='free', handler=PageHandler),
+        ], config={
+            'tipfy': {
+                'middleware': ['tipfy.ext.ratelimit.RateLimitMiddleware'],
+            },
+            'tipfy.ext.ratelimit': config,
+        })
+
+    def get_middleware(self, app):
+        return app.middleware_factory.instances[
+            'tipfy.ext.ratelimit.RateLimitMiddleware']
+
+    def test_client_limit(self):
+        client = self.get_app(rate=1, burst=2).get_test_client()
+        self.assertEqual(client.get('/').status_code, 200)
+        self.assertEqual(client.get('/other').status_code, 200)
+
+        response = client.get('/')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+        # Other clients have their own bucket.
+        response = client.get('/', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_client_header(self):
+        client = self.get_app(rate=1, burst=1,
+            client_header='X-Forwarded-For').get_test_client()
+        for address in ('1.1.1.1', '2.2.2.2, 10.0.0.1'):
+            response = client.get('/', headers=[('X-Forwarded-For', address)])
+            self.assertEqual(response.status_code, 200)
+
+        response = client.get('/', headers=[('X-Forwarded-For', '1.1.1.1')])
+        self.assertEqual(response.status_code, 429)
+
+    def test_forged_client_header(self):
+        client = self.get_app(rate=1, burst=1,
+            client_header='X-Forwarded-For').get_test_client()
+        response = client.get('/', headers=[('X-Forwarded-For',
+            '6.6.6.6, 1.1.1.1')])
+        self.assertEqual(response.status_code, 200)
+
+        # The client can't change the address added by the proxy.
+        response = client.get('/', headers=[('X-Forwarded-For',
+            '7.7.7.7, 1.1.1.1')])
+        self.assertEqual(response.status_code, 429)
+
+    def test_trusted_proxies(self):
+        app = self.get_app(rate=1, burst=1, client_header='X-Forwarded-For',
+            trusted_proxies=2)
+        client = app.get_test_client()
+        client.get('/', headers=[('X-Forwarded-For',
+            '6.6.6.6, 1.1.1.1, 10.0.0.1')])
+        response = client.get('/', headers=[('X-Forwarded-For',
+            '7.7.7.7, 1.1.1.1, 10.0.0.2')])
+        self.assertEqual(response.status_code, 429)
+
+        # Not enough hops: the remote address is used.
+        client.get('/', headers=[('X-Forwarded-For', '1.1.1.1')],
+            environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(sorted(key[1] for key in
+            self.get_middleware(app).buckets.data), ['1.1.1.1', '10.0.0.1'])
+
+    def test_rule_limit(self):
+        client = self.get_app(rate=1, burst=1, key_by='rule').get_test_client()
+        client.get('/')
+        response = client.get('/', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(client.get('/other').status_code, 200)
+
+    def test_rule_limits(self):
+        client = self.get_app(rate=1, burst=1, rule_limits={
+            'free': (None, None),
+            'other': (1, 3),
+        }).get_test_client()
+        for i in range(5):
+            self.assertEqual(client.get('/free').status_code, 200)
+
+        for i in range(3):
+            self.assertEqual(client.get('/other').status_code, 200)
+
+        self.assertEqual(client.get('/other').status_code, 429)
+        self.assertEqual(client.get('/').status_code, 200)
+
+    def test_blocked_rule(self):
+        client = self.get_app(retry_after=5, rule_limits={
+            'other': (0, 0),
+        }).get_test_client()
+        response = client.get('/other')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        self.assertEqual(client.get('/').status_code, 200)
+
+    def test_max_buckets(self):
+        app = self.get_app(rate=1, burst=1, max_buckets=2)
+        client = app.get_test_client()
+        for address in ('1.1.1.1', '2.2.2.2', '3.3.3.3'):
+            client.get('/', environ_base={'REMOTE_ADDR': address})
+
+        self.assertEqual(len(self.get_middleware(app).buckets), 2)
+
+    def test_invalid_key_by(self):
+        self.assertRaises(ValueError, self.get_app, key_by='foo')
+
+    def test_load_shedding(self):
+        app = self.get_app(rate=None, latency_slo=0.01, retry_after=5)
+        middleware = self.get_middleware(app)
+        client = app.get_test_client()
+
+        self.assertEqual(client.get('/?delay=0.05').status_code, 200)
+        self.assertTrue(middleware.latency > 0.004)
+
+        # Far over the objective: nearly all requests are rejected.
+        middleware.latency = 100.0
+        statuses = [client.get('/').status_code for i in range(20)]
+        self.assertTrue(statuses.count(503) > 15, statuses)
+        response = client.get('/')
+        if response.status_code == 503:
+            self.assertEqual(response.headers['Retry-After'], '5')
+
+        # Fast requests that get through bring the average down.
+        middleware.latency = 0.0
+        statuses = [client.get('/').status_code for i in range(20)]
+        self.assertEqual(statuses, [200] * 20)
@@ -2,11 +2,23 @@
 """
     Tests for tipfy routing
 """
+import cPickle as pickle
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from nose.tools import raises
 
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+from werkzeug.routing import BuildError, Map, RequestRedirect
+
+import tipfy
 from tipfy import (HandlerPrefix, Request, RequestHandler, Response, Rule,
-    Tipfy, url_for)
+    RuleTrie, Subdomain, Submount, Tipfy, UrlBuilder, get_rule_patterns,
+    patterns_overlap, url_for)
 
 
 class HomeHandler(RequestHandler):
@@ -26,6 +38,59 @@ def get_app():
     ])
 
 
+def get_trie_rules():
+    return [
+        Rule('/', endpoint='home', handler=HomeHandler),
+        Rule('/about', endpoint='about', handler=HomeHandler),
+        Rule('/blog/', endpoint='blog', handler=HomeHandler),
+        Rule('/blog/<int:year>/', endpoint='blog-year', handler=HomeHandler),
+        Rule('/blog/<int:year>/<slug>', endpoint='blog-post', handler=HomeHandler),
+        Rule('/blog/archive', endpoint='blog-archive', handler=HomeHandler),
+        Rule('/page/', endpoint='page', defaults={'num': 1}, handler=HomeHandler),
+        Rule('/page/<int:num>', endpoint='page', handler=HomeHandler),
+        Rule('/files/<path:filename>', endpoint='files', handler=HomeHandler),
+        Rule('/files/<path:filename>/edit', endpoint='files-edit', handler=HomeHandler),
+        Rule('/item-<int:id>.html', endpoint='item', handler=HomeHandler),
+        Rule('/<any(en, pt):lang>/help', endpoint='help', handler=HomeHandler),
+        Rule('/re/<regex("[a-z]+/[0-9]+"):key>', endpoint='regex', handler=HomeHandler),
+        Rule('/form', endpoint='form-get', methods=['GET'], handler=HomeHandler),
+        Rule('/form', endpoint='form-post', methods=['POST'], handler=HomeHandler),
+        Rule('/loose', endpoint='loose', strict_slashes=False, handler=HomeHandler),
+        Rule('/old/<int:id>', redirect_to='blog/<id>/', endpoint='old', handler=HomeHandler),
+        Rule('/build', endpoint='build-only', build_only=True, handler=HomeHandler),
+        Rule('/<username>', endpoint='profile', handler=HomeHandler),
+        Submount('/admin', [
+            Rule('/', endpoint='admin', handler=HomeHandler),
+            Rule('/users/<int:id>', endpoint='admin-user', handler=HomeHandler),
+        ]),
+        Subdomain('www', [
+            Rule('/', endpoint='www-home', handler=HomeHandler),
+        ]),
+        Subdomain('<account>', [
+            Rule('/dashboard', endpoint='account', handler=HomeHandler),
+        ]),
+    ]
+
+
+def get_match_result(func, *args):
+    try:
+        rule, rule_args = func(*args)
+        return rule, rule_args
+    except RequestRedirect, e:
+        return RequestRedirect, e.new_url
+    except MethodNotAllowed, e:
+        return MethodNotAllowed, sorted(e.valid_methods)
+    except NotFound, e:
+        return NotFound, None
+
+
+def get_build_result(func, *args):
+    try:
+        return func(*args)
+    except BuildError, e:
+        return BuildError, e.endpoint, e.method
+
+
 def get_request(app, **kwargs):
     request = Request.from_values(**kwargs)
     app.set_request(request)
@@ -128,6 +193,832 @@ class TestUrls(unittest.TestCase):
         assert url_for('home', _full=True, _anchor='my-little-anchor') == 'http://foo.com/#my-little-anchor'
 
 
+class TestRuleTrie(unittest.TestCase):
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def test_same_results_as_map_adapter(self):
+        map = Map(get_trie_rules())
+        trie = RuleTrie(map)
+
+        paths = ['/', '/about', '/about/', '/blog', '/blog/', '/blog/2010',
+            '/blog/2010/', '/blog/2010/hello', '/blog/2010/hello/',
+            '/blog/archive', '/blog/abc/', '/page', '/page/', '/page/1',
+            '/page/2', '/files/a', '/files/a/b/c', '/files/a/b/edit',
+            '/files/', '/item-10.html', '/item-x.html', '/en/help',
+            '/de/help', '/re/abc/123', '/re/abc', '/form', '/loose',
+            '/loose/', '/old/5', '/build', '/calvin', '/calvin/', '//calvin',
+            '/admin', '/admin/', '/admin/users/1', '/admin/users/x',
+            '/dashboard', '/nothing/here', u'/caf\xe9']
+
+        for subdomain in ('', 'www', 'someone'):
+            for method in ('GET', 'POST', 'PUT'):
+                adapter = map.bind('foo.com', subdomain=subdomain,
+                    default_method=method)
+                for path in paths:
+                    expected = get_match_result(adapter.match, path, method,
+                        True)
+                    result = get_match_result(trie.match, adapter, path,
+                        method)
+                    self.assertEqual(result, expected, (subdomain, method,
+                        path))
+
+    def test_get_candidates(self):
+        map = Map(get_trie_rules())
+        trie = RuleTrie(map)
+
+        endpoints = [r.endpoint for r in trie.get_candidates('',
+            u'/blog/2010/hello')]
+        self.assertEqual(endpoints, ['blog-post'])
+
+        endpoints = [r.endpoint for r in trie.get_candidates('',
+            u'/files/a/b/edit')]
+        self.assertEqual(sorted(endpoints), ['files', 'files-edit'])
+
+    def test_router_uses_trie(self):
+        app = Tipfy(rules=get_trie_rules(), config={
+            'tipfy': {'url_trie': True},
+        })
+        client = app.get_test_client()
+
+        response = client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, 'Hello, World!')
+
+        response = client.get('/blog')
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(response.headers['Location'], 'http://localhost/blog/')
+
+        response = client.put('/form')
+        self.assertEqual(response.status_code, 405)
+
+        response = client.get('/nothing/here')
+        self.assertEqual(response.status_code, 404)
+        assert app.router.trie is not None
+
+    def test_router_add_resets_trie(self):
+        app = Tipfy(rules=get_trie_rules(), config={
+            'tipfy': {'url_trie': True},
+        })
+        client = app.get_test_client()
+
+        response = client.get('/new/path')
+        self.assertEqual(response.status_code, 404)
+
+        app.router.add(Rule('/new/path', endpoint='new', handler=HomeHandler))
+        response = client.get('/new/path')
+        self.assertEqual(response.status_code, 200)
+
+
+class TestAdapters(unittest.TestCase):
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def test_get_adapter(self):
+        app = Tipfy(rules=get_trie_rules())
+
+        request = Request.from_values('/about', method='GET')
+        adapter = app.router.get_adapter(request)
+        self.assertEqual(adapter.path_info, '/about')
+        self.assertEqual(adapter.default_method, 'GET')
+        self.assertEqual(len(app.router.adapters), 1)
+
+        request = Request.from_values('/blog/2010/', method='POST')
+        adapter_2 = app.router.get_adapter(request)
+        self.assertEqual(adapter_2.path_info, '/blog/2010/')
+        self.assertEqual(adapter_2.default_method, 'POST')
+        self.assertEqual(len(app.router.adapters), 1)
+        assert adapter is not adapter_2
+
+        request = Request.from_values('/', base_url='https://foo.com/app')
+        adapter_3 = app.router.get_adapter(request)
+        self.assertEqual(adapter_3.server_name, 'foo.com')
+        self.assertEqual(adapter_3.script_name, '/app/')
+        self.assertEqual(adapter_3.url_scheme, 'https')
+        self.assertEqual(len(app.router.adapters), 2)
+
+    def test_get_adapter_with_subdomain(self):
+        app = Tipfy(rules=get_trie_rules(), config={
+            'tipfy': {'server_name': 'foo.com'},
+        })
+        client = app.get_test_client()
+
+        response = client.get('/', base_url='http://www.foo.com')
+        self.assertEqual(response.status_code, 200)
+        response = client.get('/dashboard', base_url='http://calvin.foo.com')
+        self.assertEqual(response.status_code, 200)
+        response = client.get('/dashboard/', base_url='http://calvin.foo.com')
+        self.assertEqual(response.status_code, 404)
+
+        request = Request.from_values('/', base_url='http://calvin.foo.com')
+        self.assertEqual(app.router.get_adapter(request).subdomain, 'calvin')
+        request = Request.from_values('/', base_url='http://foo.com')
+        self.assertEqual(app.router.get_adapter(request).subdomain, '')
+
+    def test_max_adapters(self):
+        app = Tipfy(rules=get_trie_rules())
+        app.router.max_adapters = 2
+
+        for host in ('a.com', 'b.com', 'c.com'):
+            request = Request.from_values('/', base_url='http://' + host)
+            app.router.get_adapter(request)
+
+        self.assertEqual(len(app.router.adapters), 1)
+
+
+class TestMatchCache(unittest.TestCase):
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def get_app(self, size=10):
+        return Tipfy(rules=get_trie_rules(), config={
+            'tipfy': {'match_cache_size': size},
+        })
+
+    def test_cached_match(self):
+        app = self.get_app()
+        cache = app.router.match_cache
+
+        request = Request.from_values('/blog/2010/hello')
+        rule, rule_args = app.router.match(request)
+        self.assertEqual(rule.endpoint, 'blog-post')
+        self.assertEqual(rule_args, {'year': 2010, 'slug': 'hello'})
+        self.assertEqual(len(cache), 1)
+
+        rule_args['year'] = 2011
+        request = Request.from_values('/blog/2010/hello')
+        rule_2, rule_args_2 = app.router.match(request)
+        assert rule_2 is rule
+        self.assertEqual(rule_args_2, {'year': 2010, 'slug': 'hello'})
+        self.assertEqual(len(cache), 1)
+
+        # Static rules are not cached.
+        app.router.match(Request.from_values('/about'))
+        self.assertEqual(len(cache), 1)
+
+        # The cache key includes the method.
+        app.router.match(Request.from_values('/blog/2010/hello',
+            method='POST'))
+        self.assertEqual(len(cache), 2)
+
+    def test_cached_errors(self):
+        app = self.get_app()
+        app.router.add(Rule('/items/<int:id>', endpoint='item-get',
+            methods=['GET'], handler=HomeHandler))
+        app.router.add(Rule('/items/<int:id>', endpoint='item-post',
+            methods=['POST'], handler=HomeHandler))
+        cache = app.router.match_cache
+
+        for i in range(2):
+            request = Request.from_values('/nothing/here')
+            self.assertRaises(NotFound, app.router.match, request)
+            request = Request.from_values('/items/1', method='PUT')
+            self.assertRaises(MethodNotAllowed, app.router.match, request)
+            self.assertEqual(len(cache), 2)
+
+        try:
+            app.router.match(Request.from_values('/items/1', method='PUT'))
+        except MethodNotAllowed, e:
+            self.assertEqual(sorted(e.valid_methods), ['GET', 'HEAD', 'POST'])
+
+        # Redirects are not cached.
+        request = Request.from_values('/blog')
+        self.assertRaises(RequestRedirect, app.router.match, request)
+        self.assertEqual(len(cache), 2)
+
+    def test_eviction(self):
+        app = self.get_app(size=2)
+        for path in ('/calvin', '/hobbes', '/moe'):
+            app.router.match(Request.from_values(path))
+
+        self.assertEqual(len(app.router.match_cache), 2)
+
+    def test_router_add_clears_cache(self):
+        app = self.get_app()
+        client = app.get_test_client()
+
+        response = client.get('/new/path')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(app.router.match_cache), 1)
+
+        app.router.add(Rule('/new/<int:id>', endpoint='new', handler=HomeHandler))
+        self.assertEqual(len(app.router.match_cache), 0)
+        response = client.get('/new/path')
+        self.assertEqual(response.status_code, 404)
+        response = client.get('/new/1')
+        self.assertEqual(response.status_code, 200)
+
+    def test_disabled(self):
+        app = Tipfy(rules=get_trie_rules())
+        self.assertEqual(app.router.match_cache, None)
+
+
+class TestStaticRules(unittest.TestCase):
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def test_static_rules(self):
+        app = Tipfy(rules=get_trie_rules())
+        rules = app.router.get_static_rules()
+
+        self.assertEqual(rules[('', 'GET', u'/')].endpoint, 'home')
+        self.assertEqual(rules[('', 'POST', u'/about')].endpoint, 'about')
+        self.assertEqual(rules[('', 'GET', u'/page/')].endpoint, 'page')
+        self.assertEqual(rules[('', 'GET', u'/form')].endpoint, 'form-get')
+        self.assertEqual(rules[('', 'HEAD', u'/form')].endpoint, 'form-get')
+        self.assertEqual(rules[('', 'POST', u'/form')].endpoint, 'form-post')
+        self.assertEqual(rules[('www', 'GET', u'/')].endpoint, 'www-home')
+        assert ('', 'PUT', u'/form') not in rules
+        assert ('', 'GET', u'/blog') not in rules
+        assert ('', 'GET', u'/build') not in rules
+
+    def test_static_rule_after_dynamic_rule(self):
+        app = Tipfy(rules=[
+            Rule('/a', endpoint='static', handler=HomeHandler),
+            Rule('/a<string(minlength=0):x>', endpoint='dynamic',
+                methods=['PUT'], handler=HomeHandler),
+        ])
+        rules = app.router.get_static_rules()
+        self.assertEqual(rules[('', 'GET', u'/a')].endpoint, 'static')
+        assert ('', 'PUT', u'/a') not in rules
+
+        request = Request.from_values('/a', method='PUT')
+        rule, rule_args = app.router.match(request)
+        self.assertEqual(rule.endpoint, 'dynamic')
+        self.assertEqual(rule_args, {'x': u''})
+
+    def test_static_rule_after_branch_rule(self):
+        app = Tipfy(rules=[
+            Rule('/a/', endpoint='branch', methods=['POST'], handler=HomeHandler),
+            Rule('/a', endpoint='leaf', handler=HomeHandler),
+        ])
+        # The branch rule redirects '/a' to '/a/' for any method.
+        assert ('', 'GET', u'/a') not in app.router.get_static_rules()
+
+        request = Request.from_values('/a', method='GET')
+        self.assertRaises(RequestRedirect, app.router.match, request)
+
+    def test_same_results_as_map_adapter(self):
+        app = Tipfy(rules=get_trie_rules())
+        map = app.router.map
+
+        paths = ['/', '/about', '/about/', '/blog', '/blog/', '/page/',
+            '/page', '/form', '/loose', '/loose/', '/build', '/admin',
+            '/admin/', '/dashboard']
+
+        for method in ('GET', 'HEAD', 'POST', 'PUT'):
+            for path in paths:
+                request = Request.from_values(path, method=method)
+                adapter = map.bind_to_environ(request.environ)
+                expected = get_match_result(adapter.match, None, None, True)
+                result = get_match_result(app.router.match, request)
+                self.assertEqual(result, expected, (method, path))
+
+    def test_router_add_resets_static_rules(self):
+        app = Tipfy(rules=get_trie_rules())
+        assert ('', 'GET', u'/new') not in app.router.get_static_rules()
+
+        app.router.add(Rule('/new', endpoint='new', handler=HomeHandler))
+        assert ('', 'GET', u'/new') in app.router.get_static_rules()
+
+
+class TestUrlBuilder(unittest.TestCase):
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def get_map(self):
+        return Map([
+            Rule('/', endpoint='home'),
+            Rule('/items/<int:id>', endpoint='item'),
+            Rule('/items/<int:id>/<name>', endpoint='item'),
+            Rule('/pages/', endpoint='page', defaults={'number': 1}),
+            Rule('/pages/<int:number>', endpoint='page'),
+            Rule('/edit/<int:id>', endpoint='edit', methods=['POST']),
+            Rule('/show/<int:id>', endpoint='edit', methods=['GET']),
+            Rule('/100%/<name>', endpoint='percent'),
+            Subdomain('<username>', [
+                Rule('/profile', endpoint='profile'),
+            ]),
+        ])
+
+    def test_same_results_as_map_adapter(self):
+        map = self.get_map()
+        values = [
+            {},
+            {'id': 1},
+            {'id': 1, 'name': u'caf\xe9'},
+            {'id': 1, 'name': None},
+            {'id': 1, 'q': 'a b', 'page': [1, 2]},
+            {'number': 1},
+            {'number': 2},
+            {'name': '50%'},
+            {'username': 'calvin'},
+        ]
+        for script_name in ('/', '/app/'):
+            for subdomain in ('', 'calvin'):
+                adapter = map.bind('foo.com', script_name,
+                    subdomain=subdomain)
+                for endpoint in ('home', 'item', 'page', 'edit', 'percent',
+                    'profile', 'missing'):
+                    builder = UrlBuilder(map, endpoint)
+                    for value in values:
+                        for method in (None, 'GET', 'POST'):
+                            for full in (False, True):
+                                args = (dict(value), method, full)
+                                expected = get_build_result(adapter.build,
+                                    endpoint, *args)
+                                result = get_build_result(builder.build,
+                                    adapter, *args)
+                                self.assertEqual(result, expected,
+                                    (endpoint, args))
+
+    def test_build_error(self):
+        map = self.get_map()
+        adapter = map.bind('foo.com', '/')
+        self.assertRaises(BuildError, UrlBuilder(map, 'missing').build,
+            adapter, {})
+        self.assertRaises(BuildError, UrlBuilder(map, 'item').build,
+            adapter, {'name': 'foo'})
+
+    def test_router_builders(self):
+        app = Tipfy(rules=get_trie_rules())
+        request = Request.from_values('/')
+        app.router.match(request)
+
+        builder = app.router.get_builder('home')
+        self.assertEqual(app.router.get_builder('home'), builder)
+        self.assertEqual(app.router.build(request, 'home', {}), '/')
+
+        app.router.add(Rule('/new', endpoint='new', handler=HomeHandler))
+        self.assertEqual(app.router.builders, {})
+        self.assertEqual(app.router.build(request, 'new', {'_full': True}),
+            'http://localhost/new')
+
+    def test_build_many(self):
+        app = Tipfy(rules=[
+            Rule('/', endpoint='home', handler=HomeHandler),
+            Rule('/items/<int:id>', endpoint='item', handler=HomeHandler),
+        ])
+        request = Request.from_values('/')
+        app.router.match(request)
+
+        values = [
+            {'id': 1},
+            {'id': 2, 'q': 'foo'},
+            {'id': 3, '_full': True},
+            {'id': 4, '_anchor': 'top', '_netloc': 'foo.com'},
+        ]
+        urls = app.router.build_many(request, 'item', values)
+        self.assertEqual(list(urls), [
+            app.router.build(request, 'item', dict(value)) for value in values
+        ])
+        # The values are not changed.
+        self.assertEqual(values[2], {'id': 3, '_full': True})
+
+    def test_build_many_error(self):
+        app = Tipfy(rules=[
+            Rule('/items/<int:id>', endpoint='item', handler=HomeHandler),
+        ])
+        request = Request.from_values('/')
+        request.url_adapter = app.router.get_adapter(request)
+
+        urls = app.router.build_many(request, 'item', [{'id': 1}, {}])
+        self.assertEqual(urls.next(), '/items/1')
+        self.assertRaises(BuildError, urls.next)
+
+
+SNAPSHOT_URLS = """
+from tipfy import Rule
+
+def get_rules(app):
+    return [
+        Rule('/', endpoint='home', handler='resources.handlers.HomeHandler'),
+        Rule('/<int:id>', endpoint='item', handler='resources.handlers.HomeHandler'),%s
+    ]
+"""
+
+
+class TestUrlMapSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.path, 'url_map.snapshot')
+        self.write_urls('')
+        sys.path.insert(0, self.path)
+
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+        sys.path.remove(self.path)
+        sys.modules.pop('snapshot_urls', None)
+        shutil.rmtree(self.path)
+
+    def write_urls(self, extra):
+        filename = os.path.join(self.path, 'snapshot_urls.py')
+        f = open(filename, 'w')
+        f.write(SNAPSHOT_URLS % extra)
+        f.close()
+        if os.path.exists(filename + 'c'):
+            os.remove(filename + 'c')
+
+        sys.modules.pop('snapshot_urls', None)
+
+    def get_app(self, **kwargs):
+        kwargs['url_map_snapshot'] = self.snapshot
+        return Tipfy(rules='snapshot_urls.get_rules', config={
+            'tipfy': kwargs,
+        })
+
+    def test_save_and_load(self):
+        app = self.get_app()
+        assert os.path.isfile(self.snapshot)
+
+        app = self.get_app()
+        rules = app.router.map._rules
+        self.assertEqual(sorted(rule.endpoint for rule in rules),
+            ['home', 'item'])
+        self.assertEqual(rules[0].handler, 'resources.handlers.HomeHandler')
+        # Regexes are compiled when the snapshot is loaded.
+        for rule in rules:
+            assert hasattr(rule._regex, 'search')
+
+        request = Request.from_values('/42')
+        rule, rule_args = app.router.match(request)
+        self.assertEqual(rule.endpoint, 'item')
+        self.assertEqual(rule_args, {'id': 42})
+        self.assertEqual(app.router.build(request, 'item', {'id': 1}), '/1')
+
+    def test_source_changed(self):
+        self.get_app()
+        self.write_urls("""
+        Rule('/new', endpoint='new', handler='resources.handlers.HomeHandler'),""")
+
+        app = self.get_app()
+        self.assertEqual(sorted(r.endpoint for r in app.router.map._rules),
+            ['home', 'item', 'new'])
+
+    def test_config_changed(self):
+        rules = 'snapshot_urls.get_rules'
+        key = self.get_app().router.get_snapshot_key(rules)
+
+        app = self.get_app(default_subdomain='www')
+        self.assertNotEqual(app.router.get_snapshot_key(rules), key)
+        self.assertNotEqual(app.router.get_snapshot_key(
+            'snapshot_urls:get_rules'), key)
+        # The map was rebuilt for the new configuration.
+        for rule in app.router.map._rules:
+            self.assertEqual(rule.subdomain, 'www')
+
+        # Rules of lazily loaded apps are left out of the map.
+        app = self.get_app(apps_lazy_load=True)
+        self.assertNotEqual(app.router.get_snapshot_key(rules), key)
+
+    def test_relative_sources(self):
+        self.get_app()
+        f = open(self.snapshot, 'rb')
+        header = pickle.load(f)
+        f.close()
+
+        sources = dict(header['sources'])
+        assert 'snapshot_urls.py' in sources
+        assert 'werkzeug/routing.py' in sources
+
+        # The snapshot is still valid in another directory.
+        old_path = self.path
+        self.path = tempfile.mkdtemp()
+        for name in ('snapshot_urls.py', 'url_map.snapshot'):
+            shutil.move(os.path.join(old_path, name), self.path)
+
+        shutil.rmtree(old_path)
+        sys.path.remove(old_path)
+        sys.path.insert(0, self.path)
+        sys.modules.pop('snapshot_urls', None)
+        self.snapshot = os.path.join(self.path, 'url_map.snapshot')
+
+        app = self.get_app()
+        # The map was loaded without importing the rules.
+        assert 'snapshot_urls' not in sys.modules
+        self.assertEqual(len(app.router.map._rules), 2)
+
+    def test_invalid_snapshot(self):
+        f = open(self.snapshot, 'wb')
+        f.write('invalid')
+        f.close()
+
+        app = self.get_app()
+        self.assertEqual(len(app.router.map._rules), 2)
+        assert app.router.load_snapshot(self.snapshot,
+            'snapshot_urls.get_rules') is not None
+
+    def test_rules_list(self):
+        Tipfy(rules=[Rule('/', endpoint='home', handler=HomeHandler)],
+            config={'tipfy': {'url_map_snapshot': self.snapshot}})
+        assert not os.path.exists(self.snapshot)
+
+
+LAZY_APP_URLS = """
+from tipfy import Rule
+
+def get_rules(app):
+    return [
+        Rule('%(prefix)s/', endpoint='%(name)s-home', handler='resources.handlers.HomeHandler'),
+        Rule('%(prefix)s/<int:id>', endpoint='%(name)s-item', handler='resources.handlers.HomeHandler'),
+    ]
+"""
+
+
+class TestLazyApps(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name in ('lazy_api', 'lazy_admin', 'lazy_broken'):
+            os.mkdir(os.path.join(self.path, name))
+            open(os.path.join(self.path, name, '__init__.py'), 'w').close()
+
+        for name, prefix in (('lazy_api', '/api'), ('lazy_admin', '/admin')):
+            f = open(os.path.join(self.path, name, 'urls.py'), 'w')
+            f.write(LAZY_APP_URLS % {'name': name, 'prefix': prefix})
+            f.close()
+
+        sys.path.insert(0, self.path)
+
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+        sys.path.remove(self.path)
+        for name in sys.modules.keys():
+            if name.startswith('lazy_'):
+                del sys.modules[name]
+
+        shutil.rmtree(self.path)
+
+    def get_app(self, lazy=True):
+        return Tipfy(rules=[
+            Rule('/', endpoint='home', handler=HomeHandler),
+        ], config={
+            'tipfy': {
+                'apps_installed': ['lazy_api', 'lazy_admin', 'lazy_broken'],
+                'apps_entry_points': {
+                    'lazy_api': '/api',
+                    'lazy_admin': '/admin/',
+                    'lazy_broken': '/broken',
+                },
+                'apps_lazy_load': lazy,
+            },
+        })
+
+    def get_endpoints(self, app):
+        return sorted(rule.endpoint for rule in app.router.map._rules)
+
+    def test_load_on_match(self):
+        app = self.get_app()
+        self.assertEqual(app.router.lazy_apps, {
+            '/api': 'lazy_api',
+            '/admin': 'lazy_admin',
+            '/broken': 'lazy_broken',
+        })
+        self.assertEqual(self.get_endpoints(app), ['home'])
+
+        request = Request.from_values('/apis')
+        self.assertRaises(NotFound, app.router.match, request)
+        self.assertEqual(self.get_endpoints(app), ['home'])
+
+        request = Request.from_values('/api/42')
+        rule, rule_args = app.router.match(request)
+        self.assertEqual(rule.endpoint, 'lazy_api-item')
+        self.assertEqual(rule_args, {'id': 42})
+        self.assertEqual(self.get_endpoints(app), ['home', 'lazy_api-home',
+            'lazy_api-item'])
+        assert 'lazy_admin' not in sys.modules
+
+        request = Request.from_values('/admin')
+        self.assertRaises(RequestRedirect, app.router.match, request)
+        self.assertEqual(app.router.lazy_apps, {'/broken': 'lazy_broken'})
+
+    def test_load_on_build(self):
+        app = self.get_app()
+        request = Request.from_values('/')
+        app.router.match(request)
+
+        self.assertEqual(app.router.build(request, 'home', {}), '/')
+        self.assertEqual(len(app.router.lazy_apps), 3)
+
+        self.assertEqual(app.router.build(request, 'lazy_admin-item',
+            {'id': 1}), '/admin/1')
+        self.assertEqual(app.router.lazy_apps, {})
+        self.assertRaises(BuildError, app.router.build, request, 'missing', {})
+
+    def test_missing_urls(self):
+        app = self.get_app()
+        request = Request.from_values('/broken/')
+        self.assertRaises(NotFound, app.router.match, request)
+        assert '/broken' not in app.router.lazy_apps
+
+    def test_disabled(self):
+        app = self.get_app(lazy=False)
+        self.assertEqual(app.router.lazy_apps, {})
+
+    def test_add_list(self):
+        app = self.get_app(lazy=False)
+        app.router.add([
+            Rule('/b', endpoint='b', handler=HomeHandler),
+            Rule('/a/<int:id>', endpoint='a', handler=HomeHandler),
+            Submount('/c', [Rule('/', endpoint='c', handler=HomeHandler)]),
+        ])
+
+        map = Map([
+            Rule('/', endpoint='home'),
+            Rule('/b', endpoint='b'),
+            Rule('/a/<int:id>', endpoint='a'),
+            Submount('/c', [Rule('/', endpoint='c')]),
+        ])
+        map.update()
+        self.assertEqual([rule.rule for rule in app.router.map._rules],
+            [rule.rule for rule in map._rules])
+
+
+class TestRouterStats(unittest.TestCase):
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def get_app(self, **config):
+        return Tipfy(rules=[
+            Rule('/', endpoint='home', handler=HomeHandler),
+            Rule('/<username>', endpoint='profile', handler=HomeHandler),
+            Rule('/items/<int:id>', endpoint='item', handler=HomeHandler),
+            Rule('/items/<int:id>', endpoint='item', methods=['POST'],
+                handler=HomeHandler),
+            Rule('/files/<path:filename>', endpoint='file',
+                handler=HomeHandler),
+        ], config={'tipfy': config})
+
+    def match(self, app, path, method='GET'):
+        return app.router.match(Request.from_values(path, method=method))
+
+    def test_stats(self):
+        app = self.get_app(url_stats=True)
+        self.match(app, '/')
+        self.match(app, '/calvin')
+        self.match(app, '/hobbes')
+        self.match(app, '/items/1')
+        self.match(app, '/items/1', method='POST')
+        self.assertRaises(NotFound, self.match, app, '/items/foo')
+        self.assertEqual(app.router.stats(), {
+            'home': 1,
+            'profile': 2,
+            'item': 2,
+        })
+
+        app.router.use_stats = False
+        self.match(app, '/')
+        self.assertEqual(app.router.stats()['home'], 1)
+
+        app.router.reset_stats()
+        self.assertEqual(app.router.stats(), {})
+
+    def test_stats_disabled(self):
+        app = self.get_app()
+        self.match(app, '/')
+        self.assertEqual(app.router.stats(), {})
+
+    def test_adaptive(self):
+        app = self.get_app(url_adaptive=True)
+        app.router.hot_rules_interval = 1
+        self.match(app, '/items/1')
+        self.match(app, '/files/a/b.txt')
+        self.match(app, '/files/a/b.txt')
+        self.match(app, '/calvin')
+
+        # '/<username>' can match the same paths as rules before it.
+        rules = app.router.map._rules
+        self.assertEqual(app.router.hot_rules, [rules[2], rules[0]])
+        self.assertEqual(app.router.stats(), {
+            'item': 1,
+            'file': 2,
+            'profile': 1,
+        })
+
+        rule, rule_args = self.match(app, '/files/c.txt')
+        self.assertEqual(rule.endpoint, 'file')
+        self.assertEqual(rule_args, {'filename': u'c.txt'})
+
+        # Paths not matched by hot rules are matched normally.
+        rule, rule_args = self.match(app, '/hobbes')
+        self.assertEqual(rule.endpoint, 'profile')
+
+        app.router.add(Rule('/new', endpoint='new', handler=HomeHandler))
+        self.assertEqual(app.router.hot_rules, [])
+
+    def test_is_disjoint(self):
+        app = self.get_app()
+        rules = app.router.map._rules
+        self.assertEqual([rule.rule for rule in rules], ['/items/<int:id>',
+            '/items/<int:id>', '/files/<path:filename>', '/<username>', '/'])
+
+        assert app.router.is_disjoint(rules[0])
+        # Same path as the previous rule.
+        assert not app.router.is_disjoint(rules[1])
+        assert app.router.is_disjoint(rules[2])
+        # '/files' could be matched by both '/files/<path:filename>' and
+        # '/<username>'.
+        assert not app.router.is_disjoint(rules[3])
+        # No converters.
+        assert not app.router.is_disjoint(rules[4])
+
+    def test_patterns_overlap(self):
+        map = Map([
+            Rule('/a/<int:id>', endpoint='a'),
+            Rule('/a/<name>', endpoint='b'),
+            Rule('/b/<int:id>', endpoint='c'),
+            Rule('/a/', endpoint='d'),
+            Rule('/a', endpoint='e'),
+            Rule('/a/<path:p>', endpoint='f'),
+            Rule('/<name>', endpoint='g'),
+            Rule('/x/<int:id>', endpoint='h', subdomain='www'),
+            Rule('/x/<int:id>', endpoint='i', subdomain='api'),
+            Rule('/x/<int:id>', endpoint='j', subdomain='<user>'),
+        ])
+        rules = dict((rule.endpoint, rule) for rule in map._rules)
+
+        def overlap(a, b):
+            return patterns_overlap(get_rule_patterns(rules[a]),
+                get_rule_patterns(rules[b]))
+
+        assert overlap('a', 'b')
+        assert not overlap('a', 'c')
+        assert overlap('a', 'f')
+        assert not overlap('c', 'f')
+        # '/a' redirects to '/a/'.
+        assert overlap('d', 'e')
+        assert overlap('d', 'g')
+        assert not overlap('a', 'g')
+        assert not overlap('h', 'i')
+        assert overlap('h', 'j')
+
+
+class TestDispatch(unittest.TestCase):
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def test_rule_handlers(self):
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler='resources.handlers.HomeHandler'),
+            Rule('/about', name='about', handler=HomeHandler),
+        ])
+        client = app.get_test_client()
+        self.assertEqual(client.get('/').data, 'Hello, World!')
+        self.assertEqual(client.get('/about').data, 'Hello, World!')
+
+        from resources.handlers import HomeHandler as ImportedHandler
+        rules = dict((rule.endpoint, rule) for rule in app.router.map._rules)
+        # Rules are not changed.
+        self.assertEqual(rules['home'].handler,
+            'resources.handlers.HomeHandler')
+        self.assertEqual(app.router.rule_handlers, {
+            rules['home']: ImportedHandler,
+            rules['about']: HomeHandler,
+        })
+        self.assertEqual(app.router.handlers, {
+            'resources.handlers.HomeHandler': ImportedHandler,
+        })
+
+    def test_error_handler_not_stored(self):
+        app = Tipfy()
+        app.error_handlers[404] = 'resources.handlers.HomeHandler'
+        rule = Rule('/', name='__exception__',
+            handler='resources.handlers.HomeHandler')
+        app.router.get_handler(rule)
+        self.assertEqual(app.router.rule_handlers, {})
+        assert 'resources.handlers.HomeHandler' in app.router.handlers
+
+    def test_import_once(self):
+        app = Tipfy(rules=[
+            Rule('/', name='home', handler='resources.handlers.HomeHandler'),
+        ])
+        rule = app.router.map._rules[0]
+        imports = []
+        results = []
+
+        def import_string(name):
+            imports.append(name)
+            time.sleep(0.01)
+            return original(name)
+
+        def target():
+            results.append(app.router.get_handler(rule))
+
+        original = tipfy.import_string
+        tipfy.import_string = import_string
+        try:
+            threads = [threading.Thread(target=target) for i in range(5)]
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+        finally:
+            tipfy.import_string = original
+
+        self.assertEqual(imports, ['resources.handlers.HomeHandler'])
+        self.assertEqual(len(set(results)), 1)
+
+
 class TestHandlerPrefix(unittest.TestCase):
     def tearDown(self):
         Tipfy.app = Tipfy.request = None
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+    Tests for tipfy.ext.tasks
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from tipfy import RequestHandler, Response, Rule, Tipfy
+from tipfy.ext.tasks import (MemoryStore, PermanentTaskFailure, SqliteStore,
+    TaskQueue, TaskQueueHandler, TaskQueueMixin, get_task_queue)
+
+
+calls = []
+done = threading.Event()
+
+
+def append(value):
+    calls.append((value, Tipfy.app))
+    done.set()
+
+
+def fail(times):
+    calls.append(times)
+    if len(calls) <= times:
+        raise ValueError('booo!')
+
+
+def fail_permanently():
+    calls.append('permanent')
+    raise PermanentTaskFailure('no way!')
+
+
+class DeferHandler(RequestHandler, TaskQueueMixin):
+    def get(self, **kwargs):
+        self.defer(append, self.request.args['value'])
+        return Response('Deferred!')
+
+
+class StoreTestMixin(object):
+    def test_put_and_lease(self):
+        store = self.get_store()
+        ids = store.put([(10, 'a'), (5, 'b'), (20, 'c')])
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(store.count(), 3)
+
+        # Ordered by ETA, and only tasks that are due.
+        tasks = store.lease(15, 10, 100)
+        self.assertEqual(tasks, [(ids[1], 0, 'b'), (ids[0], 0, 'a')])
+
+        # Leased tasks are hidden.
+        self.assertEqual(store.lease(15, 10, 100), [])
+        self.assertEqual(store.lease(200, 1, 100), [(ids[2], 0, 'c')])
+
+    def test_retry_and_delete(self):
+        store = self.get_store()
+        ids = store.put([(10, 'a'), (10, 'b')])
+        store.lease(10, 10, 100)
+        store.retry(ids[0], 20, 1)
+        store.delete([ids[1]])
+        self.assertEqual(store.count(), 1)
+        self.assertEqual(store.lease(20, 10, 100), [(ids[0], 1, 'a')])
+
+
+class TestMemoryStore(StoreTestMixin, unittest.TestCase):
+    def get_store(self):
+        return MemoryStore()
+
+
+class TestSqliteStore(StoreTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'tasks.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def get_store(self):
+        return SqliteStore(self.path)
+
+    def test_persistent(self):
+        store = self.get_store()
+        ids = store.put([(10, 'a\x00b')])
+        store.connection.close()
+
+        store = self.get_store()
+        self.assertEqual(store.lease(10, 10, 100), [(ids[0], 0, 'a\x00b')])
+
+
+class TestTaskQueue(unittest.TestCase):
+    def setUp(self):
+        del calls[:]
+        done.clear()
+
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def get_queue(self, **kwargs):
+        kwargs.setdefault('workers', 0)
+        return TaskQueue(MemoryStore(), **kwargs)
+
+    def test_run_pending(self):
+        queue = self.get_queue(batch_size=2)
+        queue.add(append, 'a')
+        queue.add_many([(append, ('b',), {}), (append, (), {'value': 'c'})])
+        queue.add(append, 'later', _countdown=60)
+
+        self.assertEqual(queue.run_pending(), 3)
+        self.assertEqual([call[0] for call in calls], ['a', 'b', 'c'])
+        self.assertEqual(queue.store.count(), 1)
+
+    def test_retry_with_backoff(self):
+        queue = self.get_queue(retry_delay=0.05, max_retry_delay=0.1)
+        queue.add(fail, 2)
+
+        self.assertEqual(queue.run_pending(), 1)
+        self.assertEqual(calls, [2])
+        # Not due yet.
+        self.assertEqual(queue.run_pending(), 0)
+
+        time.sleep(0.06)
+        self.assertEqual(queue.run_pending(), 1)
+        self.assertEqual(calls, [2, 2])
+        task = queue.store.tasks.values()[0]
+        self.assertEqual(task[1], 2)
+        # The second delay is doubled.
+        self.assertTrue(task[0] - time.time() > 0.05)
+
+        time.sleep(0.11)
+        self.assertEqual(queue.run_pending(), 1)
+        self.assertEqual(calls, [2, 2, 2])
+        self.assertEqual(queue.store.count(), 0)
+
+    def test_max_retries(self):
+        queue = self.get_queue(retry_delay=0, max_retries=1)
+        queue.add(fail, 5)
+        queue.run_pending()
+        queue.run_pending()
+        self.assertEqual(calls, [5, 5])
+        self.assertEqual(queue.store.count(), 0)
+
+    def test_permanent_failure(self):
+        queue = self.get_queue()
+        queue.add(fail_permanently)
+        queue.run_pending()
+        self.assertEqual(calls, ['permanent'])
+        self.assertEqual(queue.store.count(), 0)
+
+    def test_workers(self):
+        queue = self.get_queue(workers=2)
+        queue.start()
+        try:
+            queue.add(append, 'a')
+            self.assertTrue(done.wait(2) is not False)
+            self.assertEqual(calls[0][0], 'a')
+        finally:
+            queue.stop()
+
+        self.assertEqual(queue.threads, [])
+
+    def test_defer_from_handler(self):
+        app = Tipfy(rules=[
+            Rule('/defer', name='defer', handler=DeferHandler),
+            Rule('/tasks', name='tasks', handler=TaskQueueHandler),
+        ], config={'tipfy.ext.tasks': {'workers': 0}})
+
+        client = app.get_test_client()
+        response = client.get('/defer?value=foo')
+        self.assertEqual(response.data, 'Deferred!')
+        self.assertEqual(calls, [])
+
+        queue = get_task_queue(app)
+        self.assertTrue(app.registry['tipfy.ext.tasks'] is queue)
+        self.assertEqual(queue.run_pending(), 1)
+        self.assertEqual(calls, [('foo', app)])
+
+        client.get('/defer?value=bar')
+        response = client.post('/tasks')
+        self.assertEqual(response.data, '1')
+        self.assertEqual(calls[1], ('bar', app))
+
+        # Tasks are not executed on GET.
+        client.get('/defer?value=baz')
+        response = client.get('/tasks')
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(queue.store.count(), 1)
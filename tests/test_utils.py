@@ -2,13 +2,16 @@
 """
     Tests for tipfy utils
 """
+import Queue
+import threading
+import time
 import unittest
 from nose.tools import raises
 
 import werkzeug
 
-from tipfy import (RequestHandler, Response, Rule, Tipfy, redirect,
-    redirect_to, render_json_response)
+from tipfy import (LRUCache, RequestHandler, Response, Rule, ThreadPool, Tipfy,
+    TimeoutError, redirect, redirect_to, render_json_response, wait_futures)
 
 
 class HomeHandler(RequestHandler):
@@ -153,3 +156,179 @@ class TestUtils(unittest.TestCase):
         assert isinstance(response, Response)
         assert response.mimetype == 'application/json'
         assert response.data == '{"foo": "bar"}'
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_set(self):
+        cache = LRUCache(3)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.get('c'), None)
+        self.assertEqual(cache.get('c', 'default'), 'default')
+        self.assertEqual(len(cache), 2)
+
+        cache.set('a', 10)
+        self.assertEqual(cache.get('a'), 10)
+        self.assertEqual(len(cache), 2)
+
+    def test_eviction(self):
+        cache = LRUCache(3)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        # 'a' is now the most recently used.
+        cache.get('a')
+        cache.set('d', 4)
+
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+        assert 'd' in cache
+
+        cache.set('e', 5)
+        assert 'c' not in cache
+        self.assertEqual(len(cache), 3)
+
+    def test_delete_and_clear(self):
+        cache = LRUCache(3)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        cache.delete('not-there')
+        assert 'a' not in cache
+        self.assertEqual(len(cache), 1)
+
+        cache.set('c', 3)
+        cache.set('d', 4)
+        cache.set('e', 5)
+        assert 'b' not in cache
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+    def test_clear_concurrent(self):
+        cache = LRUCache(10)
+        def target(n):
+            for i in range(2000):
+                cache.set((n, i), i)
+                if i % 100 == 0:
+                    cache.clear()
+
+        threads = [threading.Thread(target=target, args=(n,)) for n in
+            range(4)]
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        # The linked list and the dictionary hold the same keys.
+        keys = []
+        link = cache.root[1]
+        while link is not cache.root:
+            keys.append(link[2])
+            link = link[1]
+
+        self.assertEqual(sorted(keys), sorted(cache.data))
+        self.assertTrue(len(cache) <= 10)
+
+
+class TestThreadPool(unittest.TestCase):
+    def tearDown(self):
+        Tipfy.app = Tipfy.request = None
+
+    def test_submit(self):
+        pool = ThreadPool(2)
+        self.assertEqual(pool.threads, [])
+
+        future = pool.submit(lambda a, b=0: a + b, 1, b=2)
+        self.assertEqual(future.result(timeout=1), 3)
+        self.assertEqual(future.exception(), None)
+        self.assertTrue(future.done())
+        self.assertEqual(len(pool.threads), 2)
+        pool.shutdown()
+        self.assertEqual(pool.threads, [])
+
+    def test_exception(self):
+        def func():
+            raise ValueError('booo!')
+
+        pool = ThreadPool(1)
+        future = pool.submit(func)
+        self.assertRaises(ValueError, future.result, 1)
+        self.assertTrue(isinstance(future.exception(), ValueError))
+        pool.shutdown()
+
+    def test_timeout(self):
+        event = threading.Event()
+        pool = ThreadPool(1)
+        future = pool.submit(event.wait)
+        self.assertRaises(TimeoutError, future.result, 0.01)
+        self.assertFalse(future.done())
+        event.set()
+        pool.shutdown()
+        self.assertTrue(future.done())
+
+    def test_queue_full(self):
+        event = threading.Event()
+        pool = ThreadPool(1, queue_size=1)
+        pool.submit(event.wait)
+        # Wait until the worker takes the first callable.
+        while not pool.queue.empty():
+            time.sleep(0.01)
+
+        pool.submit(event.wait)
+        self.assertRaises(Queue.Full, pool.submit, event.wait)
+        event.set()
+        pool.shutdown()
+
+    def test_wait_futures(self):
+        event = threading.Event()
+        pool = ThreadPool(3)
+        futures = [
+            pool.submit(time.sleep, 0),
+            pool.submit(event.wait),
+            pool.submit(time.sleep, 0),
+        ]
+
+        start = time.time()
+        done, not_done = wait_futures(futures, timeout=0.1)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(done, [futures[0], futures[2]])
+        self.assertEqual(not_done, [futures[1]])
+
+        event.set()
+        done, not_done = wait_futures(futures)
+        self.assertEqual(done, futures)
+        self.assertEqual(not_done, [])
+        pool.shutdown()
+
+    def test_handler_submit(self):
+        def get_path():
+            time.sleep(0.1)
+            return Tipfy.request.path
+
+        class SlowHandler(RequestHandler):
+            def get(self, **kwargs):
+                futures = [self.submit(get_path) for i in range(3)]
+                done, not_done = self.wait_futures(futures, timeout=1)
+                return Response(','.join(f.result() for f in done))
+
+        app = Tipfy(rules=[Rule('/slow', name='slow', handler=SlowHandler)],
+            config={'tipfy': {'thread_pool_size': 3}})
+        client = app.get_test_client()
+
+        start = time.time()
+        response = client.get('/slow')
+        self.assertTrue(time.time() - start < 0.25)
+        self.assertEqual(response.data, '/slow,/slow,/slow')
+
+        pool = app.get_thread_pool()
+        self.assertTrue(app.registry['thread_pool'] is pool)
+        self.assertEqual(pool.size, 3)
+        self.assertEqual(pool.queue.maxsize, 100)
+        pool.shutdown()
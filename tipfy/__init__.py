@@ -8,19 +8,40 @@
     :copyright: 2010 by tipfy.org.
     :license: BSD, see LICENSE.txt for more details.
 """
+import atexit
+import cPickle as pickle
+import functools
+import hashlib
 import logging
 import os
+import Queue
+import re
+import sys
+import threading
+import time
 import urlparse
 import warnings
+from cStringIO import StringIO
 from wsgiref.handlers import CGIHandler
 
+try:
+    import multiprocessing
+except ImportError:
+    # Not available on App Engine.
+    multiprocessing = None
+
 # Werkzeug Swiss knife.
 # Need to import werkzeug first otherwise py_zipimport fails.
 import werkzeug
-from werkzeug import (Request as BaseRequest, Response as BaseResponse,
-    cached_property, import_string, redirect, url_quote)
-from werkzeug.exceptions import HTTPException, InternalServerError, abort
-from werkzeug.routing import BaseConverter, Map, Rule as BaseRule, RuleFactory
+from werkzeug import (MultiDict, Request as BaseRequest,
+    Response as BaseResponse, cached_property, import_string, redirect,
+    url_encode, url_quote)
+from werkzeug.exceptions import (HTTPException, InternalServerError,
+    MethodNotAllowed, NotFound, ServiceUnavailable, abort)
+from werkzeug.local import Local, release_local
+from werkzeug.routing import (AnyConverter, BaseConverter, BuildError,
+    FloatConverter, IntegerConverter, Map, MapAdapter, RequestRedirect,
+    RequestSlash, Rule as BaseRule, RuleFactory, ValidationError)
 
 try:
     # We declare the namespace to be used outside of App Engine, so that
@@ -42,6 +63,13 @@ __version_info__ = tuple(int(n) for n in __version__.split('.'))
 #:     URL entry points for the installed apps, in case their URLs are mounted
 #:     using base paths.
 #:
+#: apps_lazy_load
+#:     If True, the URL rules of installed apps with an entry point are only
+#:     loaded on the first request to a path under the entry point, or when a
+#:     URL is built for an unknown rule name. The app's ``urls`` module must
+#:     define ``get_rules(app)``, and the rules must be mounted under the
+#:     entry point. Default is False.
+#:
 #: middleware
 #:     A list of middleware classes for the WSGI application. The classes can
 #:     be defined as strings. They define hooks that plug into the application
@@ -55,12 +83,97 @@ __version_info__ = tuple(int(n) for n in __version__.split('.'))
 #:
 #: default_subdomain
 #:     The default subdomain used for rules without a subdomain defined.
+#:
+#: url_trie
+#:     If True, URLs are matched using a :class:`RuleTrie` built from the URL
+#:     map, which only tests the rules that share the static segments of the
+#:     requested path. Useful for apps with a large number of rules. Default
+#:     is False.
+#:
+#: match_cache_size
+#:     Maximum number of URL match results to cache, keyed by request method,
+#:     host and path. Paths that are not found are cached as well. The least
+#:     recently used results are discarded when the limit is reached, and the
+#:     cache is cleared when rules are added to the router. Default is 0
+#:     (disabled).
+#:
+#: url_stats
+#:     If True, the router counts matches for each rule. The counters can be
+#:     read using :meth:`Router.stats` and can be enabled or disabled at
+#:     runtime setting :attr:`Router.use_stats`. Default is False.
+#:
+#: url_adaptive
+#:     If True, the router counts matches and periodically selects the most
+#:     matched rules to be tested before the others. Only rules that can't
+#:     match the same paths as any rule defined before them are selected, so
+#:     results are the same as matching in the defined order. Default is
+#:     False.
+#:
+#: url_map_snapshot
+#:     Path to a file where the URL map is saved after it is built, e.g.,
+#:     ``'url_map.snapshot'`` to save it next to *main.py*. When set, the map
+#:     is loaded from the snapshot if it is still valid for the source files
+#:     of the modules that define the rules, and rebuilt and saved again
+#:     otherwise. Source files are looked up in ``sys.path`` like imports, so
+#:     a snapshot built before deploying is still valid. Only used when the
+#:     rules are defined as a string. Default is None (disabled).
+#:
+#: thread_pool_size
+#:     Number of worker threads of the app's :class:`ThreadPool`, used by
+#:     :meth:`RequestHandler.submit` to run blocking calls in the background.
+#:     Threads are only started when the first callable is submitted.
+#:     Default is 4.
+#:
+#: thread_pool_queue_size
+#:     Maximum number of callables waiting for a worker thread in the app's
+#:     :class:`ThreadPool`. When the limit is reached, submitting raises
+#:     ``Queue.Full``. Default is 100; 0 means no limit.
+#:
+#: process_pool_size
+#:     Number of worker processes of the app's process pool, used to execute
+#:     handler methods decorated with :func:`run_in_process`. Default is None
+#:     (the number of CPUs).
+#:
+#: process_pool_timeout
+#:     Maximum number of seconds to wait for a handler method executed in the
+#:     process pool. When it is exceeded, a ``503 Service Unavailable``
+#:     response is returned. Default is 30.
+#:
+#: coalesce_requests
+#:     If True, concurrent ``GET`` requests with the same coalesce key are
+#:     dispatched once: one request calls the handler and the others wait
+#:     for its response, each receiving a copy of it. Only useful with a
+#:     threaded server. Default is False.
+#:
+#: coalesce_key
+#:     A callable, or a string defining a callable, that receives a
+#:     :class:`Request` and returns a hashable key to group requests, or None
+#:     to dispatch the request alone. Default is None, which uses
+#:     :func:`get_coalesce_key`.
+#:
+#: coalesce_timeout
+#:     Maximum number of seconds a coalesced request waits for the response.
+#:     When it is exceeded, the request is dispatched on its own. Default is
+#:     30.
 default_config = {
     'apps_installed': [],
     'apps_entry_points': {},
+    'apps_lazy_load': False,
     'middleware': [],
     'server_name': None,
     'default_subdomain': '',
+    'url_trie': False,
+    'match_cache_size': 0,
+    'url_stats': False,
+    'url_adaptive': False,
+    'url_map_snapshot': None,
+    'thread_pool_size': 4,
+    'thread_pool_queue_size': 100,
+    'process_pool_size': None,
+    'process_pool_timeout': 30,
+    'coalesce_requests': False,
+    'coalesce_key': None,
+    'coalesce_timeout': 30,
 }
 
 # Allowed request methods.
@@ -70,6 +183,16 @@ ALLOWED_METHODS = frozenset(['DELETE', 'GET', 'HEAD', 'OPTIONS', 'POST', 'PUT',
 REQUIRED_VALUE = object()
 # Value used for missing default values.
 DEFAULT_VALUE = object()
+# Storage for the active app and request in each thread.
+_local = Local()
+# Lock to create the process pool of an app only once.
+_process_pool_lock = threading.Lock()
+# Placeholder for rule variables when splitting rules in path segments.
+_SEGMENT_VARIABLE = u'\x00'
+# Regular expression for converter variables in redirect_to rule strings.
+_variable_re = re.compile(r'<([^>]+)>')
+# Regular expression for converters that never match a slash.
+_segment_regex_re = re.compile(r'^\[\^/\](\{\d*,?\d*\}|[+*])?$')
 
 
 class RequestHandler(object):
@@ -116,36 +239,77 @@ class RequestHandler(object):
         :returns:
             A :class:`Response` instance.
         """
-        method = getattr(self, _method, None)
+        methods, valid_methods, allow = self.get_method_table()
+        method = methods.get(_method)
         if method is None:
-            # 405 Method Not Allowed.
-            # The response MUST include an Allow header containing a
-            # list of valid methods for the requested resource.
-            # http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.6
-            self.abort(405, valid_methods=get_valid_methods(self))
+            if _method.upper() not in ALLOWED_METHODS:
+                # Not a request method, e.g., 'handle_exception'.
+                method = getattr(self.__class__, _method, None)
+
+            if method is None:
+                # 405 Method Not Allowed.
+                # The response MUST include an Allow header containing a
+                # list of valid methods for the requested resource.
+                # http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.6
+                self.abort(405, valid_methods=valid_methods)
 
         plugins = self.plugins or self.middleware
         if not plugins:
             # No plugins are set: just execute the method.
-            return method(*args, **kwargs)
+            return method(self, *args, **kwargs)
 
-        # Get all plugins for this handler.
-        plugins = self.app.get_middleware(self, plugins)
+        # Execute the method wrapped by the plugins compiled for this class.
+        factory = self.app.middleware_factory
+        chain = factory.handler_chains.get(self.__class__) or \
+            factory.get_handler_chain(self, plugins)
+        return chain(self, method, args, kwargs)
 
-        # Execute pre_dispatch plugins.
-        for func in plugins.get('pre_dispatch', []):
-            response = func(self)
-            if response is not None:
-                break
-        else:
-            response = method(*args, **kwargs)
+    @classmethod
+    def get_method_table(cls):
+        """Returns the request methods implemented by this handler class. The
+        class is inspected only once and the result is stored in it, so
+        methods must not be added to the class after it handled a request.
 
-        # Execute post_dispatch plugins.
-        for func in plugins.get('post_dispatch', []):
-            response = func(self, response)
+        If the class implements any request method but not ``options()``,
+        :meth:`default_options` is used to reply to ``OPTIONS`` requests.
+
+        :returns:
+            A tuple ``(methods, valid_methods, allow)``: a dictionary of
+            unbound methods keyed by lower case request method, a sorted list
+            of valid request methods and the value for the ``Allow`` header.
+        """
+        table = cls.__dict__.get('_method_table')
+        if table is None:
+            methods = {}
+            for request_method in ALLOWED_METHODS:
+                name = request_method.lower().replace('-', '_')
+                method = getattr(cls, name, None)
+                if method is not None:
+                    methods[name] = method
+
+            if methods and 'options' not in methods:
+                methods['options'] = cls.default_options
+
+            valid_methods = sorted(name.upper().replace('_', '-') for name in
+                methods)
+            table = (methods, valid_methods, ', '.join(valid_methods))
+            cls._method_table = table
+
+        return table
+
+    def default_options(self, *args, **kwargs):
+        """Replies to ``OPTIONS`` requests when the handler doesn't implement
+        ``options()``, returning an empty response with an ``Allow`` header
+        listing the valid request methods.
 
-        # Done!
-        return response
+        :param kwargs:
+            Keyword arguments from the matched :class:`Rule`.
+        :returns:
+            A :class:`Response` instance.
+        """
+        return self.app.response_class(headers=[
+            ('Allow', self.get_method_table()[2]),
+        ])
 
     def dispatch(self, _method, *args, **kwargs):
         """A wrapper for :meth:`__call__`.
@@ -231,6 +395,46 @@ class RequestHandler(object):
         """
         return self.app.router.build(self.request, _name, kwargs)
 
+    def submit(self, func, *args, **kwargs):
+        """Runs a callable in the app's :class:`ThreadPool`, to overlap
+        blocking calls, e.g., to slow backends, made during a request::
+
+            def get(self, **kwargs):
+                user = self.submit(fetch_user, kwargs['user_id'])
+                feed = self.submit(fetch_feed, kwargs['user_id'])
+                done, not_done = self.wait_futures([user, feed], timeout=2)
+                # ...
+
+        The current app and request are set in the worker thread while the
+        callable is executed.
+
+        :param func:
+            The callable to execute.
+        :param args:
+            Positional arguments to call it with.
+        :param kwargs:
+            Keyword arguments to call it with.
+        :returns:
+            A :class:`Future` instance.
+        """
+        app, request = self.app, self.request
+
+        def call():
+            Tipfy.app, Tipfy.request = app, request
+            try:
+                return func(*args, **kwargs)
+            finally:
+                release_local(_local)
+
+        return app.get_thread_pool().submit(call)
+
+    def wait_futures(self, futures, timeout=None):
+        """Waits for futures to finish, up to a deadline.
+
+        .. seealso:: :func:`wait_futures`.
+        """
+        return wait_futures(futures, timeout)
+
 
 class Request(BaseRequest):
     """The :class:`Request` object contains all environment variables for the
@@ -272,6 +476,28 @@ class Response(BaseResponse):
     default_mimetype = 'text/html'
 
 
+class WarmupHandler(RequestHandler):
+    """Handles App Engine warmup requests calling :meth:`Tipfy.warmup`. To
+    use it, enable warmup requests in *app.yaml*::
+
+        inbound_services:
+        - warmup
+
+    And add a rule for it::
+
+        Rule('/_ah/warmup', name='warmup', handler='tipfy.WarmupHandler')
+
+    The response is empty, as App Engine ignores it. The import time of each
+    module is logged at debug level.
+    """
+    def get(self, **kwargs):
+        for module, seconds in self.app.warmup():
+            logging.debug('Warmup imported %s in %.1fms' % (module,
+                seconds * 1000))
+
+        return Response('')
+
+
 class Config(dict):
     """A simple configuration dictionary keyed by module name. This is a
     dictionary of dictionaries. It requires all values to be dictionaries
@@ -467,6 +693,271 @@ class Config(dict):
         self[module].update(value)
 
 
+class LRUCache(object):
+    """A thread-safe cache that holds a limited number of values, discarding
+    the least recently used ones when the limit is reached.
+    """
+    def __init__(self, capacity):
+        """Initializes the cache.
+
+        :param capacity:
+            Maximum number of values to keep.
+        """
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self._reset()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        """Returns a cached value and marks it as the most recently used.
+
+        :param key:
+            The cache key.
+        :param default:
+            Value returned if the key is not cached.
+        :returns:
+            The cached value, or the default value.
+        """
+        self.lock.acquire()
+        try:
+            link = self.data.get(key)
+            if link is None:
+                return default
+
+            self._move_to_end(link)
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        """Caches a value, discarding the least recently used one if the cache
+        is full.
+
+        :param key:
+            The cache key.
+        :param value:
+            The value to be cached.
+        """
+        self.lock.acquire()
+        try:
+            link = self.data.get(key)
+            if link is not None:
+                link[3] = value
+                self._move_to_end(link)
+                return
+
+            root = self.root
+            if len(self.data) >= self.capacity:
+                oldest = root[1]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+                del self.data[oldest[2]]
+
+            last = root[0]
+            last[1] = root[0] = self.data[key] = [last, root, key, value]
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        """Removes a value from the cache.
+
+        :param key:
+            The cache key.
+        """
+        self.lock.acquire()
+        try:
+            link = self.data.pop(key, None)
+            if link is not None:
+                link[0][1] = link[1]
+                link[1][0] = link[0]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Removes all values from the cache."""
+        self.lock.acquire()
+        try:
+            self._reset()
+        finally:
+            self.lock.release()
+
+    def _reset(self):
+        # Circular doubly linked list of [previous, next, key, value] links,
+        # from the least to the most recently used.
+        root = []
+        root[:] = [root, root, None, None]
+        self.root = root
+        self.data = {}
+
+    def _move_to_end(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+
+
+class TimeoutError(Exception):
+    """Raised when the result of a :class:`Future` is not ready in time."""
+
+
+class Future(object):
+    """The pending result of a callable submitted to a :class:`ThreadPool`.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def done(self):
+        """Returns True if the callable has finished."""
+        return self.event.isSet()
+
+    def wait(self, timeout=None):
+        """Waits for the callable to finish.
+
+        :param timeout:
+            Maximum number of seconds to wait, or None to wait until done.
+        :returns:
+            True if the callable has finished, False otherwise.
+        """
+        self.event.wait(timeout)
+        return self.event.isSet()
+
+    def result(self, timeout=None):
+        """Returns the value returned by the callable, waiting for it to
+        finish. If the callable raised an exception, it is raised again.
+
+        :param timeout:
+            Maximum number of seconds to wait, or None to wait until done.
+        :returns:
+            The value returned by the callable.
+        :raises:
+            :class:`TimeoutError` if the callable didn't finish in time.
+        """
+        if not self.wait(timeout):
+            raise TimeoutError('Future not done after %s seconds.' % timeout)
+
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+        return self.value
+
+    def exception(self, timeout=None):
+        """Returns the exception raised by the callable, or None.
+
+        :param timeout:
+            Maximum number of seconds to wait, or None to wait until done.
+        :raises:
+            :class:`TimeoutError` if the callable didn't finish in time.
+        """
+        if not self.wait(timeout):
+            raise TimeoutError('Future not done after %s seconds.' % timeout)
+
+        if self.exc_info is not None:
+            return self.exc_info[1]
+
+    def set_result(self, value):
+        self.value = value
+        self.event.set()
+
+    def set_exception(self, exc_info):
+        self.exc_info = exc_info
+        self.event.set()
+
+
+class ThreadPool(object):
+    """A pool of worker threads that execute callables in the background.
+    The threads are started when the first callable is submitted.
+    """
+    def __init__(self, size, queue_size=0):
+        """Initializes the pool.
+
+        :param size:
+            Number of worker threads.
+        :param queue_size:
+            Maximum number of callables waiting for a worker thread, or 0 for
+            no limit.
+        """
+        self.size = size
+        self.queue = Queue.Queue(queue_size)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedules a callable to be executed by a worker thread.
+
+        :param func:
+            The callable to execute.
+        :param args:
+            Positional arguments to call it with.
+        :param kwargs:
+            Keyword arguments to call it with.
+        :returns:
+            A :class:`Future` instance.
+        :raises:
+            ``Queue.Full`` if the queue limit was reached.
+        """
+        if len(self.threads) < self.size:
+            self.start()
+
+        future = Future()
+        self.queue.put_nowait((future, func, args, kwargs))
+        return future
+
+    def start(self):
+        """Starts the worker threads that are not running yet."""
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.size:
+                thread = threading.Thread(target=self.work)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def shutdown(self, wait=True):
+        """Stops the worker threads after the queued callables are executed.
+
+        :param wait:
+            True to wait for the threads to finish.
+        """
+        self.lock.acquire()
+        try:
+            threads, self.threads = self.threads, []
+            for thread in threads:
+                self.queue.put(None)
+        finally:
+            self.lock.release()
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            future, func, args, kwargs = item
+            try:
+                future.set_result(func(*args, **kwargs))
+            except:
+                future.set_exception(sys.exc_info())
+
+            # Don't keep references to the last callable while idle.
+            item = future = func = args = kwargs = None
+
+
 class MiddlewareFactory(object):
     """A factory and registry for middleware instances in use."""
     #: All middleware methods to look for.
@@ -490,6 +981,8 @@ class MiddlewareFactory(object):
         self.methods = {}
         # Middleware methods for a given object.
         self.obj_middleware = {}
+        # Compiled plugin chains for a given handler class.
+        self.handler_chains = {}
 
     def get_middleware(self, obj, classes):
         """Returns a dictionary of all middleware instance methods for a given
@@ -561,6 +1054,131 @@ class MiddlewareFactory(object):
 
         return res
 
+    def get_handler_chain(self, handler, classes):
+        """Returns the compiled plugin chain for a handler class, compiling
+        it on first use.
+
+        :param handler:
+            A :class:`RequestHandler` instance.
+        :param classes:
+            A list of middleware classes used by the handler.
+        :returns:
+            A callable, as returned by :meth:`compile_handler_chain`.
+        """
+        cls = handler.__class__
+        chain = self.handler_chains.get(cls)
+        if chain is None:
+            middleware = self.get_middleware(handler, classes)
+            chain = self.handler_chains[cls] = self.compile_handler_chain(
+                middleware.get('pre_dispatch', ()),
+                middleware.get('post_dispatch', ()))
+
+        return chain
+
+    def compile_handler_chain(self, pre_dispatch, post_dispatch):
+        """Compiles the ``pre_dispatch`` and ``post_dispatch`` middleware
+        methods into a single callable that executes a handler method.
+
+        If a ``pre_dispatch`` method returns a response, the remaining ones
+        and the handler method are not called. All ``post_dispatch`` methods
+        are always called.
+
+        :param pre_dispatch:
+            A list of ``pre_dispatch`` middleware methods.
+        :param post_dispatch:
+            A list of ``post_dispatch`` middleware methods, in the order they
+            are called.
+        :returns:
+            A callable ``chain(handler, method, args, kwargs)`` that returns
+            a response. ``method`` is the unbound handler method.
+        """
+        pre_dispatch = tuple(pre_dispatch)
+        post_dispatch = tuple(post_dispatch)
+
+        if not pre_dispatch:
+            def chain(handler, method, args, kwargs):
+                response = method(handler, *args, **kwargs)
+                for func in post_dispatch:
+                    response = func(handler, response)
+
+                return response
+        elif not post_dispatch:
+            def chain(handler, method, args, kwargs):
+                for func in pre_dispatch:
+                    response = func(handler)
+                    if response is not None:
+                        return response
+
+                return method(handler, *args, **kwargs)
+        else:
+            def chain(handler, method, args, kwargs):
+                for func in pre_dispatch:
+                    response = func(handler)
+                    if response is not None:
+                        break
+                else:
+                    response = method(handler, *args, **kwargs)
+
+                for func in post_dispatch:
+                    response = func(handler, response)
+
+                return response
+
+        return chain
+
+    def compile_app_pipeline(self, middleware):
+        """Compiles the ``pre_dispatch_handler`` and ``post_dispatch_handler``
+        app middleware methods into a single callable that dispatches a
+        request using :meth:`Router.dispatch`.
+
+        If a ``pre_dispatch_handler`` method returns a response, the remaining
+        ones and the handler are not called. All ``post_dispatch_handler``
+        methods are always called and must return a response.
+
+        :param middleware:
+            A dictionary of middleware methods, as returned by
+            :meth:`load_middleware`.
+        :returns:
+            A callable ``pipeline(app, request, match)`` that returns a
+            response.
+        """
+        pre_dispatch = tuple(middleware.get('pre_dispatch_handler', ()))
+        post_dispatch = tuple(middleware.get('post_dispatch_handler', ()))
+
+        if not pre_dispatch and not post_dispatch:
+            def pipeline(app, request, match):
+                return app.router.dispatch(app, request, match)
+        elif not pre_dispatch:
+            def pipeline(app, request, match):
+                response = app.router.dispatch(app, request, match)
+                for func in post_dispatch:
+                    response = func(response)
+
+                return response
+        elif not post_dispatch:
+            def pipeline(app, request, match):
+                for func in pre_dispatch:
+                    response = func()
+                    if response is not None:
+                        return response
+
+                return app.router.dispatch(app, request, match)
+        else:
+            def pipeline(app, request, match):
+                for func in pre_dispatch:
+                    response = func()
+                    if response is not None:
+                        break
+                else:
+                    response = app.router.dispatch(app, request, match)
+
+                for func in post_dispatch:
+                    response = func(response)
+
+                return response
+
+        return pipeline
+
 
 class Rule(BaseRule):
     """Extends Werkzeug routing to support handler and name definitions for
@@ -636,7 +1254,311 @@ class RegexConverter(BaseConverter):
         self.regex = items[0]
 
 
+class RuleTrieNode(object):
+    """A node of :class:`RuleTrie`."""
+    def __init__(self):
+        #: Child nodes keyed by static path segment.
+        self.static = {}
+        #: Child node for a segment that contains converters.
+        self.dynamic = None
+        #: Rules that end in this node, as ``(index, rule)`` tuples.
+        self.rules = []
+        #: Rules with a converter that can match slashes after this node,
+        #: as ``(index, rule)`` tuples. They are candidates for any path that
+        #: reaches this node.
+        self.rest = []
+
+
+class RuleTrie(object):
+    """A prefix tree of path segments built from the rules of a
+    ``werkzeug.routing.Map``. It is used by :class:`Router` to select the few
+    rules that can match a path, instead of testing the regular expression of
+    every rule in sequence.
+
+    Each rule is stored under the static segments of its path. A segment with
+    converters that can't match slashes is stored in a wildcard branch, and a
+    converter that can (like ``path`` or ``regex``) stops the descent, making
+    the rule a candidate for any remaining path. Candidates are then matched
+    in the same order used by the map, so results and exceptions are the same
+    as the ones from ``MapAdapter.match()``.
+    """
+    def __init__(self, map):
+        """Builds the trie.
+
+        :param map:
+            A ``werkzeug.routing.Map`` instance.
+        """
+        map.update()
+        self.map = map
+        # Root nodes keyed by static subdomains.
+        self.subdomains = {}
+        # Root node for rules with converters in the subdomain.
+        self.any_subdomain = RuleTrieNode()
+
+        index = 0
+        for rule in map._rules:
+            if not rule.build_only:
+                self.add(index, rule)
+                index += 1
+
+    def add(self, index, rule):
+        """Adds a rule to the trie.
+
+        :param index:
+            The position of the rule in the map, used to sort candidates.
+        :param rule:
+            A bound :class:`Rule`.
+        """
+        subdomain, segments, greedy = get_rule_segments(rule)
+        if subdomain is None:
+            node = self.any_subdomain
+        else:
+            node = self.subdomains.get(subdomain)
+            if node is None:
+                node = self.subdomains[subdomain] = RuleTrieNode()
+
+        for segment in segments:
+            if _SEGMENT_VARIABLE in segment:
+                if node.dynamic is None:
+                    node.dynamic = RuleTrieNode()
+
+                node = node.dynamic
+            else:
+                child = node.static.get(segment)
+                if child is None:
+                    child = node.static[segment] = RuleTrieNode()
+
+                node = child
+
+        item = (index, rule)
+        if greedy:
+            node.rest.append(item)
+            return
+
+        node.rules.append(item)
+        if not rule.is_leaf or not rule.strict_slashes:
+            # The rule also matches (or redirects from) the path with a
+            # trailing slash.
+            child = node.static.get(u'')
+            if child is None:
+                child = node.static[u''] = RuleTrieNode()
+
+            child.rules.append(item)
+
+    def get_candidates(self, subdomain, path):
+        """Returns the rules that can match a given path, in map order.
+
+        :param subdomain:
+            The subdomain of the current request.
+        :param path:
+            The requested path, starting with a slash.
+        :returns:
+            A list of :class:`Rule` instances.
+        """
+        segments = path.split(u'/')[1:]
+        depth = len(segments)
+        found = []
+        stack = [(self.any_subdomain, 0)]
+        node = self.subdomains.get(subdomain)
+        if node is not None:
+            stack.append((node, 0))
+
+        while stack:
+            node, pos = stack.pop()
+            if node.rest:
+                found.extend(node.rest)
+
+            if pos == depth:
+                found.extend(node.rules)
+                continue
+
+            child = node.static.get(segments[pos])
+            if child is not None:
+                stack.append((child, pos + 1))
+
+            if node.dynamic is not None:
+                stack.append((node.dynamic, pos + 1))
+
+        found.sort()
+        return [rule for index, rule in found]
+
+    def match(self, adapter, path_info=None, method=None):
+        """Matches a path against the rules in the trie. This is equivalent to
+        ``MapAdapter.match(path_info, method, return_rule=True)``.
+
+        :param adapter:
+            A ``werkzeug.routing.MapAdapter`` bound to the current request.
+        :param path_info:
+            The path to match. If not set, uses the path the adapter is bound
+            to.
+        :param method:
+            The request method. If not set, uses the adapter default method.
+        :returns:
+            A tuple ``(rule, rule_args)``.
+        """
+        if path_info is None:
+            path_info = adapter.path_info
+
+        if not isinstance(path_info, unicode):
+            path_info = path_info.decode(self.map.charset, 'ignore')
+
+        method = (method or adapter.default_method).upper()
+        rules = self.get_candidates(adapter.subdomain,
+            u'/' + path_info.lstrip(u'/'))
+        return match_rules(adapter, rules, path_info, method)
+
+
+class UrlBuilder(object):
+    """Builds URLs for the rules of an endpoint. This is equivalent to
+    ``MapAdapter.build()``, but the rules are compiled once into a format
+    string and a list of converters, so building a URL only needs to convert
+    the values and interpolate them.
+    """
+    def __init__(self, map, endpoint):
+        """Compiles the rules for an endpoint.
+
+        :param map:
+            A ``werkzeug.routing.Map`` instance.
+        :param endpoint:
+            The endpoint (rule name) to build URLs for.
+        """
+        map.update()
+        self.map = map
+        self.endpoint = endpoint
+        # True if any rule is limited to some methods.
+        self.has_methods = False
+        # Compiled rules: (rule, simple, arguments, template, converters).
+        self.rules = []
+
+        for rule in map._rules_by_endpoint.get(endpoint, ()):
+            template = []
+            converters = []
+            for is_dynamic, data in rule._trace:
+                if is_dynamic:
+                    template.append(u'%s')
+                    converters.append((data, rule._converters[data]))
+                else:
+                    if isinstance(data, str):
+                        data = data.decode(map.charset)
+
+                    template.append(data.replace(u'%', u'%%'))
+
+            # Simple rules are suitable for any values with their arguments.
+            simple = rule.methods is None and rule.defaults is None
+            self.has_methods = self.has_methods or rule.methods is not None
+            self.rules.append((rule, simple, rule.arguments,
+                u''.join(template), tuple(converters)))
+
+    def build(self, adapter, values, method=None, force_external=False):
+        """Builds a URL. This is equivalent to ``MapAdapter.build()``.
+
+        :param adapter:
+            A ``werkzeug.routing.MapAdapter`` bound to the current request.
+        :param values:
+            A dictionary of values to build the URL. Values not used by the
+            rule are appended as query arguments.
+        :param method:
+            The HTTP method for the rule, if there are different rules for
+            different methods on the same endpoint.
+        :param force_external:
+            If True, builds an absolute URL.
+        :returns:
+            The built URL.
+        """
+        if not values:
+            values = {}
+        elif isinstance(values, MultiDict):
+            values = dict((k, v) for k, v in values.iteritems(multi=True)
+                if v is not None)
+        else:
+            values = dict((k, v) for k, v in values.iteritems()
+                if v is not None)
+
+        rv = None
+        if method is None and self.has_methods:
+            # Try the default method first, like MapAdapter.
+            rv = self.build_path(values, adapter.default_method)
+
+        if rv is None:
+            rv = self.build_path(values, method)
+            if rv is None:
+                raise BuildError(self.endpoint, values, method)
+
+        subdomain, path = rv
+        path = path.lstrip('/')
+        if not force_external and subdomain == adapter.subdomain:
+            url = adapter.script_name + path
+            if u':' in url or u'/.' in url or u'#' in url:
+                # Let urljoin() resolve relative segments and odd paths.
+                url = urlparse.urljoin(adapter.script_name, path)
+
+            return str(url)
+
+        return str('%s://%s%s%s/%s' % (
+            adapter.url_scheme,
+            subdomain and subdomain + '.' or '',
+            adapter.server_name,
+            adapter.script_name[:-1],
+            path
+        ))
+
+    def build_path(self, values, method=None):
+        """Returns the subdomain and path built by the first rule suitable for
+        the given values and method.
+
+        :param values:
+            A dictionary of values to build the URL, without None values.
+        :param method:
+            The HTTP method for the rule, or None.
+        :returns:
+            A tuple ``(subdomain, path)`` or None if no rule is suitable.
+        """
+        for rule, simple, arguments, template, converters in self.rules:
+            if simple:
+                # Same as suitable_for(), without building sets.
+                for key in arguments:
+                    if key not in values:
+                        break
+                else:
+                    simple = False
+
+                if simple:
+                    continue
+            elif not rule.suitable_for(values, method):
+                continue
+
+            try:
+                url = template % tuple([converter.to_url(values[name]) for
+                    name, converter in converters])
+            except ValidationError:
+                continue
+
+            subdomain, url = url.split(u'|', 1)
+            for key in values:
+                if key not in arguments:
+                    # Append unknown values as query arguments.
+                    map = self.map
+                    query = MultiDict(values)
+                    for key in arguments:
+                        if key in query:
+                            del query[key]
+
+                    url += '?' + url_encode(query, map.charset,
+                        sort=map.sort_parameters, key=map.sort_key)
+                    break
+
+            return subdomain, url
+
+
 class Router(object):
+    #: Maximum number of bound URL adapters to keep. When it is reached, the
+    #: cache is cleared.
+    max_adapters = 100
+    #: Maximum number of rules tested first when ``url_adaptive`` is enabled.
+    max_hot_rules = 10
+    #: Number of counted matches between updates of the rules tested first.
+    hot_rules_interval = 1000
+
     def __init__(self, app, rules=None):
         """
         :param app:
@@ -649,16 +1571,135 @@ class Router(object):
             and call it passing the WSGI application.
         """
         self.app = app
+        # Imported handler classes keyed by import string.
         self.handlers = {}
+        # Handler classes keyed by rule.
+        self.rule_handlers = {}
         self.map = self.get_map(rules)
+        self.map.update()
+        # Lock to add rules and import handlers.
+        self.lock = threading.RLock()
+        # Installed apps to be loaded on demand, keyed by entry point.
+        self.lazy_apps = {}
+        if app.config.get('tipfy', 'apps_lazy_load'):
+            entry_points = app.config.get('tipfy', 'apps_entry_points')
+            for module in app.config.get('tipfy', 'apps_installed'):
+                if module in entry_points:
+                    self.lazy_apps[entry_points[module].rstrip('/')] = module
+
+        # Use a trie to select the rules to match?
+        self.use_trie = app.config.get('tipfy', 'url_trie')
+        # Trie built from the URL map, used when use_trie is set.
+        self.trie = None
+        # Rules without converters keyed by (subdomain, method, path).
+        self.static_rules = None
+        # URL adapters bound to server name, host, script name and scheme.
+        self.adapters = {}
+        # URL builders keyed by endpoint.
+        self.builders = {}
+        # Match results keyed by method, host and path.
+        cache_size = app.config.get('tipfy', 'match_cache_size')
+        if cache_size:
+            self.match_cache = LRUCache(cache_size)
+        else:
+            self.match_cache = None
+
+        # Test the most matched rules first?
+        self.use_adaptive = app.config.get('tipfy', 'url_adaptive')
+        # Count matches for each rule?
+        self.use_stats = self.use_adaptive or app.config.get('tipfy',
+            'url_stats')
+        # Number of matches keyed by rule, and total.
+        self.hits = {}
+        self.hits_total = 0
+        # Rules tested first, and rules that can be tested first keyed by
+        # rule, when use_adaptive is set.
+        self.hot_rules = []
+        self.disjoint_rules = {}
+
+        # Dispatch concurrent GET requests with the same key once?
+        self.use_coalesce = app.config.get('tipfy', 'coalesce_requests')
+        self.coalesce_timeout = app.config.get('tipfy', 'coalesce_timeout')
+        coalesce_key = app.config.get('tipfy', 'coalesce_key')
+        if isinstance(coalesce_key, basestring):
+            coalesce_key = import_string(coalesce_key)
+
+        self.coalesce_key = coalesce_key or get_coalesce_key
+        # Futures of the responses being dispatched, keyed by coalesce key.
+        self.flights = {}
+        self.flights_lock = threading.Lock()
 
     def add(self, rule):
-        """Adds a rule to the URL map.
+        """Adds a rule to the URL map. Rules must be added using this method
+        (and not directly to the map) so that the lookup structures built from
+        the map are refreshed.
+
+        The rules are added to copies of the map's rule lists, which then
+        replace the original ones. This way requests matched in other threads
+        never see a partially updated map.
 
         :param rule:
-            A :class:`Rule` or rule factory to be added.
+            A :class:`Rule`, a rule factory or a list of them to be added.
+        """
+        if not isinstance(rule, (list, tuple)):
+            rule = [rule]
+
+        map = self.map
+        self.lock.acquire()
+        try:
+            rules = list(map._rules)
+            rules_by_endpoint = dict((endpoint, list(endpoint_rules)) for
+                endpoint, endpoint_rules in map._rules_by_endpoint.iteritems())
+
+            for rulefactory in rule:
+                for r in rulefactory.get_rules(map):
+                    r.bind(map)
+                    rules.append(r)
+                    rules_by_endpoint.setdefault(r.endpoint, []).append(r)
+
+            # Same as Map.update().
+            rules.sort(lambda a, b: a.match_compare(b))
+            for endpoint_rules in rules_by_endpoint.itervalues():
+                endpoint_rules.sort(lambda a, b: a.build_compare(b))
+
+            map._rules, map._rules_by_endpoint = rules, rules_by_endpoint
+            self.trie = self.static_rules = None
+            self.builders = {}
+            self.hot_rules = []
+            self.disjoint_rules = {}
+            if self.match_cache is not None:
+                self.match_cache.clear()
+        finally:
+            self.lock.release()
+
+    def load_apps(self, path=None):
+        """Loads the URL rules of installed apps that were not loaded yet
+        because ``apps_lazy_load`` is enabled.
+
+        :param path:
+            A requested path. Only apps with entry points that contain the
+            path are loaded. If None, all apps are loaded.
+        :returns:
+            None.
         """
-        self.map.add(rule)
+        for entry_point in self.lazy_apps.keys():
+            if path is None or path == entry_point or \
+                path.startswith(entry_point + '/'):
+                self.lock.acquire()
+                try:
+                    # Check again: it may have been loaded by another thread.
+                    module = self.lazy_apps.get(entry_point)
+                    if module is not None:
+                        urls = import_string('%s.urls' % module, silent=True)
+                        if urls is None:
+                            logging.warning('Missing %s.urls. No URL rules '
+                                'were loaded.' % module)
+                        else:
+                            self.add(urls.get_rules(self.app))
+
+                        del self.lazy_apps[entry_point]
+                finally:
+                    self.lock.release()
 
     def match(self, request):
         """Matches registered :class:`Rule` definitions against the URL
@@ -675,89 +1716,509 @@ class Router(object):
             None.
         """
         # Bind the URL map to the current request
-        request.url_adapter = self.map.bind_to_environ(request.environ,
-            server_name=self.get_server_name())
+        adapter = request.url_adapter = self.get_adapter(request)
+        if self.lazy_apps:
+            self.load_apps(adapter.path_info)
+
+        # Try a rule without converters, then match the path against
+        # registered rules.
+        match = self.match_static(adapter, request.method)
+        if match is None:
+            if self.match_cache is not None:
+                match = self.match_cached(adapter, request.method)
+            else:
+                match = self.match_rules(adapter)
 
-        # Match the path against registered rules.
-        match = request.url_adapter.match(return_rule=True)
         request.rule, request.rule_args = match
+        if self.use_stats:
+            self.count_hit(match[0])
+
         return match
 
-    def dispatch_with_hooks(self, app, request, match):
-        # XXX rename this method name, split in two: pre and post_dispatch.
+    def match_rules(self, adapter):
+        """Matches the path bound to a URL adapter against the registered
+        rules, using the :class:`RuleTrie` if it is enabled.
 
-        # Executes pre_dispatch_handler middleware. If a middleware returns
-        # a response, the chain is stopped.
-        for func in app.middleware.get('pre_dispatch_handler', []):
-            response = func()
-            if response is not None:
-                break
-        else:
-            response = self.dispatch(app, request, match)
+        :param adapter:
+            A ``werkzeug.routing.MapAdapter`` bound to the current request.
+        :returns:
+            A tuple ``(rule, rule_args)``.
+        """
+        if self.hot_rules:
+            match = self.match_hot_rules(adapter)
+            if match is not None:
+                return match
 
-        # Executes post_dispatch_handler middleware. All middleware are
-        # executed and must return a response object.
-        for func in app.middleware.get('post_dispatch_handler', []):
-            response = func(response)
+        if self.use_trie:
+            return self.get_trie().match(adapter)
 
-        return response
+        return adapter.match(return_rule=True)
 
-    def dispatch(self, app, request, match, method=None):
-        """Dispatches a request. This calls the :class:`RequestHandler` from
-        the matched :class:`Rule`.
+    def match_hot_rules(self, adapter):
+        """Matches the path bound to a URL adapter against the most matched
+        rules, selected when ``url_adaptive`` is enabled. These rules can't
+        match the same paths as any rule that comes before them in the map,
+        so a match is the same one the map would return.
 
-        :param app:
-            A :class:`Tipfy` instance.
-        :param request:
-            A :class:`Request` instance.
-        :param match:
-            A tuple ``(rule, kwargs)``, resulted from the matched URL.
-        :param method:
-            Handler method to be called. In cases like exception handling, a
-            method can be forced instead of using the request method.
+        :param adapter:
+            A ``werkzeug.routing.MapAdapter`` bound to the current request.
+        :returns:
+            A tuple ``(rule, rule_args)`` or None if the path must be matched
+            normally.
         """
-        method = method or request.method.lower().replace('-', '_')
-        rule, kwargs = match
-
-        if isinstance(rule.handler, basestring):
-            if rule.handler not in self.handlers:
-                # Import handler set in matched rule. This can raise an
-                # ImportError or AttributeError if the handler is badly
-                # defined. The exception will be caught in the WSGI app.
-                self.handlers[rule.handler] = import_string(rule.handler)
+        path_info = adapter.path_info
+        if not isinstance(path_info, unicode):
+            path_info = path_info.decode(self.map.charset, 'ignore')
 
-            rule.handler = self.handlers[rule.handler]
+        path = u'%s|/%s' % (adapter.subdomain, path_info.lstrip(u'/'))
+        for rule in self.hot_rules:
+            try:
+                rv = rule.match(path)
+            except RequestSlash:
+                return None
 
-        # Instantiate handler.
-        handler = rule.handler(app, request)
-        try:
-            # Dispatch the requested method.
-            return handler(method, **kwargs)
-        except Exception, e:
-            if method == 'handle_exception':
-                # We are already handling an exception.
-                raise
+            if rv is not None:
+                if rule.methods is None or \
+                    adapter.default_method.upper() in rule.methods:
+                    return rule, rv
 
-            # If the handler implements exception handling, let it handle it.
-            return handler.handle_exception(exception=e, debug=self.app.debug)
+                return None
 
-    def build(self, request, name, kwargs):
-        """Returns a URL for a named :class:`Rule`. This is the central place
-        to build URLs for an app. It is used by :meth:`RequestHandler.url_for`,
-        :meth:`Tipfy.url_for and the standalone function :func:`url_for`.
-        Those functions conveniently pass the current request object so you
-        don't have to.
+    def count_hit(self, rule):
+        """Counts a match for a rule. When ``url_adaptive`` is enabled, the
+        rules tested first are updated periodically. Counters are not
+        locked, so some hits may be lost when requests are served by
+        multiple threads.
 
-        :param request:
-            The current request object.
-        :param name:
-            The rule name.
-        :param kwargs:
-            Values to build the URL. All variables not set in the rule
-            default values must be passed and must conform to the format set
-            in the rule. Extra keywords are appended as query arguments.
+        :param rule:
+            The matched :class:`Rule`.
+        :returns:
+            None.
+        """
+        self.hits[rule] = self.hits.get(rule, 0) + 1
+        self.hits_total += 1
+        if self.use_adaptive and \
+            self.hits_total % self.hot_rules_interval == 0:
+            self.update_hot_rules()
 
-            A few keywords have special meaning:
+    def update_hot_rules(self):
+        """Selects the most matched rules to be tested first. Only rules with
+        converters and that can't match the same paths as any rule before
+        them in the map are selected.
+
+        :returns:
+            None.
+        """
+        hot_rules = []
+        hits = sorted(self.hits.items(), key=lambda item: item[1],
+            reverse=True)
+        for rule, count in hits:
+            if len(hot_rules) >= self.max_hot_rules:
+                break
+
+            disjoint = self.disjoint_rules.get(rule)
+            if disjoint is None:
+                disjoint = self.disjoint_rules[rule] = self.is_disjoint(rule)
+
+            if disjoint:
+                hot_rules.append(rule)
+
+        self.hot_rules = hot_rules
+
+    def is_disjoint(self, rule):
+        """Checks if a rule can be tested before all others: it must not
+        redirect, and must not be able to match the same paths as any rule
+        before it in the map.
+
+        :param rule:
+            A :class:`Rule` from the map.
+        :returns:
+            True if the rule can be tested first, False otherwise.
+        """
+        map = self.map
+        if not rule._converters or rule.build_only or rule.redirect_to:
+            return False
+
+        if map.redirect_defaults:
+            for r in map._rules_by_endpoint.get(rule.endpoint, ()):
+                if r.provides_defaults_for(rule):
+                    return False
+
+        patterns = get_rule_patterns(rule)
+        for r in map._rules:
+            if r is rule:
+                return True
+
+            if not r.build_only and patterns_overlap(get_rule_patterns(r),
+                patterns):
+                return False
+
+        # The rule is no longer in the map.
+        return False
+
+    def stats(self):
+        """Returns the number of matches for each rule name, counted while
+        ``url_stats`` or ``url_adaptive`` are enabled.
+
+        :returns:
+            A dictionary of match counts keyed by rule name.
+        """
+        stats = {}
+        for rule, count in self.hits.items():
+            stats[rule.endpoint] = stats.get(rule.endpoint, 0) + count
+
+        return stats
+
+    def reset_stats(self):
+        """Resets the match counters and the rules tested first.
+
+        :returns:
+            None.
+        """
+        self.hits = {}
+        self.hits_total = 0
+        self.hot_rules = []
+
+    def match_cached(self, adapter, method):
+        """Matches the path bound to a URL adapter using the match cache.
+        Matched rules and ``NotFound`` or ``MethodNotAllowed`` results are
+        cached; redirects are not, as they may be built dynamically.
+
+        :param adapter:
+            A ``werkzeug.routing.MapAdapter`` bound to the current request.
+        :param method:
+            The request method, in upper case.
+        :returns:
+            A tuple ``(rule, rule_args)``.
+        """
+        key = (method, adapter.url_scheme, adapter.server_name,
+            adapter.subdomain, adapter.script_name, adapter.path_info)
+        cached = self.match_cache.get(key)
+        if cached is not None:
+            rule, value = cached
+            if rule is not None:
+                return rule, dict(value)
+            elif value is None:
+                raise NotFound()
+            else:
+                raise MethodNotAllowed(valid_methods=list(value))
+
+        try:
+            rule, rule_args = self.match_rules(adapter)
+        except MethodNotAllowed, e:
+            self.match_cache.set(key, (None, tuple(e.valid_methods)))
+            raise
+        except NotFound:
+            self.match_cache.set(key, (None, None))
+            raise
+
+        self.match_cache.set(key, (rule, dict(rule_args)))
+        return rule, rule_args
+
+    def get_adapter(self, request):
+        """Returns a URL adapter bound to the current request. Binding the map
+        requires parsing the host, script name and subdomain from the WSGI
+        environment, so the result is cached and each request gets a copy of
+        the cached adapter set to its own path and method.
+
+        :param request:
+            A :class:`Request` instance.
+        :returns:
+            A ``werkzeug.routing.MapAdapter`` instance.
+        """
+        environ = request.environ
+        key = (self.get_server_name(), environ.get('HTTP_HOST'),
+            environ.get('SERVER_NAME'), environ.get('SERVER_PORT'),
+            environ.get('SCRIPT_NAME'), environ.get('wsgi.url_scheme'))
+
+        adapter = self.adapters.get(key)
+        if adapter is None:
+            adapter = self.map.bind_to_environ(environ, server_name=key[0])
+            if len(self.adapters) >= self.max_adapters:
+                self.adapters.clear()
+
+            self.adapters[key] = adapter
+
+        return MapAdapter(self.map, adapter.server_name, adapter.script_name,
+            adapter.subdomain, adapter.url_scheme, environ.get('PATH_INFO'),
+            environ['REQUEST_METHOD'])
+
+    def match_static(self, adapter, method):
+        """Looks up the path bound to a URL adapter in the table of rules
+        without converters.
+
+        :param adapter:
+            A ``werkzeug.routing.MapAdapter`` bound to the current request.
+        :param method:
+            The request method, in upper case.
+        :returns:
+            A tuple ``(rule, rule_args)`` or None if the path is not in the
+            table. In this case the path must be matched normally.
+        """
+        path_info = adapter.path_info
+        if not isinstance(path_info, unicode):
+            path_info = path_info.decode(self.map.charset, 'ignore')
+
+        rule = self.get_static_rules().get((adapter.subdomain, method,
+            u'/' + path_info.lstrip(u'/')))
+        if rule is not None:
+            return rule, dict(rule.defaults or ())
+
+    def get_static_rules(self):
+        """Returns a dictionary of rules without converters keyed by
+        ``(subdomain, method, path)``, building it if needed. A rule is only
+        added for the methods it would also be matched by
+        ``MapAdapter.match()``: rules that redirect, rules with a rule
+        providing defaults for them and rules preceded by other rules that
+        match the same path are left to be matched normally.
+
+        :returns:
+            A dictionary of :class:`Rule` instances.
+        """
+        if self.static_rules is not None:
+            return self.static_rules
+
+        map = self.map
+        trie = self.get_trie()
+        rules = {}
+        for rule in map._rules:
+            if rule._converters or rule.build_only or rule.redirect_to:
+                continue
+
+            if map.redirect_defaults and [r for r in
+                map._rules_by_endpoint[rule.endpoint] if
+                r.provides_defaults_for(rule)]:
+                continue
+
+            subdomain, path = rule.subdomain, rule.rule
+            if isinstance(subdomain, str):
+                subdomain = subdomain.decode(map.charset)
+
+            if isinstance(path, str):
+                path = path.decode(map.charset)
+
+            # Methods taken by rules that come first in the map.
+            blocked = set()
+            for candidate in trie.get_candidates(subdomain, path):
+                if candidate is rule:
+                    break
+
+                try:
+                    if candidate.match(u'%s|%s' % (subdomain, path)) is None:
+                        continue
+                except RequestSlash:
+                    # Redirects to add a trailing slash for any method.
+                    blocked.update(ALLOWED_METHODS)
+                    break
+
+                blocked.update(candidate.methods or ALLOWED_METHODS)
+
+            for method in (rule.methods or ALLOWED_METHODS):
+                if method not in blocked:
+                    rules.setdefault((subdomain, method, path), rule)
+
+        self.static_rules = rules
+        return rules
+
+    def get_trie(self):
+        """Returns the :class:`RuleTrie` for the URL map, building it if it
+        was not built yet or if rules were added since the last build.
+
+        :returns:
+            A :class:`RuleTrie` instance.
+        """
+        if self.trie is None:
+            self.trie = RuleTrie(self.map)
+
+        return self.trie
+
+    def get_builder(self, name):
+        """Returns the :class:`UrlBuilder` for a rule name, compiling it if it
+        was not compiled yet or if rules were added since then. If the name
+        is unknown, apps not loaded yet are loaded.
+
+        :param name:
+            The rule name.
+        :returns:
+            A :class:`UrlBuilder` instance.
+        """
+        builder = self.builders.get(name)
+        if builder is None:
+            if self.lazy_apps and name not in self.map._rules_by_endpoint:
+                self.load_apps()
+
+            builder = self.builders[name] = UrlBuilder(self.map, name)
+
+        return builder
+
+    def dispatch_with_hooks(self, app, request, match):
+        """Dispatches a request wrapped by the ``pre_dispatch_handler`` and
+        ``post_dispatch_handler`` app middleware.
+
+        .. seealso:: :meth:`MiddlewareFactory.compile_app_pipeline`.
+
+        :param app:
+            A :class:`Tipfy` instance.
+        :param request:
+            A :class:`Request` instance.
+        :param match:
+            A tuple ``(rule, kwargs)``, resulted from the matched URL.
+        :returns:
+            A :class:`Response` instance.
+        """
+        return app.dispatch_pipeline(app, request, match)
+
+    def dispatch(self, app, request, match, method=None):
+        """Dispatches a request. This calls the :class:`RequestHandler` from
+        the matched :class:`Rule`.
+
+        :param app:
+            A :class:`Tipfy` instance.
+        :param request:
+            A :class:`Request` instance.
+        :param match:
+            A tuple ``(rule, kwargs)``, resulted from the matched URL.
+        :param method:
+            Handler method to be called. In cases like exception handling, a
+            method can be forced instead of using the request method.
+        """
+        if method is None and self.use_coalesce and request.method == 'GET':
+            return self.dispatch_coalesced(app, request, match)
+
+        method = method or request.method.lower().replace('-', '_')
+        rule, kwargs = match
+
+        handler_class = self.rule_handlers.get(rule)
+        if handler_class is None:
+            handler_class = self.get_handler(rule)
+
+        # Instantiate handler.
+        handler = handler_class(app, request)
+        try:
+            # Dispatch the requested method.
+            return handler(method, **kwargs)
+        except Exception, e:
+            if method == 'handle_exception':
+                # We are already handling an exception.
+                raise
+
+            # If the handler implements exception handling, let it handle it.
+            return handler.handle_exception(exception=e, debug=self.app.debug)
+
+    def dispatch_coalesced(self, app, request, match):
+        """Dispatches a ``GET`` request once for all concurrent requests
+        with the same coalesce key. The first request calls the handler, and
+        the others wait for its response and receive a copy of it. Followers
+        are dispatched on their own if the response is not successful (2xx
+        or 3xx), is streamed, sets a cookie, isn't ready within
+        ``coalesce_timeout`` or if the handler raised an exception.
+
+        :param app:
+            A :class:`Tipfy` instance.
+        :param request:
+            A :class:`Request` instance.
+        :param match:
+            A tuple ``(rule, kwargs)``, resulted from the matched URL.
+        :returns:
+            A ``Response`` instance.
+        """
+        key = self.coalesce_key(request)
+        if key is None:
+            return self.dispatch(app, request, match, method='get')
+
+        self.flights_lock.acquire()
+        try:
+            future = self.flights.get(key)
+            leader = future is None
+            if leader:
+                future = self.flights[key] = Future()
+        finally:
+            self.flights_lock.release()
+
+        if not leader:
+            if future.wait(self.coalesce_timeout) and \
+                future.value is not None:
+                status, headers, body = future.value
+                return app.response_class(body, status=status,
+                    headers=headers)
+
+            return self.dispatch(app, request, match, method='get')
+
+        result = None
+        try:
+            response = self.dispatch(app, request, match, method='get')
+            # Errors may be transient or caused by the request itself.
+            if 200 <= response.status_code < 400 and \
+                not response.is_streamed and \
+                'set-cookie' not in response.headers:
+                result = (response.status_code, list(response.headers),
+                    response.data)
+
+            return response
+        finally:
+            self.flights_lock.acquire()
+            try:
+                del self.flights[key]
+            finally:
+                self.flights_lock.release()
+
+            future.set_result(result)
+
+    def get_handler(self, rule):
+        """Returns the handler class for a rule, importing it if it is set as
+        a string. Imports happen once, holding the router lock, and handlers
+        for rules in the URL map are stored in :attr:`rule_handlers`, so that
+        :meth:`dispatch` can read them without locking. The rule itself is
+        not changed.
+
+        :param rule:
+            A :class:`Rule`.
+        :returns:
+            A :class:`RequestHandler` class.
+        """
+        handler = rule.handler
+        if isinstance(handler, basestring):
+            handler_class = self.handlers.get(handler)
+            if handler_class is None:
+                self.lock.acquire()
+                try:
+                    handler_class = self.handlers.get(handler)
+                    if handler_class is None:
+                        # Import handler set in matched rule. This can raise
+                        # an ImportError or AttributeError if the handler is
+                        # badly defined. The exception will be caught in the
+                        # WSGI app.
+                        handler_class = import_string(handler)
+                        self.handlers[handler] = handler_class
+                finally:
+                    self.lock.release()
+
+            handler = handler_class
+
+        if rule.map is self.map:
+            # Rules built on the fly (e.g., for error handlers) are not
+            # stored.
+            self.rule_handlers[rule] = handler
+
+        return handler
+
+    def build(self, request, name, kwargs):
+        """Returns a URL for a named :class:`Rule`. This is the central place
+        to build URLs for an app. It is used by :meth:`RequestHandler.url_for`,
+        :meth:`Tipfy.url_for and the standalone function :func:`url_for`.
+        Those functions conveniently pass the current request object so you
+        don't have to.
+
+        :param request:
+            The current request object.
+        :param name:
+            The rule name.
+        :param kwargs:
+            Values to build the URL. All variables not set in the rule
+            default values must be passed and must conform to the format set
+            in the rule. Extra keywords are appended as query arguments.
+
+            A few keywords have special meaning:
 
             - **_full**: If True, builds an absolute URL.
             - **_method**: Uses a rule defined to handle specific request
@@ -779,8 +2240,8 @@ class Router(object):
         if scheme or netloc:
             full = False
 
-        url = request.url_adapter.build(name, values=kwargs, method=method,
-            force_external=full)
+        url = self.get_builder(name).build(request.url_adapter, kwargs,
+            method=method, force_external=full)
 
         if scheme or netloc:
             url = '%s://%s%s' % (scheme or 'http', netloc or request.host, url)
@@ -790,6 +2251,57 @@ class Router(object):
 
         return url
 
+    def build_many(self, request, name, iterable):
+        """Returns a generator of URLs for a named :class:`Rule`, one for each
+        dictionary of values in an iterable. This is equivalent to calling
+        :meth:`build` for each item, but the URL builder and adapter are
+        looked up only once, which is faster for long listings::
+
+            urls = app.router.build_many(request, 'entity-show',
+                ({'id': entity.id} for entity in entities))
+
+        :param request:
+            The current request object.
+        :param name:
+            The rule name.
+        :param iterable:
+            An iterable of dictionaries with values to build the URLs. The
+            dictionaries are not changed. The special keywords accepted by
+            :meth:`build` can be set in each dictionary.
+        :returns:
+            A generator of absolute or relative URLs.
+        """
+        build = self.get_builder(name).build
+        adapter = request.url_adapter
+
+        for kwargs in iterable:
+            if '_full' in kwargs or '_method' in kwargs or \
+                '_scheme' in kwargs or '_netloc' in kwargs or \
+                '_anchor' in kwargs:
+                kwargs = dict(kwargs)
+                full = kwargs.pop('_full', False)
+                method = kwargs.pop('_method', None)
+                scheme = kwargs.pop('_scheme', None)
+                netloc = kwargs.pop('_netloc', None)
+                anchor = kwargs.pop('_anchor', None)
+            else:
+                yield build(adapter, kwargs)
+                continue
+
+            if scheme or netloc:
+                full = False
+
+            url = build(adapter, kwargs, method=method, force_external=full)
+
+            if scheme or netloc:
+                url = '%s://%s%s' % (scheme or 'http', netloc or request.host,
+                    url)
+
+            if anchor:
+                url += '#%s' % url_quote(anchor)
+
+            yield url
+
     def get_server_name(self):
         """Returns the server name used to bind the URL map. By default it
         returns the configured server name. Extend this if you want to
@@ -824,20 +2336,182 @@ class Router(object):
             # Load rules from urls.py.
             rules = 'urls.get_rules'
 
+        snapshot = None
         if isinstance(rules, basestring):
+            snapshot = self.app.config.get('tipfy', 'url_map_snapshot')
+            if snapshot:
+                map = self.load_snapshot(snapshot, rules)
+                if map is not None:
+                    return map
+
+                # Track the modules imported to build the rules.
+                modules = set(sys.modules)
+
+            name = rules
             rules = import_string(rules, silent=True)
             if not rules:
                 logging.warning('Missing %s. No URL rules were loaded.' %
-                    rules)
+                    name)
 
         if callable(rules):
             rules = rules(self.app)
 
-        return Map(rules, default_subdomain=self.get_default_subdomain())
+        map = Map(rules, default_subdomain=self.get_default_subdomain())
+
+        if snapshot:
+            modules = set(sys.modules) - modules
+            modules.add(name.replace(':', '.').rsplit('.', 1)[0])
+            self.save_snapshot(snapshot, name, map, modules)
+
+        return map
+
+    def get_snapshot_key(self, rules):
+        """Returns a key that identifies a URL map snapshot for the current
+        configuration. A snapshot saved with a different key is not loaded.
+        The key includes the configuration read to build the rules: the
+        default subdomain and the installed apps, and whether they are loaded
+        on demand, as their rules are then left out of the map.
+
+        :param rules:
+            The string defining the callable that returns the rules.
+        :returns:
+            A string key.
+        """
+        config = self.app.config
+        return hashlib.md5(repr((
+            __version__,
+            rules,
+            self.get_default_subdomain(),
+            config.get('tipfy', 'apps_installed'),
+            sorted(config.get('tipfy', 'apps_entry_points').items()),
+            bool(config.get('tipfy', 'apps_lazy_load')),
+        ))).hexdigest()
+
+    def load_snapshot(self, path, rules):
+        """Loads a URL map from a snapshot saved by :meth:`save_snapshot`.
+
+        :param path:
+            Path to the snapshot file.
+        :param rules:
+            The string defining the callable that returns the rules.
+        :returns:
+            A ``werkzeug.routing.Map`` instance, or None if the snapshot
+            doesn't exist or is not valid for the configuration or the
+            current source files.
+        """
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        try:
+            try:
+                header = pickle.load(f)
+                if header['key'] != self.get_snapshot_key(rules):
+                    return None
+
+                for source, digest in header['sources']:
+                    filename = find_module_source(source)
+                    if filename is None or get_file_hash(filename) != digest:
+                        return None
+
+                return pickle.load(f)
+            except Exception, e:
+                logging.warning('Failed to load URL map snapshot %s: %s' %
+                    (path, e))
+                return None
+        finally:
+            f.close()
+
+    def save_snapshot(self, path, rules, map, modules):
+        """Saves a URL map to a snapshot file, to be loaded by
+        :meth:`load_snapshot`. Errors are logged and ignored, as the file
+        system may be read-only.
+
+        :param path:
+            Path to the snapshot file.
+        :param rules:
+            The string defining the callable that returns the rules.
+        :param map:
+            The ``werkzeug.routing.Map`` instance to be saved.
+        :param modules:
+            Names of the modules used to build the rules. The snapshot is only
+            valid while their source files don't change.
+        :returns:
+            True if the snapshot was saved, False otherwise.
+        """
+        # Werkzeug's routing is also a source: upgrades invalidate snapshots.
+        # Paths are relative to sys.path, so that the snapshot can be built
+        # in a different directory than the one it is deployed to.
+        sources = []
+        for name in sorted(set(modules) | set(['werkzeug.routing'])):
+            filename = getattr(sys.modules.get(name), '__file__', None)
+            if not filename:
+                continue
+
+            if filename.endswith(('.pyc', '.pyo')):
+                filename = filename[:-1]
+
+            if os.path.isfile(filename):
+                sources.append((get_module_source(name, filename),
+                    get_file_hash(filename)))
+
+        header = {
+            'key':     self.get_snapshot_key(rules),
+            'sources': sources,
+        }
+
+        # Bind and sort the rules before they are saved.
+        map.update()
+
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            f = open(tmp_path, 'wb')
+            try:
+                pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(map, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+
+            os.rename(tmp_path, path)
+            return True
+        except Exception, e:
+            logging.debug('Failed to save URL map snapshot %s: %s' %
+                (path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+            return False
+
+
+class TipfyMeta(type):
+    """Metaclass for :class:`Tipfy`. It stores the active app and request set
+    in ``Tipfy.app`` and ``Tipfy.request`` in context-local storage, so that
+    each thread serves its own request. When no app was set in the current
+    thread, ``Tipfy.app`` is the last initialized app.
+    """
+    def _get_app(cls):
+        return getattr(_local, 'app', Tipfy.default_app)
+
+    def _set_app(cls, app):
+        _local.app = app
+
+    def _get_request(cls):
+        return getattr(_local, 'request', None)
+
+    def _set_request(cls, request):
+        _local.request = request
+
+    app = property(_get_app, _set_app)
+    request = property(_get_request, _set_request)
 
 
 class Tipfy(object):
     """The WSGI application."""
+    __metaclass__ = TipfyMeta
     #: Default class for requests.
     request_class = Request
     #: Default class for responses.
@@ -846,10 +2520,9 @@ class Tipfy(object):
     config_class = Config
     #: Default class for the configuration object.
     router_class = Router
-    #: The active :class:`Tipfy` instance.
-    app = None
-    #: The active :class:`Request` instance.
-    request = None
+    #: The last initialized :class:`Tipfy` instance. The active app is
+    #: ``Tipfy.app``.
+    default_app = None
 
     def __init__(self, rules=None, config=None, debug=False):
         """Initializes the application.
@@ -868,7 +2541,7 @@ class Tipfy(object):
             config = _rules
             rules = _config
 
-        Tipfy.app = self
+        Tipfy.app = Tipfy.default_app = self
         self.debug = debug
         self.registry = {}
         self.error_handlers = {}
@@ -894,6 +2567,11 @@ class Tipfy(object):
         for func in self.middleware.get('post_make_app', []):
             func(self)
 
+        # Compile the pre_dispatch_handler and post_dispatch_handler
+        # middleware around the router dispatch.
+        self.dispatch_pipeline = self.middleware_factory.compile_app_pipeline(
+            self.middleware)
+
     def __call__(self, environ, start_response):
         """Shortcut for :meth:`Tipfy.wsgi_app`."""
         return self.wsgi_app(environ, start_response)
@@ -943,7 +2621,7 @@ class Tipfy(object):
                 response = InternalServerError()
         finally:
             if cleanup:
-                Tipfy.app = Tipfy.request = None
+                release_local(_local)
 
         return response(environ, start_response)
 
@@ -1002,6 +2680,16 @@ class Tipfy(object):
         """
         return self.config.get_or_load(module, key=key, default=default)
 
+    @property
+    def app(self):
+        """The active :class:`Tipfy` instance in the current thread."""
+        return Tipfy.app
+
+    @property
+    def request(self):
+        """The active :class:`Request` instance in the current thread."""
+        return Tipfy.request
+
     def get_middleware(self, obj, classes):
         """Returns a dictionary of all middleware instance methods for a given
         object.
@@ -1026,6 +2714,135 @@ class Tipfy(object):
         """
         return self.router.build(self.request, _name, kwargs)
 
+    def get_process_pool(self):
+        """Returns the app's process pool, stored in the registry and created
+        on first use with the size set in the ``process_pool_size`` config
+        key. Call it when the app starts to fork the worker processes before
+        any request is served. The pool is closed when the interpreter exits.
+
+        :returns:
+            A ``multiprocessing.Pool`` instance.
+        """
+        pool = self.registry.get('process_pool')
+        if pool is None:
+            if multiprocessing is None:
+                raise NotImplementedError('Process pools require the '
+                    'multiprocessing module.')
+
+            _process_pool_lock.acquire()
+            try:
+                pool = self.registry.get('process_pool')
+                if pool is None:
+                    pool = self.registry['process_pool'] = \
+                        multiprocessing.Pool(self.config.get('tipfy',
+                        'process_pool_size'), init_process, (self,))
+                    atexit.register(self.close_process_pool)
+            finally:
+                _process_pool_lock.release()
+
+        return pool
+
+    def close_process_pool(self):
+        """Closes the app's process pool, if it was created, waiting for
+        the pending handler methods to finish.
+        """
+        _process_pool_lock.acquire()
+        try:
+            pool = self.registry.pop('process_pool', None)
+        finally:
+            _process_pool_lock.release()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def get_thread_pool(self):
+        """Returns the app's :class:`ThreadPool`, stored in the registry and
+        created on first use with the sizes set in the ``thread_pool_size``
+        and ``thread_pool_queue_size`` config keys.
+
+        :returns:
+            A :class:`ThreadPool` instance.
+        """
+        pool = self.registry.get('thread_pool')
+        if pool is None:
+            # Threads are started on first use, so a pool discarded by a
+            # concurrent call doesn't leak any.
+            pool = self.registry.setdefault('thread_pool', ThreadPool(
+                self.config.get('tipfy', 'thread_pool_size'),
+                self.config.get('tipfy', 'thread_pool_queue_size')))
+
+        return pool
+
+    def warmup(self):
+        """Imports the handlers of all rules in the URL map and the middleware
+        they use, and builds the router lookup tables, so that the first
+        requests after a cold start don't have to. Handlers of apps not loaded
+        yet because of ``apps_lazy_load`` are not imported.
+
+        Imports are done one at a time, as the Python import lock doesn't
+        allow them to run in parallel. Handlers that fail to import are logged
+        and skipped.
+
+        .. seealso:: :class:`WarmupHandler`.
+
+        :returns:
+            A list of tuples ``(module, seconds)`` with the import time of
+            each module imported during warmup, slowest first.
+        """
+        timings = []
+
+        def load(spec, func, *args):
+            module = None
+            if isinstance(spec, basestring):
+                if ':' in spec:
+                    module = spec.split(':', 1)[0]
+                else:
+                    module = spec.rsplit('.', 1)[0]
+
+                if module in sys.modules:
+                    module = None
+
+            start = time.time()
+            try:
+                rv = func(*args)
+            except (ImportError, AttributeError), e:
+                logging.warning('Failed to import %s: %s' % (spec, e))
+                return None
+
+            if module is not None and module in sys.modules:
+                timings.append((module, time.time() - start))
+
+            return rv
+
+        router = self.router
+        handler_classes = []
+        for rule in router.map._rules:
+            if rule.build_only or rule.redirect_to is not None:
+                continue
+
+            handler_class = load(rule.handler, router.get_handler, rule)
+            if handler_class is not None and \
+                handler_class not in handler_classes:
+                handler_classes.append(handler_class)
+
+        factory = self.middleware_factory
+        for handler_class in handler_classes:
+            specs = getattr(handler_class, 'plugins', None) or \
+                getattr(handler_class, 'middleware', None) or ()
+            for spec in specs:
+                load(spec, factory.load_middleware, [spec])
+
+        # This also builds the trie.
+        router.get_static_rules()
+
+        timings.sort(key=lambda timing: timing[1], reverse=True)
+        for module, seconds in timings:
+            logging.info('Warmup: imported %s in %.1fms.' % (module,
+                seconds * 1000))
+
+        return timings
+
     def get_test_client(self):
         """Creates a test client for this application.
 
@@ -1058,6 +2875,47 @@ class Tipfy(object):
 
         CGIHandler().run(self)
 
+    def make_server(self, host='127.0.0.1', port=8080, threaded=True,
+        processes=1):
+        """Returns a WSGI server for this app, to run it outside of App
+        Engine. By default each request is handled in its own thread, so a
+        request waiting for a backend doesn't block the other ones. The
+        current app and request are context-local, so handlers and middleware
+        must only keep per-request state in the handler or the request.
+
+        :param host:
+            The host to bind to.
+        :param port:
+            The port to bind to. If 0, a free port is chosen and can be read
+            from the ``server_port`` attribute of the returned server.
+        :param threaded:
+            True to handle each request in a new thread.
+        :param processes:
+            Number of processes to fork to handle requests, if not threaded.
+        :returns:
+            A ``werkzeug.serving.BaseWSGIServer`` instance.
+        """
+        from werkzeug.serving import make_server
+        return make_server(host, port, self, threaded=threaded,
+            processes=processes, passthrough_errors=self.debug)
+
+    def serve(self, host='127.0.0.1', port=8080, threaded=True, processes=1):
+        """Serves the app until the process is interrupted, using the server
+        returned by :meth:`make_server`::
+
+            if __name__ == '__main__':
+                app.serve(port=8080)
+
+        The arguments are the same as in :meth:`make_server`.
+        """
+        server = self.make_server(host, port, threaded=threaded,
+            processes=processes)
+        logging.info('Serving on http://%s:%d/' % (host, server.server_port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
     @cached_property
     def dev(self):
         """True is the app is using the dev server, False otherwise."""
@@ -1085,13 +2943,428 @@ def get_config(module, key=None, default=REQUIRED_VALUE):
 def get_valid_methods(handler):
     """Returns a list of HTTP methods supported by a handler.
 
+    .. seealso:: :meth:`RequestHandler.get_method_table`.
+
     :param handler:
         A :class:`RequestHandler` instance.
     :returns:
         A list of HTTP methods supported by the handler.
     """
-    return [method for method in ALLOWED_METHODS if
-        getattr(handler, method.lower().replace('-', '_'), None)]
+    return list(handler.get_method_table()[1])
+
+
+def run_in_process(func):
+    """A decorator for CPU-bound :class:`RequestHandler` methods, to execute
+    them in the app's process pool instead of the thread serving the
+    request::
+
+        class ThumbnailHandler(RequestHandler):
+            @run_in_process
+            def post(self, **kwargs):
+                return Response(make_thumbnail(self.request.data))
+
+    In the worker process, the method receives a new handler instance with a
+    request built from the string values of the WSGI environment and the
+    request body, so the body must not be read before the method is called.
+    Only the status, headers and body of the returned response are sent
+    back. The handler class must be importable by its module and name.
+
+    If the method doesn't finish within the ``process_pool_timeout`` config
+    value, a ``503 Service Unavailable`` response is returned.
+
+    :param func:
+        The handler method to decorate.
+    :returns:
+        The decorated method.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        request = self.request
+        environ = dict((key, value) for key, value in
+            request.environ.iteritems() if isinstance(value, (basestring,
+            int, long, float, bool, tuple)))
+        length = int(request.environ.get('CONTENT_LENGTH') or 0)
+        if length:
+            body = request.input_stream.read(length)
+        else:
+            body = ''
+
+        result = self.app.get_process_pool().apply_async(run_handler_method,
+            (self.__class__, func.__name__, environ, body, args, kwargs))
+        try:
+            status, headers, data = result.get(self.app.config.get('tipfy',
+                'process_pool_timeout'))
+        except multiprocessing.TimeoutError:
+            logging.warning('Handler method %s.%s timed out in the process '
+                'pool.' % (self.__class__.__name__, func.__name__))
+            raise ServiceUnavailable()
+
+        return self.app.response_class(data, status=status, headers=headers)
+
+    wrapper.process_func = func
+    return wrapper
+
+
+def run_handler_method(handler_class, name, environ, body, args, kwargs):
+    """Executes a handler method decorated with :func:`run_in_process` in a
+    worker process.
+
+    :param handler_class:
+        A :class:`RequestHandler` class.
+    :param name:
+        Name of the decorated method.
+    :param environ:
+        A WSGI environment without the input and error streams.
+    :param body:
+        The request body.
+    :param args:
+        Positional arguments for the method.
+    :param kwargs:
+        Keyword arguments from the matched :class:`Rule`.
+    :returns:
+        A tuple ``(status, headers, body)`` for the returned response.
+    """
+    environ['wsgi.input'] = StringIO(body)
+    environ['wsgi.errors'] = sys.stderr
+    app = Tipfy.app
+    Tipfy.request = request = app.request_class(environ)
+    try:
+        handler = handler_class(app, request)
+        func = getattr(handler_class, name).process_func
+        try:
+            response = func(handler, *args, **kwargs)
+        except HTTPException, e:
+            response = e.get_response(environ)
+
+        return response.status_code, list(response.headers), response.data
+    finally:
+        release_local(_local)
+
+
+def init_process(app):
+    """Sets the active app in a worker process of the app's process pool.
+
+    :param app:
+        A :class:`Tipfy` instance.
+    """
+    Tipfy.default_app = app
+    release_local(_local)
+
+
+def wait_futures(futures, timeout=None):
+    """Waits for futures to finish, up to a deadline.
+
+    :param futures:
+        A list of :class:`Future` instances.
+    :param timeout:
+        Maximum number of seconds to wait for all futures, or None to wait
+        until all are done.
+    :returns:
+        A tuple ``(done, not_done)`` with lists of finished and pending
+        futures, in the given order.
+    """
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    for future in futures:
+        if timeout is None:
+            future.wait()
+        elif not future.wait(max(deadline - time.time(), 0)):
+            break
+
+    done = []
+    not_done = []
+    for future in futures:
+        if future.done():
+            done.append(future)
+        else:
+            not_done.append(future)
+
+    return done, not_done
+
+
+def get_coalesce_key(request):
+    """Returns the default key to coalesce a request, used when the
+    ``coalesce_requests`` config is enabled. Requests are grouped by host,
+    path and query, and only with requests sending the same cookies and
+    credentials, so that personalized responses aren't shared.
+
+    :param request:
+        A :class:`Request` instance.
+    :returns:
+        A tuple.
+    """
+    environ = request.environ
+    return (environ.get('HTTP_HOST'), environ.get('PATH_INFO'),
+        environ.get('QUERY_STRING'), environ.get('HTTP_COOKIE'),
+        environ.get('HTTP_AUTHORIZATION'))
+
+
+def get_file_hash(filename):
+    """Returns the MD5 digest of a file's contents.
+
+    :param filename:
+        Path to the file.
+    :returns:
+        The hex digest, or None if the file can't be read.
+    """
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+
+    try:
+        return hashlib.md5(f.read()).hexdigest()
+    finally:
+        f.close()
+
+
+def get_module_source(name, filename):
+    """Returns the path of a module's source file relative to the
+    ``sys.path`` entry it is imported from, e.g., ``'werkzeug/routing.py'``.
+
+    :param name:
+        The module name.
+    :param filename:
+        Path to the module's source file.
+    :returns:
+        The relative path, using ``/`` as separator.
+    """
+    parts = name.split('.')
+    if os.path.basename(filename) == '__init__.py':
+        parts.append('__init__')
+
+    return '/'.join(parts) + '.py'
+
+
+def find_module_source(source):
+    """Finds a module's source file in the ``sys.path`` entries, in the
+    same order used by imports.
+
+    :param source:
+        The relative path returned by :func:`get_module_source`.
+    :returns:
+        The path to the source file, or None if it was not found.
+    """
+    path = os.path.join(*source.split('/'))
+    for entry in sys.path:
+        filename = os.path.join(entry or os.curdir, path)
+        if os.path.isfile(filename):
+            return filename
+
+
+def is_segment_converter(converter):
+    """Returns True if a rule converter can only match inside a single path
+    segment, i.e., its regular expression never matches a slash.
+
+    :param converter:
+        A ``werkzeug.routing.BaseConverter`` instance.
+    :returns:
+        True if the converter never matches a slash, False otherwise.
+    """
+    regex = converter.regex
+    if regex in (IntegerConverter.regex, FloatConverter.regex):
+        return True
+
+    if type(converter) is AnyConverter:
+        return '/' not in regex
+
+    return _segment_regex_re.match(regex) is not None
+
+
+def get_rule_segments(rule):
+    """Splits the path of a bound :class:`Rule` in segments.
+
+    :param rule:
+        A :class:`Rule` bound to a map.
+    :returns:
+        A tuple ``(subdomain, segments, greedy)``. Subdomain is None if it
+        contains converters. Segments is a list of static path segments, and
+        segments with converters contain a ``\\x00`` placeholder for each
+        variable. Greedy is True if a converter that can match slashes
+        follows the returned segments.
+    """
+    charset = rule.map.charset
+    trace = rule._trace
+    if not rule.is_leaf:
+        # Werkzeug appends the trailing slash of branch rules to the trace.
+        trace = trace[:-1]
+
+    subdomain = []
+    path = None
+    greedy = False
+    for is_dynamic, data in trace:
+        if is_dynamic:
+            if path is None:
+                subdomain.append(_SEGMENT_VARIABLE)
+            elif is_segment_converter(rule._converters[data]):
+                path.append(_SEGMENT_VARIABLE)
+            else:
+                greedy = True
+                break
+        else:
+            if isinstance(data, str):
+                data = data.decode(charset)
+
+            if path is None and u'|' in data:
+                data, tail = data.split(u'|', 1)
+                subdomain.append(data)
+                path = [tail]
+            elif path is None:
+                subdomain.append(data)
+            else:
+                path.append(data)
+
+    subdomain = u''.join(subdomain)
+    if _SEGMENT_VARIABLE in subdomain:
+        subdomain = None
+
+    segments = u''.join(path).split(u'/')[1:]
+    if greedy:
+        # The last segment is where the greedy converter starts.
+        segments.pop()
+
+    return subdomain, segments, greedy
+
+
+def get_rule_patterns(rule):
+    """Returns the subdomain and path segment patterns that a bound
+    :class:`Rule` can match or redirect from. These are the same positions
+    where the rule is stored in a :class:`RuleTrie`.
+
+    :param rule:
+        A :class:`Rule` bound to a map.
+    :returns:
+        A tuple ``(subdomain, patterns)``. Subdomain is None if it contains
+        converters. Patterns is a list of tuples ``(segments, greedy)``, as
+        returned by :func:`get_rule_segments`.
+    """
+    subdomain, segments, greedy = get_rule_segments(rule)
+    patterns = [(segments, greedy)]
+    if not greedy and (not rule.is_leaf or not rule.strict_slashes):
+        # The rule also matches (or redirects from) the path with a
+        # trailing slash.
+        patterns.append((segments + [u''], False))
+
+    return subdomain, patterns
+
+
+def patterns_overlap(patterns1, patterns2):
+    """Checks if two rules may match the same path, given their patterns as
+    returned by :func:`get_rule_patterns`.
+
+    :param patterns1:
+        A tuple ``(subdomain, patterns)`` for a rule.
+    :param patterns2:
+        A tuple ``(subdomain, patterns)`` for another rule.
+    :returns:
+        False if the rules never match the same path, True otherwise.
+    """
+    subdomain1, patterns1 = patterns1
+    subdomain2, patterns2 = patterns2
+    if subdomain1 is not None and subdomain2 is not None and \
+        subdomain1 != subdomain2:
+        return False
+
+    for segments1, greedy1 in patterns1:
+        for segments2, greedy2 in patterns2:
+            if not greedy1 and not greedy2 and \
+                len(segments1) != len(segments2):
+                continue
+
+            if greedy1 and not greedy2 and len(segments2) < len(segments1):
+                continue
+
+            if greedy2 and not greedy1 and len(segments1) < len(segments2):
+                continue
+
+            for segment1, segment2 in zip(segments1, segments2):
+                if segment1 != segment2 and \
+                    _SEGMENT_VARIABLE not in segment1 and \
+                    _SEGMENT_VARIABLE not in segment2:
+                    break
+            else:
+                return True
+
+    return False
+
+
+def match_rules(adapter, rules, path_info, method):
+    """Matches a path against a list of rules. This is the same matching
+    algorithm used by ``MapAdapter.match()``, but only tests the given rules.
+
+    :param adapter:
+        A ``werkzeug.routing.MapAdapter`` bound to the current request.
+    :param rules:
+        A list of :class:`Rule` instances, in the map order.
+    :param path_info:
+        The path to match, as unicode.
+    :param method:
+        The request method, in upper case.
+    :returns:
+        A tuple ``(rule, rule_args)``.
+    """
+    map = adapter.map
+    charset = map.charset
+    path = u'%s|/%s' % (adapter.subdomain, path_info.lstrip('/'))
+    have_match_for = set()
+    for rule in rules:
+        try:
+            rv = rule.match(path)
+        except RequestSlash:
+            raise RequestRedirect(str('%s://%s%s%s/%s/' % (
+                adapter.url_scheme,
+                adapter.subdomain and adapter.subdomain + '.' or '',
+                adapter.server_name,
+                adapter.script_name[:-1],
+                url_quote(path_info.lstrip('/'), charset)
+            )))
+
+        if rv is None:
+            continue
+
+        if rule.methods is not None and method not in rule.methods:
+            have_match_for.update(rule.methods)
+            continue
+
+        if map.redirect_defaults:
+            for r in map._rules_by_endpoint[rule.endpoint]:
+                if r.provides_defaults_for(rule) and r.suitable_for(rv,
+                    method):
+                    rv.update(r.defaults)
+                    subdomain, path = r.build(rv)
+                    raise RequestRedirect(str('%s://%s%s%s/%s' % (
+                        adapter.url_scheme,
+                        subdomain and subdomain + '.' or '',
+                        adapter.server_name,
+                        adapter.script_name[:-1],
+                        url_quote(path.lstrip('/'), charset)
+                    )))
+
+        if rule.redirect_to is not None:
+            if isinstance(rule.redirect_to, basestring):
+                def _handle_match(match):
+                    value = rv[match.group(1)]
+                    return rule._converters[match.group(1)].to_url(value)
+
+                redirect_url = _variable_re.sub(_handle_match,
+                    rule.redirect_to)
+            else:
+                redirect_url = rule.redirect_to(adapter, **rv)
+
+            raise RequestRedirect(str(urlparse.urljoin('%s://%s%s%s' % (
+                adapter.url_scheme,
+                adapter.subdomain and adapter.subdomain + '.' or '',
+                adapter.server_name,
+                adapter.script_name
+            ), redirect_url)))
+
+        return rule, rv
+
+    if have_match_for:
+        raise MethodNotAllowed(valid_methods=list(have_match_for))
+
+    raise NotFound()
 
 
 def url_for(_name, **kwargs):
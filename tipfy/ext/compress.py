@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.ext.compress
+    ~~~~~~~~~~~~~~~~~~
+
+    Response compression middleware. Compresses response bodies with gzip or
+    deflate, according to the encodings accepted by the client.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import zlib
+
+from werkzeug import quote_etag, unquote_etag
+
+from tipfy import LRUCache, Tipfy
+
+#: Default configuration values for this module. Keys are:
+#:
+#: min_size
+#:     Minimum size in bytes of a response body to be compressed. Streamed
+#:     bodies are always compressed, as their size is unknown. Default is
+#:     500.
+#:
+#: mimetypes
+#:     A list of mimetypes that are compressed. Default is a list of text
+#:     mimetypes, JavaScript, JSON and XML.
+#:
+#: level
+#:     Compression level, from 1 (fastest) to 9 (smallest). Default is 6.
+#:
+#: cache_size
+#:     Maximum number of compressed bodies to cache, keyed by URL, strong ETag
+#:     and encoding. Responses of a URL with a strong ETag are expected to
+#:     always have the same body, so it is only compressed once. Default is
+#:     100; 0 disables the cache.
+default_config = {
+    'min_size': 500,
+    'mimetypes': [
+        'text/html',
+        'text/plain',
+        'text/css',
+        'text/javascript',
+        'text/xml',
+        'application/javascript',
+        'application/x-javascript',
+        'application/json',
+        'application/xml',
+        'application/atom+xml',
+        'application/rss+xml',
+    ],
+    'level': 6,
+    'cache_size': 100,
+}
+
+# Window bits for each encoding. Adding 16 makes zlib write a gzip header.
+_wbits = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class CompressMiddleware(object):
+    """Compresses response bodies with gzip or deflate when the client
+    accepts it. To enable it, add it to the list of middleware::
+
+        config['tipfy'] = {
+            'middleware': [
+                'tipfy.ext.compress.CompressMiddleware',
+            ],
+        }
+
+    Streamed bodies are compressed chunk by chunk while they are sent. The
+    ETag of a compressed response is marked as weak, as the body differs
+    from the uncompressed one. To compress bodies with ETags set by other
+    middleware only once, list this middleware before them, so that it runs
+    after them.
+    """
+    def __init__(self):
+        app = Tipfy.app
+        self.min_size = app.get_config(__name__, 'min_size')
+        self.mimetypes = frozenset(app.get_config(__name__, 'mimetypes'))
+        self.level = app.get_config(__name__, 'level')
+        cache_size = app.get_config(__name__, 'cache_size')
+        if cache_size:
+            self.cache = LRUCache(cache_size)
+        else:
+            self.cache = None
+
+    def post_dispatch_handler(self, response):
+        """Compresses the response body if the client accepts it.
+
+        :param response:
+            A ``Response`` instance.
+        :returns:
+            The same response.
+        """
+        status = response.status_code
+        headers = response.headers
+        if status < 200 or status in (204, 304) or \
+            response.mimetype not in self.mimetypes or \
+            'content-encoding' in headers:
+            return response
+
+        # Caches must store compressed and uncompressed bodies separately.
+        vary = headers.get('vary')
+        if not vary:
+            headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            headers['Vary'] = vary + ', Accept-Encoding'
+
+        request = Tipfy.request
+        encoding = get_encoding(request)
+        if encoding is None:
+            return response
+
+        etag, weak = unquote_etag(headers.get('etag'))
+        if response.is_streamed:
+            response.response = compress_iter(response.response, encoding,
+                self.level, response.charset)
+            headers.pop('content-length', None)
+        else:
+            chunks = list(response.iter_encoded())
+            if sum(len(chunk) for chunk in chunks) < self.min_size:
+                return response
+
+            if etag is None or weak or self.cache is None:
+                data = compress(chunks, encoding, self.level)
+            else:
+                # ETags are only unique for a resource.
+                environ = request.environ
+                key = (environ.get('HTTP_HOST'), environ.get('SCRIPT_NAME'),
+                    environ.get('PATH_INFO'), environ.get('QUERY_STRING'),
+                    etag, encoding)
+                data = self.cache.get(key)
+                if data is None:
+                    data = compress(chunks, encoding, self.level)
+                    self.cache.set(key, data)
+
+            response.response = [data]
+            headers['Content-Length'] = str(len(data))
+
+        headers['Content-Encoding'] = encoding
+        if etag is not None and not weak:
+            headers['ETag'] = quote_etag(etag, True)
+
+        return response
+
+
+def get_encoding(request):
+    """Returns the preferred encoding accepted by a client.
+
+    :param request:
+        A ``Request`` instance.
+    :returns:
+        ``'gzip'``, ``'deflate'`` or None.
+    """
+    accept = request.accept_encodings
+    gzip = accept['gzip']
+    deflate = accept['deflate']
+    if gzip and gzip >= deflate:
+        return 'gzip'
+
+    if deflate:
+        return 'deflate'
+
+
+def compress(chunks, encoding, level=6):
+    """Compresses a list of strings.
+
+    :param chunks:
+        A list of strings.
+    :param encoding:
+        ``'gzip'`` or ``'deflate'``.
+    :param level:
+        Compression level.
+    :returns:
+        The compressed string.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _wbits[encoding])
+    data = [compressor.compress(chunk) for chunk in chunks]
+    data.append(compressor.flush())
+    return ''.join(data)
+
+
+def compress_iter(body, encoding, level=6, charset='utf-8'):
+    """Compresses an iterable of strings incrementally. The compressor is
+    flushed after each chunk, so that the client can decompress it as soon
+    as it is received.
+
+    :param body:
+        An iterable of strings, closed when done if it has a ``close()``
+        method.
+    :param encoding:
+        ``'gzip'`` or ``'deflate'``.
+    :param level:
+        Compression level.
+    :param charset:
+        Charset to encode unicode strings.
+    :returns:
+        A generator of compressed strings.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _wbits[encoding])
+    try:
+        for chunk in body:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode(charset)
+
+            if chunk:
+                yield compressor.compress(chunk) + \
+                    compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        yield compressor.flush()
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
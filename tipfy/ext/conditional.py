@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.ext.conditional
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Conditional GET middleware. Sets ETags for responses and answers
+    ``304 Not Modified`` when the client already has the current version.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import hashlib
+
+from werkzeug import (http_date, parse_date, parse_etags, quote_etag,
+    remove_entity_headers, unquote_etag)
+
+from tipfy import Tipfy
+
+#: Default configuration values for this module. Keys are:
+#:
+#: weak
+#:     If True, ETags are marked as weak, meaning that responses with the same
+#:     ETag are semantically equivalent but may differ byte by byte. Default
+#:     is False.
+#:
+#: streamed
+#:     If True, ETags are also computed for streamed responses, which are
+#:     buffered while they are hashed. Default is True.
+default_config = {
+    'weak': False,
+    'streamed': True,
+}
+
+
+class ConditionalMiddleware(object):
+    """Computes ETags for the bodies of ``200 OK`` responses to ``GET`` and
+    ``HEAD`` requests, and replaces them by ``304 Not Modified`` responses
+    when ``If-None-Match`` or ``If-Modified-Since`` match. To enable it,
+    add it to the list of app middleware::
+
+        config['tipfy'] = {
+            'middleware': [
+                'tipfy.ext.conditional.ConditionalMiddleware',
+            ],
+        }
+
+    Handlers that can tell cheaply if a resource changed can also use it as
+    a plugin and define ``get_validators()``, which receives the rule
+    arguments and returns a tuple ``(etag, last_modified)``; any of them can
+    be None. On a match, the handler method is not called::
+
+        class PostHandler(RequestHandler):
+            plugins = ['tipfy.ext.conditional.ConditionalMiddleware']
+
+            def get_validators(self, **kwargs):
+                post = get_post(kwargs['post_id'])
+                return str(post.version), post.updated
+
+            def get(self, **kwargs):
+                # ...
+    """
+    def __init__(self):
+        app = Tipfy.app
+        self.weak = app.get_config(__name__, 'weak')
+        self.streamed = app.get_config(__name__, 'streamed')
+
+    def pre_dispatch(self, handler):
+        """Returns a ``304 Not Modified`` response if the validators declared
+        by the handler match the request.
+
+        :param handler:
+            A :class:`tipfy.RequestHandler` instance.
+        :returns:
+            A ``Response`` instance or None.
+        """
+        request = handler.request
+        get_validators = getattr(handler, 'get_validators', None)
+        if get_validators is None or request.method not in ('GET', 'HEAD'):
+            return None
+
+        etag, last_modified = get_validators(**(request.rule_args or {}))
+        if last_modified is not None:
+            # HTTP dates don't have microseconds.
+            last_modified = last_modified.replace(microsecond=0)
+
+        request.registry[__name__] = (etag, last_modified)
+        if is_not_modified(request, etag, last_modified):
+            response = handler.app.response_class(status=304)
+            self.set_validators(response, etag, last_modified)
+            return response
+
+    def post_dispatch(self, handler, response):
+        """Sets the validators declared by the handler in the response.
+
+        :param handler:
+            A :class:`tipfy.RequestHandler` instance.
+        :param response:
+            A ``Response`` instance.
+        :returns:
+            The same response.
+        """
+        validators = handler.request.registry.get(__name__)
+        if validators is not None and response.status_code == 200:
+            self.set_validators(response, *validators)
+
+        return response
+
+    def post_dispatch_handler(self, response):
+        """Sets the ETag of the response, and turns it into a ``304 Not
+        Modified`` response if the request validators match.
+
+        :param response:
+            A ``Response`` instance.
+        :returns:
+            A ``Response`` instance.
+        """
+        request = Tipfy.request
+        if request.method not in ('GET', 'HEAD') or \
+            response.status_code != 200:
+            return response
+
+        headers = response.headers
+        if 'etag' not in headers and (self.streamed or
+            not response.is_streamed):
+            headers['ETag'] = quote_etag(get_body_etag(response), self.weak)
+
+        etag = unquote_etag(headers.get('etag'))[0]
+        last_modified = parse_date(headers.get('last-modified'))
+        if is_not_modified(request, etag, last_modified):
+            return make_not_modified(response)
+
+        return response
+
+    def set_validators(self, response, etag, last_modified):
+        headers = response.headers
+        if etag is not None and 'etag' not in headers:
+            headers['ETag'] = quote_etag(etag, self.weak)
+
+        if last_modified is not None and 'last-modified' not in headers:
+            headers['Last-Modified'] = http_date(last_modified)
+
+
+def get_body_etag(response):
+    """Returns an ETag computed from the body of a response. The body is
+    hashed chunk by chunk; a streamed body is buffered while it is hashed,
+    so that it can still be sent.
+
+    :param response:
+        A ``Response`` instance.
+    :returns:
+        The unquoted ETag.
+    """
+    md5 = hashlib.md5()
+    if response.is_sequence:
+        for chunk in response.iter_encoded():
+            md5.update(chunk)
+    else:
+        body = response.response
+        chunks = []
+        for chunk in response.iter_encoded():
+            md5.update(chunk)
+            chunks.append(chunk)
+
+        if hasattr(body, 'close'):
+            body.close()
+
+        response.response = chunks
+
+    return md5.hexdigest()
+
+
+def is_not_modified(request, etag, last_modified):
+    """Checks if the conditional headers of a request match the validators
+    of a response. ``If-None-Match`` takes precedence over
+    ``If-Modified-Since``, and ETags are compared using weak comparison.
+
+    :param request:
+        A ``Request`` instance.
+    :param etag:
+        The unquoted ETag of the response, or None.
+    :param last_modified:
+        The modification date of the response as a ``datetime``, or None.
+    :returns:
+        True if the client has the current version of the response.
+    """
+    environ = request.environ
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return etag is not None and \
+            parse_etags(if_none_match).contains_weak(etag)
+
+    if last_modified is not None:
+        modified_since = parse_date(environ.get('HTTP_IF_MODIFIED_SINCE'))
+        return modified_since is not None and last_modified <= modified_since
+
+    return False
+
+
+def make_not_modified(response):
+    """Turns a response into a ``304 Not Modified`` response, without body
+    and entity headers.
+
+    :param response:
+        A ``Response`` instance.
+    :returns:
+        The same response.
+    """
+    if hasattr(response.response, 'close'):
+        response.response.close()
+
+    response.status_code = 304
+    response.response = []
+    remove_entity_headers(response.headers)
+    return response
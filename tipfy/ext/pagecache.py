@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.ext.pagecache
+    ~~~~~~~~~~~~~~~~~~~
+
+    Full page cache middleware. Responses to ``GET`` requests are cached and
+    served to following ``GET`` and ``HEAD`` requests without dispatching
+    them to handlers.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import hashlib
+import math
+import time
+
+from tipfy import LRUCache, Tipfy
+
+#: Default configuration values for this module. Keys are:
+#:
+#: backend
+#:     Where responses are cached: ``'memory'`` for an in-process LRU cache,
+#:     or ``'memcache'`` to use App Engine's memcache or, outside of App
+#:     Engine, a ``memcache.Client`` connected to ``memcache_servers``.
+#:     Default is ``'memory'``.
+#:
+#: capacity
+#:     Maximum number of responses kept by the ``'memory'`` backend. The least
+#:     recently used ones are discarded when it is reached. Default is 1000.
+#:
+#: ttl
+#:     Seconds a response is cached. Default is 60.
+#:
+#: rule_ttls
+#:     A dictionary of seconds a response is cached keyed by rule name, to
+#:     override ``ttl`` for some rules. Use 0 to not cache a rule. Default is
+#:     an empty dictionary.
+#:
+#: vary
+#:     A list of request headers that are part of the cache key, e.g.,
+#:     ``['Accept-Language']``. Default is an empty list.
+#:
+#: ignore_cookies
+#:     A list of cookie names that don't change the response, e.g., analytics
+#:     cookies. Requests sending other cookies or an ``Authorization`` header
+#:     may get personalized pages, so they are not cached nor served from the
+#:     cache. Default is an empty list.
+#:
+#: memcache_servers
+#:     Servers used by the ``'memcache'`` backend outside of App Engine.
+#:     Default is ``['127.0.0.1:11211']``.
+#:
+#: key_prefix
+#:     Prefix for the cache keys. Default is ``'tipfy.ext.pagecache:'``.
+default_config = {
+    'backend': 'memory',
+    'capacity': 1000,
+    'ttl': 60,
+    'rule_ttls': {},
+    'vary': [],
+    'ignore_cookies': [],
+    'memcache_servers': ['127.0.0.1:11211'],
+    'key_prefix': 'tipfy.ext.pagecache:',
+}
+
+
+class MemoryBackend(object):
+    """Caches values in memory, in a :class:`tipfy.LRUCache`."""
+    def __init__(self, capacity):
+        """Initializes the backend.
+
+        :param capacity:
+            Maximum number of values to keep.
+        """
+        self.cache = LRUCache(capacity)
+
+    def get(self, key):
+        """Returns a cached value, or None if it is missing or expired.
+
+        :param key:
+            The cache key.
+        :returns:
+            The cached value or None.
+        """
+        item = self.cache.get(key)
+        if item is None:
+            return None
+
+        if item[0] < time.time():
+            self.cache.delete(key)
+            return None
+
+        return item[1]
+
+    def set(self, key, value, ttl):
+        """Caches a value.
+
+        :param key:
+            The cache key.
+        :param value:
+            The value to be cached.
+        :param ttl:
+            Seconds to keep the value.
+        """
+        self.cache.set(key, (time.time() + ttl, value))
+
+
+class MemcacheBackend(object):
+    """Caches values in memcache, using a client with the ``memcache``
+    module API, such as App Engine's ``google.appengine.api.memcache`` or
+    ``memcache.Client`` from python-memcached.
+    """
+    def __init__(self, client):
+        """Initializes the backend.
+
+        :param client:
+            A memcache client.
+        """
+        self.client = client
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl):
+        # Memcache expiration times are integers, and 0 means no expiration.
+        self.client.set(key, value, time=int(math.ceil(ttl)))
+
+
+class PageCacheMiddleware(object):
+    """Caches the responses to ``GET`` requests and serves them to
+    following ``GET`` and ``HEAD`` requests with the same URL and ``vary``
+    headers, skipping dispatch. To enable it, add it to the list of
+    middleware::
+
+        config['tipfy'] = {
+            'middleware': [
+                'tipfy.ext.pagecache.PageCacheMiddleware',
+            ],
+        }
+
+    Requests with cookies not listed in ``ignore_cookies`` or with an
+    ``Authorization`` header are dispatched normally. Only ``200 OK``
+    responses without cookies, a ``private`` or ``no-store``
+    ``Cache-Control`` header or a streamed body are cached.
+
+    The request headers named in the ``Vary`` header of a cached response,
+    e.g., ``Accept-Encoding`` set by
+    :class:`tipfy.ext.compress.CompressMiddleware`, are also part of the
+    key. They are cached for each URL, so that the key can be built before
+    dispatch. Responses with ``Vary: *`` are not cached.
+    """
+    def __init__(self):
+        app = Tipfy.app
+        self.ttl = app.get_config(__name__, 'ttl')
+        self.rule_ttls = app.get_config(__name__, 'rule_ttls')
+        self.vary = tuple(app.get_config(__name__, 'vary'))
+        self.ignore_cookies = frozenset(app.get_config(__name__,
+            'ignore_cookies'))
+        self.key_prefix = app.get_config(__name__, 'key_prefix')
+        self.backend = get_backend(app)
+
+    def pre_dispatch_handler(self):
+        """Returns a cached response for the current request, if any.
+
+        :returns:
+            A ``Response`` instance or None.
+        """
+        request = Tipfy.request
+        if request.method not in ('GET', 'HEAD') or \
+            self.get_ttl(request) <= 0:
+            return None
+
+        if 'HTTP_AUTHORIZATION' in request.environ:
+            return None
+
+        for name in request.cookies:
+            if name not in self.ignore_cookies:
+                return None
+
+        # Headers named by the Vary header of the cached responses.
+        vary = self.backend.get(self.get_key(request, 'vary'))
+        if vary is not None:
+            cached = self.backend.get(self.get_key(request, 'page', vary))
+            if cached is not None:
+                status, headers, body = cached
+                return Tipfy.app.response_class(body, status=status,
+                    headers=headers)
+
+        if request.method == 'GET':
+            # Mark the request to cache the response.
+            request.registry[__name__] = True
+
+    def post_dispatch_handler(self, response):
+        """Caches the response if the request was marked to be cached.
+
+        :param response:
+            A ``Response`` instance.
+        :returns:
+            The same response.
+        """
+        request = Tipfy.request
+        if not request.registry.pop(__name__, None) or \
+            response.status_code != 200 or response.is_streamed or \
+            'set-cookie' in response.headers:
+            return response
+
+        cache_control = response.headers.get('cache-control', '')
+        if 'private' in cache_control or 'no-store' in cache_control:
+            return response
+
+        vary = get_vary(response)
+        if vary is None:
+            return response
+
+        ttl = self.get_ttl(request)
+        self.backend.set(self.get_key(request, 'vary'), vary, ttl)
+        self.backend.set(self.get_key(request, 'page', vary),
+            (response.status_code, list(response.headers), response.data),
+            ttl)
+        return response
+
+    def get_ttl(self, request):
+        """Returns the seconds to cache the response for a request.
+
+        :param request:
+            A ``Request`` instance.
+        :returns:
+            The number of seconds, or 0 to not cache.
+        """
+        rule = request.rule
+        if rule is not None:
+            return self.rule_ttls.get(rule.name, self.ttl)
+
+        return self.ttl
+
+    def get_key(self, request, kind='page', vary=()):
+        """Returns a cache key for a request.
+
+        :param request:
+            A ``Request`` instance.
+        :param kind:
+            ``'page'`` for the key of the cached response, or ``'vary'``
+            for the key of the header names it varies on.
+        :param vary:
+            Names of request headers that are part of the key, besides the
+            ``vary`` config.
+        :returns:
+            A string, suitable as a memcache key.
+        """
+        environ = request.environ
+        parts = [environ.get('wsgi.url_scheme', ''),
+            environ.get('HTTP_HOST', ''), environ.get('SCRIPT_NAME', ''),
+            environ.get('PATH_INFO', ''), environ.get('QUERY_STRING', '')]
+        headers = request.headers
+        for name in self.vary:
+            parts.append(headers.get(name, ''))
+
+        for name in vary:
+            parts.append('%s=%s' % (name, headers.get(name, '')))
+
+        return '%s%s:%s' % (self.key_prefix, kind,
+            hashlib.sha1('\n'.join(parts)).hexdigest())
+
+
+def get_vary(response):
+    """Returns the request headers named in the ``Vary`` header of a
+    response.
+
+    :param response:
+        A ``Response`` instance.
+    :returns:
+        A sorted tuple of lower case header names, or None if the response
+        varies on ``*``.
+    """
+    names = set()
+    for name in response.headers.get('vary', '').split(','):
+        name = name.strip().lower()
+        if name == '*':
+            return None
+
+        if name:
+            names.add(name)
+
+    return tuple(sorted(names))
+
+
+def get_backend(app):
+    """Returns the page cache backend configured for an app.
+
+    :param app:
+        A :class:`tipfy.Tipfy` instance.
+    :returns:
+        A :class:`MemoryBackend` or :class:`MemcacheBackend` instance.
+    """
+    backend = app.get_config(__name__, 'backend')
+    if backend == 'memory':
+        return MemoryBackend(app.get_config(__name__, 'capacity'))
+
+    if backend == 'memcache':
+        try:
+            from google.appengine.api import memcache
+            client = memcache
+        except ImportError:
+            import memcache
+            client = memcache.Client(app.get_config(__name__,
+                'memcache_servers'))
+
+        return MemcacheBackend(client)
+
+    raise ValueError('Invalid page cache backend: %r.' % backend)
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.ext.ratelimit
+    ~~~~~~~~~~~~~~~~~~~
+
+    Rate limiting and load shedding middleware. Requests are limited using
+    token buckets kept in memory, and part of them are rejected when handlers
+    respond slower than a configured latency objective.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import math
+import random
+import threading
+import time
+
+from tipfy import LRUCache, Tipfy
+
+#: Default configuration values for this module. Keys are:
+#:
+#: rate
+#:     Number of requests per second allowed for each key, on average.
+#:     Default is 10.
+#:
+#: burst
+#:     Maximum number of requests allowed at once for each key, which is the
+#:     capacity of the token buckets. Default is 20.
+#:
+#: key_by
+#:     How requests are grouped: ``'client'`` to limit each client address,
+#:     or ``'rule'`` to limit each rule, for all clients. Default is
+#:     ``'client'``.
+#:
+#: client_header
+#:     A request header with the client address, e.g., ``'X-Forwarded-For'``
+#:     behind a proxy. Default is None, to use the remote address of the
+#:     connection.
+#:
+#: trusted_proxies
+#:     Number of proxies in front of the app that append an address to
+#:     ``client_header``. The client address is the one added by the
+#:     outermost of them, counting from the right, as the addresses before it
+#:     are set by the client. If the header has fewer addresses, the remote
+#:     address is used. Default is 1.
+#:
+#: rule_limits
+#:     A dictionary of tuples ``(rate, burst)`` keyed by rule name, to
+#:     override ``rate`` and ``burst`` for some rules. A rate of None doesn't
+#:     limit the rule, and a rate of 0 allows only ``burst`` requests for
+#:     each key, e.g., ``(0, 0)`` blocks the rule. Default is an empty
+#:     dictionary.
+#:
+#: max_buckets
+#:     Maximum number of token buckets kept in memory. The least recently
+#:     used ones are discarded when it is reached. Default is 10000.
+#:
+#: latency_slo
+#:     Target handler latency in seconds. When the average latency goes over
+#:     it, part of the requests are rejected with ``503 Service Unavailable``,
+#:     proportionally to the excess. Default is None (disabled).
+#:
+#: retry_after
+#:     Seconds sent in the ``Retry-After`` header of requests rejected due to
+#:     load or by a bucket that never refills. Default is 1.
+default_config = {
+    'rate': 10,
+    'burst': 20,
+    'key_by': 'client',
+    'client_header': None,
+    'trusted_proxies': 1,
+    'rule_limits': {},
+    'max_buckets': 10000,
+    'latency_slo': None,
+    'retry_after': 1,
+}
+
+
+class TokenBucket(object):
+    """A bucket that refills with tokens at a constant rate, up to its
+    capacity. Each allowed request takes one token.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        """Initializes a full bucket.
+
+        :param rate:
+            Tokens added per second. If 0, the bucket never refills.
+        :param burst:
+            Maximum number of tokens.
+        :param now:
+            Current time, in seconds.
+        """
+        if rate < 0:
+            raise ValueError('Invalid token bucket rate: %r.' % rate)
+
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now or time.time()
+
+    def consume(self, now=None):
+        """Takes a token from the bucket.
+
+        :param now:
+            Current time, in seconds.
+        :returns:
+            0 if a token was taken, or the seconds until a token is available,
+            which are infinite if the bucket never refills.
+        """
+        now = now or time.time()
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        if not self.rate:
+            return float('inf')
+
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimitMiddleware(object):
+    """Limits the rate of requests per client or per rule, and sheds load
+    when handlers are slow. To enable it, add it to the list of middleware::
+
+        config['tipfy'] = {
+            'middleware': [
+                'tipfy.ext.ratelimit.RateLimitMiddleware',
+            ],
+        }
+
+    Requests over the rate limit receive a ``429 Too Many Requests``
+    response. Buckets are kept in a :class:`tipfy.LRUCache`, so memory is
+    bounded and idle buckets are the first to be discarded; a bucket idle
+    for ``burst / rate`` seconds is full, so discarding it doesn't change
+    the limits.
+
+    The latency is measured from this middleware to the end of dispatch, so
+    list it first to measure the other middleware as well.
+    """
+    #: Weight of the last request in the average latency.
+    latency_weight = 0.1
+
+    def __init__(self):
+        app = Tipfy.app
+        self.rate = app.get_config(__name__, 'rate')
+        self.burst = app.get_config(__name__, 'burst')
+        self.key_by = app.get_config(__name__, 'key_by')
+        if self.key_by not in ('client', 'rule'):
+            raise ValueError('Invalid rate limit key: %r.' % self.key_by)
+
+        self.client_header = app.get_config(__name__, 'client_header')
+        self.trusted_proxies = app.get_config(__name__, 'trusted_proxies')
+        self.rule_limits = app.get_config(__name__, 'rule_limits')
+        self.buckets = LRUCache(app.get_config(__name__, 'max_buckets'))
+        self.latency_slo = app.get_config(__name__, 'latency_slo')
+        self.retry_after = app.get_config(__name__, 'retry_after')
+        # Moving average of the handler latency, in seconds.
+        self.latency = 0.0
+        self.lock = threading.Lock()
+
+    def pre_dispatch_handler(self):
+        """Returns an error response if the request is over the rate limit or
+        must be rejected due to load.
+
+        :returns:
+            A ``Response`` instance or None.
+        """
+        request = Tipfy.request
+        now = time.time()
+        if self.latency_slo is not None:
+            if self.is_overloaded():
+                return self.make_response('503 Service Unavailable',
+                    self.retry_after)
+
+            request.registry[__name__] = now
+
+        rule = request.rule
+        if rule is not None and rule.name in self.rule_limits:
+            rate, burst = self.rule_limits[rule.name]
+        else:
+            rate, burst = self.rate, self.burst
+
+        if rate is None:
+            return None
+
+        key = self.get_key(request)
+        if key is None:
+            return None
+
+        self.lock.acquire()
+        try:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(rate, burst, now)
+                self.buckets.set(key, bucket)
+
+            wait = bucket.consume(now)
+        finally:
+            self.lock.release()
+
+        if wait:
+            # Rejected requests don't count for the latency.
+            request.registry.pop(__name__, None)
+            if wait == float('inf'):
+                wait = self.retry_after
+
+            return self.make_response('429 Too Many Requests', wait)
+
+    def post_dispatch_handler(self, response):
+        """Updates the average latency with the one of the current request.
+
+        :param response:
+            A ``Response`` instance.
+        :returns:
+            The same response.
+        """
+        start = Tipfy.request.registry.pop(__name__, None)
+        if start is not None:
+            elapsed = time.time() - start
+            # Concurrent updates may lose a sample, which is fine for an
+            # average.
+            self.latency += (elapsed - self.latency) * self.latency_weight
+
+        return response
+
+    def is_overloaded(self):
+        """Checks if a request must be rejected due to load. When the average
+        latency is over the objective, requests are rejected with a
+        probability proportional to the excess, so that the ones still
+        dispatched keep measuring the latency.
+
+        :returns:
+            True if the request must be rejected.
+        """
+        latency = self.latency
+        if latency <= self.latency_slo:
+            return False
+
+        return random.random() > self.latency_slo / latency
+
+    def get_key(self, request):
+        """Returns the bucket key for a request.
+
+        :param request:
+            A ``Request`` instance.
+        :returns:
+            A tuple, or None to not limit the request.
+        """
+        rule = request.rule
+        if self.key_by == 'rule':
+            if rule is None:
+                return None
+
+            return ('rule', rule.name)
+
+        address = None
+        if self.client_header:
+            # Only addresses appended by trusted proxies can't be forged.
+            hops = [hop.strip() for hop in request.headers.get(
+                self.client_header, '').split(',') if hop.strip()]
+            if self.trusted_proxies and len(hops) >= self.trusted_proxies:
+                address = hops[-self.trusted_proxies]
+
+        address = address or request.remote_addr
+        if rule is not None and rule.name in self.rule_limits:
+            # Rules with their own limits have separate buckets.
+            return ('client', address, rule.name)
+
+        return ('client', address)
+
+    def make_response(self, status, retry_after):
+        """Returns a response for a rejected request.
+
+        :param status:
+            The response status.
+        :param retry_after:
+            Seconds after which the client can retry.
+        :returns:
+            A ``Response`` instance.
+        """
+        return Tipfy.app.response_class(status, status=status, headers=[
+            ('Retry-After', str(int(math.ceil(retry_after))))])
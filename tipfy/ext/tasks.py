@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+"""
+    tipfy.ext.tasks
+    ~~~~~~~~~~~~~~~
+
+    In-process deferred task queue. Callables are pickled into a local store
+    and executed after the request by a pool of worker threads, in batches,
+    with retries and exponential backoff.
+
+    :copyright: 2010 by tipfy.org.
+    :license: BSD, see LICENSE.txt for more details.
+"""
+import cPickle as pickle
+import heapq
+import logging
+import threading
+import time
+
+from tipfy import RequestHandler, Tipfy
+
+#: Default configuration values for this module. Keys are:
+#:
+#: store_path
+#:     Path to a SQLite database where tasks are stored, so that pending tasks
+#:     survive a restart. Default is None, to keep tasks in memory.
+#:
+#: workers
+#:     Number of worker threads executing tasks in the background. If 0,
+#:     tasks are only executed by :meth:`TaskQueue.run_pending`, e.g., when
+#:     :class:`TaskQueueHandler` is requested. Default is 2.
+#:
+#: batch_size
+#:     Maximum number of tasks leased from the store at once. Default is 10.
+#:
+#: max_retries
+#:     Number of times a failed task is retried before it is discarded.
+#:     Default is 5.
+#:
+#: retry_delay
+#:     Seconds to wait before the first retry of a failed task. The delay is
+#:     doubled for each following retry. Default is 1.
+#:
+#: max_retry_delay
+#:     Maximum number of seconds to wait before retrying a task. Default is
+#:     300.
+#:
+#: lease_time
+#:     Seconds a leased task is hidden from other workers. If the process
+#:     stops while executing it, it is executed again after this time.
+#:     Default is 600.
+default_config = {
+    'store_path': None,
+    'workers': 2,
+    'batch_size': 10,
+    'max_retries': 5,
+    'retry_delay': 1,
+    'max_retry_delay': 300,
+    'lease_time': 600,
+}
+
+# Lock to create the task queue of an app only once.
+_lock = threading.Lock()
+
+
+class PermanentTaskFailure(Exception):
+    """Raised by a task to be discarded without being retried."""
+
+
+class MemoryStore(object):
+    """Stores tasks in memory. Pending tasks are lost when the process
+    stops.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.last_id = 0
+
+    def put(self, tasks):
+        """Stores new tasks.
+
+        :param tasks:
+            A list of tuples ``(eta, payload)``.
+        :returns:
+            A list with the ids of the stored tasks.
+        """
+        self.lock.acquire()
+        try:
+            ids = []
+            for eta, payload in tasks:
+                self.last_id += 1
+                self.tasks[self.last_id] = [eta, 0, payload]
+                ids.append(self.last_id)
+
+            return ids
+        finally:
+            self.lock.release()
+
+    def lease(self, now, limit, lease_time):
+        """Returns the tasks due by a given time, and postpones them by the
+        lease time so that they are not returned again while executed.
+
+        :param now:
+            Current timestamp.
+        :param limit:
+            Maximum number of tasks to return.
+        :param lease_time:
+            Seconds to postpone the returned tasks.
+        :returns:
+            A list of tuples ``(id, retries, payload)``, ordered by ETA.
+        """
+        self.lock.acquire()
+        try:
+            due = heapq.nsmallest(limit, ((task[0], id) for id, task in
+                self.tasks.iteritems() if task[0] <= now))
+            res = []
+            for eta, id in due:
+                task = self.tasks[id]
+                task[0] = now + lease_time
+                res.append((id, task[1], task[2]))
+
+            return res
+        finally:
+            self.lock.release()
+
+    def retry(self, id, eta, retries):
+        """Schedules a task to be executed again.
+
+        :param id:
+            The task id.
+        :param eta:
+            Timestamp of the next execution.
+        :param retries:
+            Number of times the task was retried.
+        """
+        self.lock.acquire()
+        try:
+            task = self.tasks.get(id)
+            if task is not None:
+                task[0] = eta
+                task[1] = retries
+        finally:
+            self.lock.release()
+
+    def delete(self, ids):
+        """Removes tasks.
+
+        :param ids:
+            A list of task ids.
+        """
+        self.lock.acquire()
+        try:
+            for id in ids:
+                self.tasks.pop(id, None)
+        finally:
+            self.lock.release()
+
+    def count(self):
+        """Returns the number of stored tasks."""
+        return len(self.tasks)
+
+
+class SqliteStore(object):
+    """Stores tasks in a SQLite database, so that pending tasks are kept
+    when the process stops. Implements the same interface as
+    :class:`MemoryStore`.
+    """
+    def __init__(self, path):
+        """Initializes the store.
+
+        :param path:
+            Path to the database file. It is created if it doesn't exist.
+        """
+        import sqlite3
+        self.binary = sqlite3.Binary
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False,
+            isolation_level=None)
+        self.execute('CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY '
+            'KEY, eta REAL, retries INTEGER, payload BLOB)')
+        self.execute('CREATE INDEX IF NOT EXISTS tasks_eta ON tasks (eta)')
+
+    def execute(self, query, *args):
+        self.lock.acquire()
+        try:
+            return self.connection.execute(query, args).fetchall()
+        finally:
+            self.lock.release()
+
+    def put(self, tasks):
+        self.lock.acquire()
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN')
+            try:
+                ids = []
+                for eta, payload in tasks:
+                    cursor.execute('INSERT INTO tasks (eta, retries, payload) '
+                        'VALUES (?, 0, ?)', (eta, self.binary(payload)))
+                    ids.append(cursor.lastrowid)
+
+                cursor.execute('COMMIT')
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+
+            return ids
+        finally:
+            self.lock.release()
+
+    def lease(self, now, limit, lease_time):
+        self.lock.acquire()
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                rows = cursor.execute('SELECT id, retries, payload FROM tasks '
+                    'WHERE eta <= ? ORDER BY eta LIMIT ?',
+                    (now, limit)).fetchall()
+                cursor.executemany('UPDATE tasks SET eta = ? WHERE id = ?',
+                    [(now + lease_time, row[0]) for row in rows])
+                cursor.execute('COMMIT')
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+
+            return [(id, retries, str(payload)) for id, retries, payload in
+                rows]
+        finally:
+            self.lock.release()
+
+    def retry(self, id, eta, retries):
+        self.execute('UPDATE tasks SET eta = ?, retries = ? WHERE id = ?',
+            eta, retries, id)
+
+    def delete(self, ids):
+        self.lock.acquire()
+        try:
+            self.connection.executemany('DELETE FROM tasks WHERE id = ?',
+                [(id,) for id in ids])
+        finally:
+            self.lock.release()
+
+    def count(self):
+        return self.execute('SELECT COUNT(*) FROM tasks')[0][0]
+
+
+class TaskQueue(object):
+    """A queue of deferred callables, executed in batches by worker threads
+    or by :meth:`run_pending`. Tasks that raise an exception are retried with
+    exponential backoff.
+    """
+    def __init__(self, store, workers=2, batch_size=10, max_retries=5,
+        retry_delay=1, max_retry_delay=300, lease_time=600, app=None):
+        """Initializes the queue. Worker threads are started by
+        :meth:`start`.
+
+        :param store:
+            A task store, e.g., a :class:`MemoryStore` or :class:`SqliteStore`.
+        :param workers:
+            Number of worker threads.
+        :param batch_size:
+            Maximum number of tasks leased from the store at once.
+        :param max_retries:
+            Number of times a failed task is retried.
+        :param retry_delay:
+            Seconds to wait before the first retry.
+        :param max_retry_delay:
+            Maximum number of seconds to wait before a retry.
+        :param lease_time:
+            Seconds a leased task is hidden from other workers.
+        :param app:
+            A :class:`Tipfy` instance, set as the active app while tasks are
+            executed.
+        """
+        self.store = store
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.lease_time = lease_time
+        self.app = app
+        self.condition = threading.Condition()
+        self.threads = []
+        self.running = False
+
+    def add(self, func, *args, **kwargs):
+        """Adds a task to execute a callable.
+
+        :param func:
+            A picklable callable, e.g., a module level function.
+        :param args:
+            Positional arguments to call it with.
+        :param kwargs:
+            Keyword arguments to call it with. The ``_countdown`` argument
+            sets the number of seconds to wait before executing the task.
+        :returns:
+            The task id.
+        """
+        countdown = kwargs.pop('_countdown', 0)
+        return self.add_many([(func, args, kwargs)], countdown)[0]
+
+    def add_many(self, calls, countdown=0):
+        """Adds tasks for several callables at once.
+
+        :param calls:
+            A list of tuples ``(func, args, kwargs)``.
+        :param countdown:
+            Seconds to wait before executing the tasks.
+        :returns:
+            A list with the task ids.
+        """
+        eta = time.time() + countdown
+        ids = self.store.put([(eta, pickle.dumps(call,
+            pickle.HIGHEST_PROTOCOL)) for call in calls])
+
+        self.condition.acquire()
+        try:
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+        return ids
+
+    def run_batch(self):
+        """Leases a batch of due tasks and executes them.
+
+        :returns:
+            The number of executed tasks.
+        """
+        tasks = self.store.lease(time.time(), self.batch_size,
+            self.lease_time)
+        if not tasks:
+            return 0
+
+        done = []
+        for id, retries, payload in tasks:
+            if self.execute(id, retries, payload):
+                done.append(id)
+
+        if done:
+            self.store.delete(done)
+
+        return len(tasks)
+
+    def run_pending(self):
+        """Executes all due tasks in the current thread.
+
+        :returns:
+            The number of executed tasks.
+        """
+        count = 0
+        while True:
+            executed = self.run_batch()
+            if not executed:
+                return count
+
+            count += executed
+
+    def execute(self, id, retries, payload):
+        """Executes a task, scheduling a retry if it fails.
+
+        :returns:
+            True if the task must be removed from the store.
+        """
+        if self.app is not None:
+            Tipfy.app = self.app
+
+        try:
+            func, args, kwargs = pickle.loads(payload)
+            func(*args, **kwargs)
+            return True
+        except PermanentTaskFailure, e:
+            logging.error('Task %s failed permanently: %s' % (id, e))
+            return True
+        except Exception, e:
+            if retries >= self.max_retries:
+                logging.exception('Task %s failed after %d retries.' % (id,
+                    retries))
+                return True
+
+            delay = min(self.retry_delay * 2 ** retries, self.max_retry_delay)
+            logging.warning('Task %s failed, retrying in %ss: %s' % (id,
+                delay, e))
+            self.store.retry(id, time.time() + delay, retries + 1)
+            return False
+
+    def start(self):
+        """Starts the worker threads."""
+        self.condition.acquire()
+        try:
+            self.running = True
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.condition.release()
+
+    def stop(self, wait=True):
+        """Stops the worker threads after their current batch.
+
+        :param wait:
+            True to wait for the threads to finish.
+        """
+        self.condition.acquire()
+        try:
+            self.running = False
+            threads, self.threads = self.threads, []
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def work(self):
+        while self.running:
+            try:
+                if self.run_batch():
+                    continue
+            except Exception:
+                logging.exception('Error leasing tasks.')
+
+            # Nothing to do: wait for new tasks, or for retries to be due.
+            self.condition.acquire()
+            try:
+                if self.running:
+                    self.condition.wait(1)
+            finally:
+                self.condition.release()
+
+
+class TaskQueueMixin(object):
+    """A mixin for :class:`tipfy.RequestHandler` to defer tasks to the app's
+    :class:`TaskQueue`::
+
+        class SignupHandler(RequestHandler, TaskQueueMixin):
+            def post(self, **kwargs):
+                # ...
+                self.defer(send_welcome_email, user.email)
+                return Response('Welcome!')
+    """
+    def defer(self, func, *args, **kwargs):
+        """Adds a task to the app's task queue.
+
+        .. seealso:: :meth:`TaskQueue.add`.
+        """
+        return get_task_queue(self.app).add(func, *args, **kwargs)
+
+    def defer_many(self, calls, countdown=0):
+        """Adds several tasks to the app's task queue.
+
+        .. seealso:: :meth:`TaskQueue.add_many`.
+        """
+        return get_task_queue(self.app).add_many(calls, countdown)
+
+
+class TaskQueueHandler(RequestHandler):
+    """Executes all due tasks. Useful when tasks are not executed by worker
+    threads, e.g., requesting it periodically from a script. It can be mapped
+    to a protected URL::
+
+        Rule('/_tasks/run', name='tasks/run',
+            handler='tipfy.ext.tasks.TaskQueueHandler')
+
+    Only ``POST`` requests are accepted, so that crawlers and link
+    prefetchers can't execute tasks.
+    """
+    def post(self, **kwargs):
+        count = get_task_queue(self.app).run_pending()
+        return self.app.response_class('%d' % count, mimetype='text/plain')
+
+
+def get_task_queue(app=None):
+    """Returns the task queue of an app, stored in its registry. It is
+    created on first use with the values from this module's config, and its
+    worker threads are started.
+
+    :param app:
+        A :class:`tipfy.Tipfy` instance. Default is the active app.
+    :returns:
+        A :class:`TaskQueue` instance.
+    """
+    app = app or Tipfy.app
+    queue = app.registry.get(__name__)
+    if queue is None:
+        _lock.acquire()
+        try:
+            queue = app.registry.get(__name__)
+            if queue is None:
+                queue = app.registry[__name__] = create_task_queue(app)
+                queue.start()
+        finally:
+            _lock.release()
+
+    return queue
+
+
+def create_task_queue(app):
+    """Returns a new :class:`TaskQueue` configured with the values from this
+    module's config.
+
+    :param app:
+        A :class:`tipfy.Tipfy` instance.
+    :returns:
+        A :class:`TaskQueue` instance.
+    """
+    config = dict((key, app.get_config(__name__, key)) for key in
+        default_config)
+    path = config.pop('store_path')
+    if path:
+        store = SqliteStore(path)
+    else:
+        store = MemoryStore()
+
+    return TaskQueue(store, app=app, **config)